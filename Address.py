@@ -0,0 +1,143 @@
+"""
+Name:     Address.py
+Purpose:  Column at a time situs address parsing
+
+          Split() turns a whole column of LOCADDR / SITUS / REM_PRCL_LOCN values into house
+          number and street columns with one scan of each string - FieldMap.Normalize() calls
+          it once per batch for both fields (FieldMap.SplitAddress). Fix() applies
+          codeblock_FixStreet and codeblock_FixHouseNo to whole columns - house numbers that do
+          not start with 1-9 are folded into the street and the house number becomes "--".
+
+          Plain list comprehensions - a numpy.unicode_ version of Fix() was slower than the
+          codeblocks on the 1000 row blocks Pipeline.Addresses() feeds it, building the arrays
+          costing more than the comparisons save. CheckEquivalence() compares Split() and Fix()
+          against the codeblocks in MonthlyParcelUpdate.py on random addresses, Benchmark()
+          times them against the row by row functions in those blocks.
+
+"""
+
+import ast, os, random, time
+
+Placeholder = '--'
+
+Digits = frozenset('123456789')
+
+############################################################################################
+
+def Split(addresses):
+    # [address, ...] --> ([house number, ...], [street, ...])
+    parts = [address.partition(' ') if isinstance(address, basestring) else (None, None, None) for address in addresses]
+    return [p[0] for p in parts], [p[2] for p in parts]
+
+def FixStreet(HouseNo, Street):
+    # Same as codeblock_FixStreet
+    if isinstance(HouseNo, basestring) and HouseNo[:1] in Digits:
+        return Street
+    if isinstance(HouseNo, basestring) and HouseNo and isinstance(Street, basestring):
+        return HouseNo + " " + Street
+    return Street
+
+def FixHouseNo(HouseNo):
+    # Same as codeblock_FixHouseNo
+    if isinstance(HouseNo, basestring) and HouseNo[:1] in Digits:
+        return HouseNo
+    return Placeholder
+
+def Fix(houseNumbers, streets):
+    # Columns of FixHouseNo() and FixStreet()
+    text = all(isinstance(v, basestring) for v in houseNumbers) and all(isinstance(v, basestring) for v in streets)
+    if text:
+        keep = [h[:1] in Digits for h in houseNumbers]
+        return ([h if k else Placeholder for h, k in zip(houseNumbers, keep)],
+                [s if k or not h else h + " " + s for h, s, k in zip(houseNumbers, streets, keep)])
+    return [FixHouseNo(h) for h in houseNumbers], [FixStreet(h, s) for h, s in zip(houseNumbers, streets)]
+
+############################################################################################
+
+def Codeblocks(path=None):
+    # The codeblock_* strings from MonthlyParcelUpdate.py, read without importing arcpy
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MonthlyParcelUpdate.py')
+    functions = {}
+    for node in ast.parse(open(path).read()).body:
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name) and \
+           node.targets[0].id in ('codeblock_FixStreet', 'codeblock_FixHouseNo'):
+            exec ast.literal_eval(node.value) in functions
+    return functions['FixStreet'], functions['FixHouseNo']
+
+def RandomAddress(rng):
+    # Mostly ordinary addresses plus the odd values that show up in the sources
+    kind = rng.random()
+    if kind < 0.02:
+        return None
+    if kind < 0.04:
+        return ''
+    words = []
+    for i in range(rng.randint(1, 5)):
+        words.append(rng.choice(['', '0', '01', '0012', '1', '9', '123', '4500A', '12-14', 'A', 'N',
+                                 'MAIN', 'ST', 'RD', 'WARWICK', 'BLVD', '--', u'CAF\xc9', '#2']))
+    return rng.choice([' ', ' ', ' ', '  ']).join(words)
+
+def CheckEquivalence(samples=100000, seed=1, path=None):
+    # Random addresses through Split/Fix and through the codeblocks - raises on the first difference
+    rng = random.Random(seed)
+    FixStreetBlock, FixHouseNoBlock = Codeblocks(path)
+    addresses = [RandomAddress(rng) for i in range(samples)]
+    houseNumbers, streets = Split(addresses)
+    for address, house, street in zip(addresses, houseNumbers, streets):
+        if isinstance(address, basestring):
+            x = address.split(" ")
+            expected = (x[0], " ".join(x[1:]))
+        else:
+            expected = (None, None)
+        if (house, street) != expected:
+            raise AssertionError('Split(%r) = %r, expected %r' % (address, (house, street), expected))
+
+    ## House numbers that are not text go through the fallback
+    houseNumbers += [None, '', 12, 0.5]
+    streets += ['MAIN ST', None, 'RD', None]
+    fixedHouse, fixedStreet = Fix(houseNumbers, streets)
+    for i, (house, street) in enumerate(zip(houseNumbers, streets)):
+        expected = (FixHouseNoBlock(house), FixStreetBlock(house, street))
+        if (fixedHouse[i], fixedStreet[i]) != expected or (FixHouseNo(house), FixStreet(house, street)) != expected:
+            raise AssertionError('Fix(%r, %r) = %r, expected %r' % (house, street, (fixedHouse[i], fixedStreet[i]), expected))
+    text = [(h, s) for h, s in zip(houseNumbers, streets) if isinstance(h, basestring) and isinstance(s, basestring)]
+    fixedHouse, fixedStreet = Fix([h for h, s in text], [s for h, s in text])
+    for (house, street), h, s in zip(text, fixedHouse, fixedStreet):
+        if (h, s) != (FixHouseNoBlock(house), FixStreetBlock(house, street)):
+            raise AssertionError('Text only Fix(%r, %r) = %r' % (house, street, (h, s)))
+    print 'Split/Fix match the codeblocks on %d addresses' % samples
+    return True
+
+def Benchmark(count=1000000, seed=1, path=None, block=1000):
+    # Split() and Fix() in blocks of block rows, as FieldMap.Normalize() and Pipeline.Addresses()
+    # call them, against the row by row functions they replace
+    import FieldMap
+    rng = random.Random(seed)
+    FixStreetBlock, FixHouseNoBlock = Codeblocks(path)
+    addresses = [RandomAddress(rng) or '1 MAIN ST' for i in range(count)]
+    blocks = range(0, count, block)
+
+    start = time.time()
+    houseNumbers = [FieldMap.HouseNumber(address) for address in addresses]
+    streets = [FieldMap.Street(address) for address in addresses]
+    splitRows = time.time() - start
+    start = time.time()
+    for i in blocks:
+        Split([FieldMap.Text(address) for address in addresses[i:i + block]])
+    splitColumns = time.time() - start
+
+    start = time.time()
+    [FixHouseNoBlock(h) for h in houseNumbers]
+    [FixStreetBlock(h, s) for h, s in zip(houseNumbers, streets)]
+    fixRows = time.time() - start
+    start = time.time()
+    for i in blocks:
+        Fix(houseNumbers[i:i + block], streets[i:i + block])
+    fixColumns = time.time() - start
+
+    print 'Split: %.2f s row by row (HouseNumber + Street), %.2f s in blocks of %d (%.1fx)' % (
+        splitRows, splitColumns, block, splitRows / splitColumns)
+    print 'Fix:   %.2f s row by row (codeblocks), %.2f s in blocks of %d (%.1fx)' % (
+        fixRows, fixColumns, block, fixRows / fixColumns)
+    return splitRows, splitColumns, fixRows, fixColumns
@@ -0,0 +1,419 @@
+"""
+Name:     Archive.py
+Purpose:  Keep every month's RealPropertyParcel in one content-addressed store
+
+          Each UpdateFolder\<date> holds whole copies of the parcels, though only a few percent
+          of them change from one month to the next. Store() splits a layer into geometries
+          (Geometry.Pack) and attribute rows and keeps each object in Archive.sqlite once,
+          keyed by the SHA-1 of its content. A parcel that hasn't changed since last month
+          adds nothing but its place in the month's snapshot. Geometries are keyed on their
+          exact coordinates, not Geometry.Fingerprint(), so Restore() gives back the same layer.
+
+          - A snapshot is the ordered object ids of its rows (delta encoded and compressed),
+            its fields, schema and spatial reference
+          - EditDate and EditBy change every month, so they are kept in the snapshot as runs of
+            equal values instead of in the attribute rows
+          - Restore() rebuilds a snapshot into any of the Backends, checking each object
+            against its key
+          - Drop() forgets a snapshot, Collect() deletes the objects no snapshot uses any more
+            and compacts the file
+          - Stats() has the dedup ratio, the bytes of the snapshots as whole copies over the
+            bytes in the store
+
+          SelfTest() archives a year of synthetic months and restores each of them, Benchmark()
+          reports the dedup ratio and restore throughput.
+
+"""
+
+import array, datetime, hashlib, json, os, random, shutil, sqlite3, tempfile, time, zlib
+import Backends, Geometry
+from Backends import Shape
+
+## Fields kept in the snapshot as runs of equal values (see Publish.Ignore)
+Volatile = ['EditDate', 'EditBy']
+
+## Rows hashed and looked up at a time
+Batch = 5000
+
+## Keys or ids per sqlite query
+Query = 500
+
+## Object kinds - part of the key, so a geometry and a row with the same bytes stay apart
+Geometries = 0
+Attributes = 1
+
+DateFormat = '%Y-%m-%d %H:%M:%S.%f'
+
+SnapshotColumns = ['name', 'created', 'rows', 'bytes', 'fields', 'schema', 'volatile', 'runs',
+                   'spatial_reference', 'attributes', 'geometries']
+
+############################################################################################
+
+def Encode(value):
+    # json for the values json doesn't have
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.strftime(DateFormat)}
+    raise TypeError('Cannot archive %r' % (value,))
+
+def Decode(obj):
+    if '$date' in obj:
+        return datetime.datetime.strptime(obj['$date'], DateFormat)
+    return obj
+
+def PackRow(values):
+    text = json.dumps(list(values), ensure_ascii=False, separators=(',', ':'), default=Encode)
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+def UnpackRow(data):
+    return json.loads(data.decode('utf-8'), object_hook=Decode)
+
+def PackIds(ids):
+    # Delta encoded - most of a month's ids run on from the month before
+    deltas = array.array('i')
+    last = 0
+    for i in ids:
+        deltas.append(i - last)
+        last = i
+    return zlib.compress(deltas.tostring(), 6)
+
+def UnpackIds(data):
+    deltas = array.array('i')
+    deltas.fromstring(zlib.decompress(str(data)))
+    ids = []
+    last = 0
+    for delta in deltas:
+        last += delta
+        ids.append(last)
+    return ids
+
+def Key(kind, data):
+    return hashlib.sha1(chr(kind) + data).digest()
+
+def Batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+############################################################################################
+
+class Store(object):
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = unicode
+        c = self.connection
+        # id 0 is never used - it stands for a null geometry in a snapshot
+        c.execute('CREATE TABLE IF NOT EXISTS objects (id INTEGER PRIMARY KEY, key BLOB UNIQUE, kind INTEGER, '
+                  'size INTEGER, compressed INTEGER, data BLOB)')
+        c.execute('CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, created TEXT, rows INTEGER, '
+                  'bytes INTEGER, fields TEXT, schema TEXT, volatile TEXT, runs TEXT, spatial_reference TEXT, '
+                  'attributes BLOB, geometries BLOB)')
+        c.commit()
+
+    def Put(self, kind, datas):
+        # Object id of each of datas, adding the ones not stored yet.
+        # Returns (ids, objects added, bytes added).
+        keys = [Key(kind, data) for data in datas]
+        found = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), Query):
+            chunk = unique[i:i + Query]
+            for id, key in self.connection.execute('SELECT id, key FROM objects WHERE key IN (%s)' % ','.join('?' * len(chunk)),
+                                                   [sqlite3.Binary(key) for key in chunk]):
+                found[str(key)] = id
+        added = stored = 0
+        for key, data in zip(keys, datas):
+            if key in found:
+                continue
+            packed = zlib.compress(data, 6)
+            compressed = len(packed) < len(data)
+            if not compressed:
+                packed = data
+            cursor = self.connection.execute('INSERT INTO objects (key, kind, size, compressed, data) VALUES (?, ?, ?, ?, ?)',
+                                             (sqlite3.Binary(key), kind, len(data), int(compressed), sqlite3.Binary(packed)))
+            found[key] = cursor.lastrowid
+            added += 1
+            stored += len(packed)
+        return [found[key] for key in keys], added, stored
+
+    def Store(self, name, backend, table, fields, schema=None, spatialReference=None, volatile=Volatile):
+        # table (read with backend) --> snapshot name, replacing one of the same name. schema is
+        # [(name, type, length)] as CreateTable takes it, spatialReference well known text.
+        # Nothing is kept unless the whole table was read.
+        start = time.time()
+        volatile = [field for field in fields if field in volatile]
+        kept = [field for field in fields if field not in volatile]
+        attributes, geometries, runs = [], [], []
+        stats = {'snapshot': name, 'rows': 0, 'bytes': 0, 'new_objects': 0, 'new_bytes': 0}
+        try:
+            for batch in Batches(backend.Search(table, kept + volatile + [Shape]), Batch):
+                rows = [PackRow(row[:len(kept)]) for row in batch]
+                ids, added, stored = self.Put(Attributes, rows)
+                attributes.extend(ids)
+                shapes = [Geometry.Pack(backend.Rings(row[-1])) for row in batch]
+                present = [shape for shape in shapes if shape is not None]
+                ids, added2, stored2 = self.Put(Geometries, present)
+                ids = iter(ids)
+                geometries.extend(next(ids) if shape is not None else 0 for shape in shapes)
+                for row in batch:
+                    values = list(row[len(kept):-1])
+                    if runs and runs[-1][1] == values:
+                        runs[-1][0] += 1
+                    else:
+                        runs.append([1, values])
+                stats['rows'] += len(batch)
+                stats['bytes'] += sum(len(row) for row in rows) + sum(len(shape) for shape in present)
+                stats['new_objects'] += added + added2
+                stats['new_bytes'] += stored + stored2
+            self.connection.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (name, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), stats['rows'],
+                                     stats['bytes'], json.dumps(kept), json.dumps(schema), json.dumps(volatile),
+                                     json.dumps(runs, default=Encode), spatialReference,
+                                     sqlite3.Binary(PackIds(attributes)), sqlite3.Binary(PackIds(geometries))))
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        stats['seconds'] = round(time.time() - start, 3)
+        print '\tArchived %d parcels as %s: %d new objects, %.1f of %.1f MB new, %.1f s' % (
+            stats['rows'], name, stats['new_objects'], stats['new_bytes'] / 1048576.0, stats['bytes'] / 1048576.0, stats['seconds'])
+        return stats
+
+    def Snapshot(self, name):
+        row = self.connection.execute('SELECT %s FROM snapshots WHERE name = ?' % ', '.join(SnapshotColumns), (name,)).fetchone()
+        if row is None:
+            raise KeyError('No snapshot %s in %s' % (name, self.path))
+        return dict(zip(SnapshotColumns, row))
+
+    def Snapshots(self):
+        # [(name, created, rows)] oldest first
+        return self.connection.execute('SELECT name, created, rows FROM snapshots ORDER BY created, name').fetchall()
+
+    def Objects(self, ids):
+        # {id: data} for ids other than 0, each checked against its key
+        found = {}
+        unique = list(set(ids) - set([0]))
+        for i in range(0, len(unique), Query):
+            chunk = unique[i:i + Query]
+            for id, key, kind, compressed, data in self.connection.execute(
+                    'SELECT id, key, kind, compressed, data FROM objects WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk):
+                data = zlib.decompress(str(data)) if compressed else str(data)
+                if Key(kind, data) != str(key):
+                    raise ValueError('Object %d in %s is damaged' % (id, self.path))
+                found[id] = data
+        if len(found) != len(unique):
+            raise ValueError('%d objects missing from %s' % (len(unique) - len(found), self.path))
+        return found
+
+    def Rows(self, snapshot):
+        # Rows of a Snapshot() in the order of its fields + volatile fields + Shape
+        attributes = UnpackIds(snapshot['attributes'])
+        geometries = UnpackIds(snapshot['geometries'])
+        runs = json.loads(snapshot['runs'], object_hook=Decode)
+        volatile = (tuple(values) for count, values in runs for n in xrange(count))
+        for i in range(0, len(attributes), Batch):
+            rows, shapes = attributes[i:i + Batch], geometries[i:i + Batch]
+            objects = self.Objects(rows + shapes)
+            for row, shape in zip(rows, shapes):
+                yield tuple(UnpackRow(objects[row])) + next(volatile) + (Geometry.Unpack(objects[shape]) if shape else None,)
+
+    def Restore(self, name, target, table, template=None):
+        # Snapshot name --> table in target (replaced). template is the spatial reference,
+        # by default the one stored with the snapshot.
+        start = time.time()
+        snapshot = self.Snapshot(name)
+        fields = json.loads(snapshot['fields']) + json.loads(snapshot['volatile'])
+        schema = json.loads(snapshot['schema'])
+        if schema:
+            schema = [tuple(field) for field in schema]
+        else:
+            schema = [(field, 'TEXT', 255) for field in fields]
+        target.CreateTable(table, schema, template or snapshot['spatial_reference'])
+        count = target.Insert(table, fields + [Shape], self.Rows(snapshot))
+        if count != snapshot['rows']:
+            raise ValueError('Restored %d of the %d rows of %s' % (count, snapshot['rows'], name))
+        seconds = time.time() - start
+        stats = {'snapshot': name, 'rows': count, 'seconds': round(seconds, 3),
+                 'rows_per_sec': round(count / seconds, 1) if seconds else 0.0}
+        print '\tRestored %s to %s: %d parcels, %.0f rows/sec' % (name, table, count, stats['rows_per_sec'])
+        return stats
+
+    def Drop(self, name):
+        # The snapshot's objects stay until Collect()
+        dropped = self.connection.execute('DELETE FROM snapshots WHERE name = ?', (name,)).rowcount
+        self.connection.commit()
+        return dropped > 0
+
+    def Collect(self, keep=None):
+        # Drops all but the newest keep snapshots when keep is given, then deletes the objects
+        # no snapshot uses and compacts the file
+        start = time.time()
+        before = os.path.getsize(self.path)
+        dropped = []
+        if keep is not None:
+            names = [name for name, created, rows in self.Snapshots()]
+            for name in names[:max(len(names) - keep, 0)]:
+                self.Drop(name)
+                dropped.append(name)
+        c = self.connection
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS live (id INTEGER PRIMARY KEY)')
+        c.execute('DELETE FROM live')
+        for attributes, geometries in c.execute('SELECT attributes, geometries FROM snapshots').fetchall():
+            c.executemany('INSERT OR IGNORE INTO live VALUES (?)',
+                          ((i,) for i in set(UnpackIds(attributes)) | set(UnpackIds(geometries))))
+        removed = c.execute('DELETE FROM objects WHERE id NOT IN (SELECT id FROM live)').rowcount
+        c.execute('DROP TABLE live')
+        c.commit()
+        c.execute('VACUUM')
+        after = os.path.getsize(self.path)
+        stats = {'dropped': dropped, 'objects_removed': removed, 'bytes_freed': before - after,
+                 'seconds': round(time.time() - start, 3)}
+        print '\tCollected %d objects no snapshot uses (%d snapshots dropped), %.1f MB freed' % (
+            removed, len(dropped), stats['bytes_freed'] / 1048576.0)
+        return stats
+
+    def Stats(self):
+        c = self.connection
+        snapshots, rows, logical, manifests = c.execute(
+            'SELECT COUNT(*), SUM(rows), SUM(bytes), SUM(LENGTH(attributes) + LENGTH(geometries) + LENGTH(runs)) '
+            'FROM snapshots').fetchone()
+        objects, unique, stored = c.execute('SELECT COUNT(*), SUM(size), SUM(LENGTH(data)) FROM objects').fetchone()
+        logical, unique, stored, manifests = logical or 0, unique or 0, stored or 0, manifests or 0
+        return {'snapshots': snapshots, 'rows': rows or 0, 'objects': objects,
+                'logical_bytes': logical, 'unique_bytes': unique, 'stored_bytes': stored + manifests,
+                'file_bytes': os.path.getsize(self.path),
+                'dedup_ratio': round(float(logical) / (stored + manifests), 2) if stored + manifests else 0.0}
+
+    def Close(self):
+        self.connection.close()
+
+def Report(stats):
+    return ('%(snapshots)d snapshots of %(rows)d parcels in %(objects)d objects - ' % stats +
+            '%.1f MB as whole copies, %.1f MB stored, dedup ratio %.1f' % (
+                stats['logical_bytes'] / 1048576.0, stats['stored_bytes'] / 1048576.0, stats['dedup_ratio']))
+
+############################################################################################
+
+Fields = ['Parcel_ID', 'Name_Owner', 'Square_Feet', 'EditDate', 'EditBy']
+Schema = [('Parcel_ID', 'TEXT', 20), ('Name_Owner', 'TEXT', 100), ('Square_Feet', 'DOUBLE', 0),
+          ('EditDate', 'TEXT', 10), ('EditBy', 'TEXT', 20)]
+
+def Parcel(n, rng):
+    x, y = (n % 500) * 100.0, (n // 500) * 100.0
+    return {'Parcel_ID': u'P%06d' % n, 'Name_Owner': u'OWNER %d' % rng.randint(1, 1000000), 'Square_Feet': 10000.0,
+            Shape: [[(x, y), (x, y + 100), (x + 50, y + 100), (x + 100, y + 100), (x + 100, y), (x, y)]]}
+
+def Months(parcels, months, changed=0.02, seed=1):
+    # Yields (name, MemoryBackend) of each month, the parcels in its 'Parcels' table. Each
+    # month changed of them get a new owner or a moved corner, and as many again are split
+    # off or retired. Every row has the month's EditDate.
+    rng = random.Random(seed)
+    current = [Parcel(n, rng) for n in range(parcels)]
+    added = parcels
+    for month in range(1, months + 1):
+        if month > 1:
+            for i, parcel in enumerate(current):
+                roll = rng.random()
+                if roll < changed / 2:
+                    current[i] = dict(parcel, Name_Owner=u'OWNER %d' % rng.randint(1, 1000000))
+                elif roll < changed:
+                    ring = list(parcel[Shape][0])
+                    ring[2] = (ring[2][0] + rng.uniform(-5, 5), ring[2][1])
+                    current[i] = dict(parcel)
+                    current[i][Shape] = [ring]
+            for n in range(int(len(current) * changed / 2)):
+                current.pop(rng.randrange(len(current)))
+                current.append(Parcel(added, rng))
+                added += 1
+        date = u'2017%02d01' % month
+        memory = Backends.MemoryBackend()
+        memory.tables['Parcels'] = [dict(parcel, EditDate=date, EditBy=u'bkingery') for parcel in current]
+        yield date, memory
+
+def SelfTest(parcels=3000, months=12):
+    when = datetime.datetime(2017, 3, 1, 8, 30, 15, 250)
+    assert UnpackRow(PackRow([u'P1', None, 2.5, when, u'\xe9'])) == [u'P1', None, 2.5, when, u'\xe9']
+    assert UnpackIds(PackIds([5, 3, 9, 0, 10])) == [5, 3, 9, 0, 10]
+    folder = tempfile.mkdtemp()
+    try:
+        store = Store(os.path.join(folder, 'Archive', 'Archive.sqlite'))
+        signatures = {}
+        for name, memory in Months(parcels, months):
+            memory.tables['Parcels'][7][Shape] = None
+            signatures[name] = memory.Signature('Parcels', Fields)
+            stats = store.Store(name, memory, 'Parcels', Fields, Schema)
+            assert stats['rows'] == memory.Count('Parcels')
+            if name != '20170101':
+                # Only the changed parcels are new
+                assert stats['new_objects'] < parcels * 0.1, stats
+        # Storing under a name again replaces the snapshot
+        store.Store('20170101', memory, 'Parcels', Fields, Schema)
+        signatures['20170101'] = signatures[name]
+        names = [name for name, created, rows in store.Snapshots()]
+        assert len(names) == months
+        stats = store.Stats()
+        assert stats['dedup_ratio'] > months / 3.0, stats
+        restored = Backends.MemoryBackend()
+        for name in names:
+            store.Restore(name, restored, name)
+            assert restored.Signature(name, Fields) == signatures[name], name
+        sqlite = Backends.SqliteBackend(os.path.join(folder, 'Restored.sqlite'))
+        store.Restore(name, sqlite, 'Parcels')
+        assert sqlite.Signature('Parcels', Fields) == signatures[name]
+        sqlite.connection.close()
+
+        # Dropping the first half leaves the objects only they used to Collect()
+        collected = store.Collect(keep=months // 2)
+        assert len(collected['dropped']) == months - months // 2 and collected['objects_removed'] > 0
+        assert store.Stats()['objects'] == stats['objects'] - collected['objects_removed']
+        for name, created, rows in store.Snapshots():
+            store.Restore(name, restored, name)
+            assert restored.Signature(name, Fields) == signatures[name], name
+        assert store.Collect()['objects_removed'] == 0
+
+        # A damaged object is found, not restored
+        name = store.Snapshots()[-1][0]
+        damaged = UnpackIds(store.Snapshot(name)['geometries'])[0]
+        store.connection.execute('UPDATE objects SET data = ?, compressed = 0 WHERE id = ?', (sqlite3.Binary('[]'), damaged))
+        try:
+            store.Restore(name, restored, 'Damaged')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('damaged object restored')
+        store.Close()
+    finally:
+        shutil.rmtree(folder)
+    print 'Archive self test passed'
+
+def Benchmark(parcels=100000, months=12):
+    # Dedup ratio of a year of months and restore throughput of the last one into sqlite
+    folder = tempfile.mkdtemp()
+    try:
+        store = Store(os.path.join(folder, 'Archive.sqlite'))
+        start = time.time()
+        for name, memory in Months(parcels, months):
+            store.Store(name, memory, 'Parcels', Fields, Schema)
+        stored = time.time() - start
+        stats = store.Stats()
+        target = Backends.SqliteBackend(os.path.join(folder, 'Restored.sqlite'))
+        restore = store.Restore(name, target, 'Parcels')
+        target.connection.close()
+        store.Close()
+    finally:
+        shutil.rmtree(folder)
+    print Report(stats)
+    print '\tstore %.0f rows/sec, restore %.0f rows/sec' % (stats['rows'] / stored, restore['rows_per_sec'])
+    return dict(stats, store_rows_per_sec=round(stats['rows'] / stored, 1), restore_rows_per_sec=restore['rows_per_sec'])
+
+if __name__ == '__main__':
+    SelfTest()
@@ -0,0 +1,78 @@
+"""
+Name:     AssignmentCache.py
+Purpose:  Remember zip code / city assignments from month to month
+
+          Almost every parcel polygon is the same as last month, so SpatialIndex.Assign() looks
+          the parcel's geometry fingerprint (Geometry.Fingerprint) up here first and only sends
+          new or changed geometries to the spatial index.
+
+          - Everything is dropped when the reference layers' signature changes
+          - Entries not used for the longest are evicted past MaxEntries (LRU by run number)
+          - Hits and misses are counted for the run report
+
+"""
+
+import sqlite3
+
+MaxEntries = 2000000
+
+## Fingerprints per sqlite query
+Batch = 500
+
+Separator = u'\x1f'
+
+############################################################################################
+
+class AssignmentCache(object):
+
+    def __init__(self, path, signature, maxEntries=MaxEntries):
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = unicode
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        c = self.connection
+        c.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        c.execute('CREATE TABLE IF NOT EXISTS assignments (fingerprint TEXT PRIMARY KEY, value TEXT, used INTEGER)')
+        c.execute('CREATE INDEX IF NOT EXISTS assignments_used ON assignments (used)')
+        meta = dict(c.execute('SELECT name, value FROM meta'))
+        if meta.get('signature') != signature:
+            # Reference layers changed - nothing in here can be trusted
+            c.execute('DELETE FROM assignments')
+            c.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('signature', signature))
+        self.run = int(meta.get('run') or 0) + 1
+        c.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('run', str(self.run)))
+        c.commit()
+
+    def Get(self, fingerprints):
+        # {fingerprint: [value, ...]} for the fingerprints already cached
+        fingerprints = list(set(fingerprints))
+        found = {}
+        for i in range(0, len(fingerprints), Batch):
+            keys = fingerprints[i:i + Batch]
+            marks = ','.join('?' * len(keys))
+            for fingerprint, value in self.connection.execute(
+                    'SELECT fingerprint, value FROM assignments WHERE fingerprint IN (%s)' % marks, keys):
+                found[fingerprint] = [v or None for v in value.split(Separator)]
+            self.connection.execute('UPDATE assignments SET used = ? WHERE fingerprint IN (%s)' % marks, [self.run] + keys)
+        return found
+
+    def Put(self, assignments):
+        # assignments = {fingerprint: [value, ...]}
+        self.connection.executemany('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?)',
+                                    ((fingerprint, Separator.join(v or u'' for v in values), self.run)
+                                     for fingerprint, values in assignments.iteritems()))
+
+    def Close(self):
+        c = self.connection
+        count = c.execute('SELECT COUNT(*) FROM assignments').fetchone()[0]
+        if count > self.maxEntries:
+            c.execute('DELETE FROM assignments WHERE fingerprint IN '
+                      '(SELECT fingerprint FROM assignments ORDER BY used LIMIT ?)', (count - self.maxEntries,))
+        c.commit()
+        c.close()
+
+    def Stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.0}
@@ -0,0 +1,567 @@
+"""
+Name:     Backends.py
+Purpose:  Row access for the parcel update stages
+
+          ArcpyBackend reads and writes geodatabase tables through arcpy.da cursors.
+          MemoryBackend holds tables as plain lists of dicts so the same stages can be
+          run and timed without arcpy or the R: share.
+          SqliteBackend stands in for the sde target when trying out the publish step locally.
+
+          Geometry is read and written with the Shape ('SHAPE@') field. ArcpyBackend hands back
+          arcpy Polygons, the others rings as described in Geometry.py - Rings() gives rings
+          for either. OID ('OID@') and Centroid ('SHAPE@TRUECENTROID') can be read from all three.
+
+          Exists(), Drop(), Index() and Rename() are what Staging.py needs to build a table
+          offline and swap it in. SqliteBackend makes a Rename() of several tables one transaction.
+
+"""
+
+import contextlib, hashlib, os, time
+import Geometry
+
+Shape = 'SHAPE@'
+OID = 'OID@'
+Centroid = 'SHAPE@TRUECENTROID'
+
+## Keys per where clause when updating/deleting by key
+KeyBatch = 500
+
+def Quote(value):
+    return "'" + unicode(value).replace("'", "''") + "'"
+
+def KeyWhere(key, keys):
+    # Where clause matching any of keys - None matches null keys
+    where = []
+    values = [k for k in keys if k is not None]
+    if values:
+        where.append('%s IN (%s)' % (key, ','.join(Quote(k) for k in values)))
+    if len(values) < len(keys):
+        where.append('%s IS NULL' % key)
+    return ' OR '.join(where)
+
+class Writer(object):
+
+    def __init__(self, write):
+        self.write = write
+        self.count = 0
+
+    def Write(self, row):
+        self.write(row)
+        self.count += 1
+
+def IndexName(table, field):
+    # Index names stay with a table when it is renamed, so each one is made unique
+    return 'IX_' + hashlib.sha1('%s|%s|%r' % (table, field, time.time())).hexdigest()[:12]
+
+def ContentSignature(rows):
+    sha = hashlib.sha256()
+    for row in rows:
+        sha.update(repr(row))
+    return sha.hexdigest()
+
+############################################################################################
+
+class ArcpyBackend(object):
+
+    def __init__(self, workspace=None):
+        # workspace is only needed for Edit() - the gdb or sde connection being edited, for a
+        # versioned table a connection to the version the cursors write to
+        import arcpy
+        self.arcpy = arcpy
+        self.workspace = workspace
+
+    def Rings(self, shape):
+        if shape is None or isinstance(shape, list):
+            # Already rings (read from a Columnar file)
+            return shape
+        rings = []
+        for part in shape:
+            ring = []
+            for point in part:
+                if point is None:
+                    # Interior ring follows
+                    if ring:
+                        rings.append(ring)
+                    ring = []
+                else:
+                    ring.append((point.X, point.Y))
+            if ring:
+                rings.append(ring)
+        return rings
+
+    def Center(self, shape):
+        if shape is None:
+            return None
+        if isinstance(shape, list):
+            return Geometry.Centroid(shape)
+        point = shape.trueCentroid
+        return (point.X, point.Y)
+
+    def Areas(self, shape, wkt=None):
+        # (square feet, acres) the same as !shape.area@SQUAREFEET! / !shape.area@ACRES! - the
+        # geometry is only measured once, an acre being 43560 of the same square feet. wkt is
+        # the spatial reference of shapes that are already rings.
+        if shape is None:
+            return (None, None)
+        if isinstance(shape, list):
+            return Geometry.RingAreas(shape, wkt)
+        sqft = shape.getArea('PLANAR', 'SQUAREFEET')
+        return (sqft, sqft / Geometry.SquareFeetPerAcre)
+
+    def Project(self, rings, fromWkt, toWkt):
+        # Rings in fromWkt --> rings in toWkt, as an insert cursor projects a Polygon
+        references = self.__dict__.setdefault('references', {})
+        for wkt in (fromWkt, toWkt):
+            if wkt not in references:
+                references[wkt] = self.SpatialReference(wkt)
+        return self.Rings(self.Polygon(rings, references[fromWkt]).projectAs(references[toWkt]))
+
+    def Polygon(self, rings, spatialReference):
+        arcpy = self.arcpy
+        parts = arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in ring]) for ring in rings])
+        return arcpy.Polygon(parts, spatialReference)
+
+    def Search(self, table, fields, where=None, spatialReference=None):
+        # spatialReference (anything SpatialReference() takes) projects the shapes read
+        if spatialReference is not None:
+            spatialReference = self.SpatialReference(spatialReference)
+        with self.arcpy.da.SearchCursor(table, fields, where, spatialReference) as cursor:
+            for row in cursor:
+                yield row
+
+    def Count(self, table):
+        return int(self.arcpy.GetCount_management(table).getOutput(0))
+
+    def Signature(self, table, fields=[]):
+        # Changes when the table does - row count, extent and the files of its geodatabase
+        # (cheaper than reading every row of the static reference layers)
+        describe = self.arcpy.Describe(table)
+        sha = hashlib.sha256()
+        sha.update(repr((describe.catalogPath, self.Count(table), str(describe.extent), list(fields))))
+        workspace = os.path.dirname(describe.catalogPath)
+        while workspace and not os.path.isdir(workspace):
+            workspace = os.path.dirname(workspace)
+        if workspace:
+            for name in sorted(os.listdir(workspace)):
+                if not name.endswith('.lock'):
+                    stat = os.stat(os.path.join(workspace, name))
+                    sha.update(repr((name, stat.st_size, int(stat.st_mtime))))
+        return sha.hexdigest()
+
+    def SpatialReference(self, template):
+        # arcpy.SpatialReference from a dataset path, well known text or a SpatialReference
+        arcpy = self.arcpy
+        if not isinstance(template, basestring):
+            return template
+        if template.startswith(('PROJCS[', 'GEOGCS[')):
+            spatialReference = arcpy.SpatialReference()
+            spatialReference.loadFromString(template)
+            return spatialReference
+        return arcpy.Describe(template).spatialReference
+
+    def CreateTable(self, table, schema, template=None):
+        # schema = [(name, type, length)]. template supplies the spatial reference - anything
+        # SpatialReference() takes.
+        arcpy = self.arcpy
+        spatialReference = self.SpatialReference(template)
+        if arcpy.Exists(table):
+            arcpy.Delete_management(table)
+        arcpy.CreateFeatureclass_management(os.path.dirname(table), os.path.basename(table), 'POLYGON',
+                                            spatial_reference=spatialReference)
+        for name, fieldType, length in schema:
+            arcpy.AddField_management(table, name, fieldType, "", "", length)
+
+    def Schema(self, table, fields):
+        # [(name, type, length)] of fields in table, in the form CreateTable takes
+        types = {'String': 'TEXT', 'Double': 'DOUBLE', 'Single': 'FLOAT', 'Integer': 'LONG',
+                 'SmallInteger': 'SHORT', 'Date': 'DATE', 'GUID': 'GUID'}
+        found = dict((field.name.upper(), field) for field in self.arcpy.ListFields(table))
+        return [(name, types.get(found[name.upper()].type, 'TEXT'), found[name.upper()].length) for name in fields]
+
+    def Native(self, table, fields):
+        # Returns a function turning rows with rings (from the other backends) into arcpy rows
+        if Shape not in fields:
+            return lambda row: row
+        shapeIndex = fields.index(Shape)
+        spatialReference = self.arcpy.Describe(table).spatialReference
+        def Convert(row):
+            if isinstance(row[shapeIndex], list):
+                row = list(row)
+                row[shapeIndex] = self.Polygon(row[shapeIndex], spatialReference)
+            return row
+        return Convert
+
+    @contextlib.contextmanager
+    def Writer(self, table, fields):
+        # Open insert stream - writer.Write(row) for each row
+        native = self.Native(table, fields)
+        with self.arcpy.da.InsertCursor(table, fields) as cursor:
+            yield Writer(lambda row: cursor.insertRow(native(row)))
+
+    def Insert(self, table, fields, rows):
+        with self.Writer(table, fields) as writer:
+            for row in rows:
+                writer.Write(row)
+        return writer.count
+
+    def UpdateRows(self, table, fields, func, where=None):
+        # One read/write pass - func gets the row as a list in the order of fields
+        count = 0
+        with self.arcpy.da.UpdateCursor(table, fields, where) as cursor:
+            for row in cursor:
+                cursor.updateRow(func(row))
+                count += 1
+        return count
+
+    def UpdateByKey(self, table, key, fields, rows):
+        # rows = {key value: row in the order of fields}. The key field must be in fields.
+        keys = list(rows)
+        native = self.Native(table, fields)
+        keyIndex = fields.index(key)
+        count = 0
+        for i in range(0, len(keys), KeyBatch):
+            where = KeyWhere(key, keys[i:i + KeyBatch])
+            count += self.UpdateRows(table, fields, lambda row: native(rows[row[keyIndex]]), where)
+        return count
+
+    def DeleteByKey(self, table, key, keys):
+        keys = list(keys)
+        count = 0
+        for i in range(0, len(keys), KeyBatch):
+            with self.arcpy.da.UpdateCursor(table, [key], KeyWhere(key, keys[i:i + KeyBatch])) as cursor:
+                for row in cursor:
+                    cursor.deleteRow()
+                    count += 1
+        return count
+
+    def Exists(self, table):
+        return self.arcpy.Exists(table)
+
+    def Drop(self, table):
+        if self.arcpy.Exists(table):
+            self.arcpy.Delete_management(table)
+
+    def Index(self, table, fields):
+        # Spatial index and an attribute index on each of fields
+        self.arcpy.AddSpatialIndex_management(table)
+        for field in fields:
+            self.arcpy.AddIndex_management(table, field, IndexName(table, field))
+
+    def Rename(self, pairs):
+        # [(table, new name)] in order - one Rename_management each, so not atomic here
+        for table, name in pairs:
+            self.arcpy.Rename_management(table, name)
+
+    def ConnectVersion(self, sde, version, path):
+        # Copy of the sde connection file pointed at version (TRANSACTIONAL) - the workspace to
+        # Edit() a version through, the .sde file itself being on DEFAULT
+        arcpy = self.arcpy
+        props = arcpy.Describe(sde).connectionProperties
+        if arcpy.Exists(path):
+            arcpy.Delete_management(path)
+        arcpy.CreateDatabaseConnection_management(os.path.dirname(path), os.path.basename(path), 'SQL_SERVER',
+                                                  props.instance.split(':')[-1], 'OPERATING_SYSTEM_AUTH',
+                                                  database=props.database, version_type='TRANSACTIONAL', version=version)
+        return path
+
+    @contextlib.contextmanager
+    def Edit(self):
+        # Versioned edit session on self.workspace - call Operation() around each batch
+        editor = self.arcpy.da.Editor(self.workspace)
+        editor.startEditing(False, True)
+        self.editor = editor
+        try:
+            yield self
+            editor.stopEditing(True)
+        except:
+            if editor.isEditing:
+                editor.stopEditing(False)
+            raise
+        finally:
+            self.editor = None
+
+    @contextlib.contextmanager
+    def Operation(self):
+        editor = getattr(self, 'editor', None)
+        if editor is None:
+            yield
+            return
+        editor.startOperation()
+        try:
+            yield
+            editor.stopOperation()
+        except:
+            editor.abortOperation()
+            raise
+
+class MemoryBackend(object):
+
+    def __init__(self, tables=None):
+        # {table name: [{field: value}, ...]}
+        self.tables = tables if tables is not None else {}
+
+    def Rings(self, shape):
+        return shape
+
+    def Center(self, shape):
+        return Geometry.Centroid(shape)
+
+    def Areas(self, shape, wkt=None):
+        # wkt is the spatial reference of the coordinates, None for feet
+        if shape is None:
+            return (None, None)
+        return Geometry.RingAreas(shape, wkt)
+
+    def Value(self, record, field, oid):
+        if field == OID:
+            return oid
+        if field == Centroid:
+            return Geometry.Centroid(record.get(Shape))
+        return record.get(field)
+
+    def Search(self, table, fields, where=None):
+        # where is a function of the record dict here. OIDs are list positions from 1.
+        for oid, record in enumerate(self.tables[table], 1):
+            if where is None or where(record):
+                yield tuple(self.Value(record, field, oid) for field in fields)
+
+    def Count(self, table):
+        return len(self.tables[table])
+
+    def Signature(self, table, fields=[]):
+        return ContentSignature(self.Search(table, list(fields) + [Shape]))
+
+    def CreateTable(self, table, schema, template=None):
+        self.tables[table] = []
+
+    @contextlib.contextmanager
+    def Writer(self, table, fields):
+        records = self.tables.setdefault(table, [])
+        yield Writer(lambda row: records.append(dict(zip(fields, row))))
+
+    def Insert(self, table, fields, rows):
+        with self.Writer(table, fields) as writer:
+            for row in rows:
+                writer.Write(row)
+        return writer.count
+
+    def UpdateRows(self, table, fields, func, where=None):
+        count = 0
+        for oid, record in enumerate(self.tables[table], 1):
+            if where is not None and not where(record):
+                continue
+            row = func([self.Value(record, field, oid) for field in fields])
+            for field, value in zip(fields, row):
+                if field not in (OID, Centroid):
+                    record[field] = value
+            count += 1
+        return count
+
+    def UpdateByKey(self, table, key, fields, rows):
+        return self.UpdateRows(table, fields, lambda row: rows[row[fields.index(key)]],
+                               lambda record: record.get(key) in rows)
+
+    def DeleteByKey(self, table, key, keys):
+        keys = set(keys)
+        records = self.tables[table]
+        kept = [record for record in records if record.get(key) not in keys]
+        self.tables[table] = kept
+        return len(records) - len(kept)
+
+    def Exists(self, table):
+        return table in self.tables
+
+    def Drop(self, table):
+        self.tables.pop(table, None)
+
+    def Index(self, table, fields):
+        pass
+
+    def Rename(self, pairs):
+        for table, name in pairs:
+            self.tables[name] = self.tables.pop(table)
+
+    @contextlib.contextmanager
+    def Edit(self):
+        yield self
+
+    @contextlib.contextmanager
+    def Operation(self):
+        yield
+
+class SqliteBackend(object):
+    # One sqlite file standing in for the sde geodatabase. Geometry is stored packed
+    # (Geometry.Pack) in a SHAPE column.
+
+    # Rename() of several tables is one transaction
+    AtomicRename = True
+
+    Types = {'TEXT': 'TEXT', 'DOUBLE': 'REAL', 'LONG': 'INTEGER', 'SHORT': 'INTEGER', 'DATE': 'TEXT'}
+
+    def __init__(self, path):
+        import sqlite3
+        self.sqlite3 = sqlite3
+        # Transactions are handled here (Transaction/Edit/Operation), not by the sqlite3 module
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.text_factory = unicode
+        self.editing = False
+        self.depth = 0
+
+    def Column(self, field):
+        return {Shape: 'SHAPE', OID: 'OBJECTID', Centroid: 'SHAPE'}.get(field, field)
+
+    def Columns(self, fields):
+        return ', '.join('"%s"' % self.Column(field) for field in fields)
+
+    def Rings(self, shape):
+        return shape
+
+    def Center(self, shape):
+        return Geometry.Centroid(shape)
+
+    def Areas(self, shape, wkt=None):
+        # wkt is the spatial reference of the coordinates, None for feet
+        if shape is None:
+            return (None, None)
+        return Geometry.RingAreas(shape, wkt)
+
+    def Search(self, table, fields, where=None):
+        sql = 'SELECT %s FROM "%s"' % (self.Columns(fields), table)
+        if where:
+            sql += ' WHERE ' + where
+        shapes = [i for i, field in enumerate(fields) if field in (Shape, Centroid)]
+        for row in self.connection.execute(sql):
+            if shapes:
+                row = list(row)
+                for i in shapes:
+                    row[i] = Geometry.Unpack(row[i])
+                    if fields[i] == Centroid:
+                        row[i] = Geometry.Centroid(row[i])
+                row = tuple(row)
+            yield row
+
+    def Count(self, table):
+        return self.connection.execute('SELECT COUNT(*) FROM "%s"' % table).fetchone()[0]
+
+    def Signature(self, table, fields=[]):
+        return ContentSignature(self.Search(table, list(fields) + [Shape]))
+
+    def CreateTable(self, table, schema, template=None):
+        columns = ['OBJECTID INTEGER PRIMARY KEY', 'SHAPE BLOB']
+        columns += ['"%s" %s' % (name, self.Types[fieldType]) for name, fieldType, length in schema]
+        with self.Transaction():
+            self.Drop(table)
+            self.connection.execute('CREATE TABLE "%s" (%s)' % (table, ', '.join(columns)))
+
+    def Exists(self, table):
+        return self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                       (table,)).fetchone() is not None
+
+    def Drop(self, table):
+        # The table and its R*Tree spatial index
+        with self.Transaction():
+            self.connection.execute('DROP TABLE IF EXISTS "%s"' % table)
+            self.connection.execute('DROP TABLE IF EXISTS "%s_rtree"' % table)
+
+    def Index(self, table, fields):
+        # R*Tree of the shape extents in <table>_rtree (the GeoPackage layout) and an index on
+        # each of fields
+        with self.Transaction():
+            self.connection.execute('DROP TABLE IF EXISTS "%s_rtree"' % table)
+            self.connection.execute('CREATE VIRTUAL TABLE "%s_rtree" USING rtree(id, minx, maxx, miny, maxy)' % table)
+            bounds = []
+            for oid, shape in self.Search(table, ['OBJECTID', Shape]):
+                points = [point for ring in shape or [] for point in ring]
+                if points:
+                    xs = [x for x, y in points]
+                    ys = [y for x, y in points]
+                    bounds.append((oid, min(xs), max(xs), min(ys), max(ys)))
+            self.connection.executemany('INSERT INTO "%s_rtree" VALUES (?, ?, ?, ?, ?)' % table, bounds)
+            for field in fields:
+                self.connection.execute('CREATE INDEX "%s" ON "%s" ("%s")' % (IndexName(table, field), table, field))
+
+    def Rename(self, pairs):
+        # [(table, new name)] in order, in one transaction - another connection sees all of
+        # them or none
+        with self.Transaction():
+            for table, name in pairs:
+                self.connection.execute('ALTER TABLE "%s" RENAME TO "%s"' % (table, name))
+                if self.Exists(table + '_rtree'):
+                    self.connection.execute('ALTER TABLE "%s_rtree" RENAME TO "%s_rtree"' % (table, name))
+
+    def Pack(self, fields, row):
+        if Shape in fields:
+            row = list(row)
+            index = fields.index(Shape)
+            if row[index] is not None:
+                row[index] = self.sqlite3.Binary(Geometry.Pack(row[index]))
+        return row
+
+    @contextlib.contextmanager
+    def Writer(self, table, fields):
+        sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (table, self.Columns(fields), ', '.join('?' * len(fields)))
+        with self.Transaction():
+            yield Writer(lambda row: self.connection.execute(sql, self.Pack(fields, row)))
+
+    def Insert(self, table, fields, rows):
+        sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (table, self.Columns(fields), ', '.join('?' * len(fields)))
+        with self.Transaction():
+            cursor = self.connection.executemany(sql, (self.Pack(fields, row) for row in rows))
+        return cursor.rowcount
+
+    def UpdateRows(self, table, fields, func, where=None):
+        rows = [(row[0], func(list(row[1:]))) for row in self.Search(table, ['OBJECTID'] + fields, where)]
+        written = [i for i, field in enumerate(fields) if field not in (OID, Centroid)]
+        sql = 'UPDATE "%s" SET %s WHERE OBJECTID = ?' % (table, ', '.join('"%s" = ?' % self.Column(fields[i]) for i in written))
+        with self.Transaction():
+            self.connection.executemany(sql, ([self.Pack(fields, row)[i] for i in written] + [oid] for oid, row in rows))
+        return len(rows)
+
+    def UpdateByKey(self, table, key, fields, rows):
+        sql = 'UPDATE "%s" SET %s WHERE "%s" IS ?' % (table, ', '.join('"%s" = ?' % self.Column(f) for f in fields), key)
+        with self.Transaction():
+            cursor = self.connection.executemany(sql, (list(self.Pack(fields, row)) + [k] for k, row in rows.items()))
+        return cursor.rowcount
+
+    def DeleteByKey(self, table, key, keys):
+        with self.Transaction():
+            cursor = self.connection.executemany('DELETE FROM "%s" WHERE "%s" IS ?' % (table, key), ([k] for k in keys))
+        return cursor.rowcount
+
+    @contextlib.contextmanager
+    def Transaction(self):
+        # Each write is its own transaction unless it is part of an Edit() or another write
+        if self.editing or self.depth:
+            yield
+            return
+        self.connection.execute('BEGIN')
+        self.depth += 1
+        try:
+            yield
+            self.depth -= 1
+            self.connection.execute('COMMIT')
+        except:
+            self.depth -= 1
+            self.connection.execute('ROLLBACK')
+            raise
+
+    @contextlib.contextmanager
+    def Edit(self):
+        with self.Transaction():
+            self.editing = True
+            try:
+                yield self
+            finally:
+                self.editing = False
+
+    @contextlib.contextmanager
+    def Operation(self):
+        # An edit operation is a savepoint inside the edit session transaction
+        self.connection.execute('SAVEPOINT operation')
+        try:
+            yield
+            self.connection.execute('RELEASE SAVEPOINT operation')
+        except:
+            self.connection.execute('ROLLBACK TO SAVEPOINT operation')
+            self.connection.execute('RELEASE SAVEPOINT operation')
+            raise
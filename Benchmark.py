@@ -0,0 +1,295 @@
+"""
+Name:     Benchmark.py
+Purpose:  Time the parcel update stages on synthetic jurisdictions - no R:\ share, county
+          data or arcpy license needed
+
+          Synthetic()   - a source table for each jurisdiction with its real field names (WB PID/LUCat,
+                          YC GPIN/LOCADDR/OWNERSNAME, POQ MAP_PIN/STRTNUMB/NUMBSUFX, ...) plus
+                          filler fields, and polygons of 5 to 60 vertices, over zip code and city grids
+          Run()         - FieldCalc() (FieldMap.Normalize), merge, zip code / city assignment and
+                          AlterFields() (address, area and final mapping) against any backend
+          History       - wall time, rows/sec and peak RSS of every stage appended to a JSON file
+          Compare()     - last run against the one before it with the same backend, stage by stage
+          SelfTest()    - a small run on each backend, checking they are kept apart in History
+
+          Backends.MemoryBackend is the default pure Python stand-in for arcpy. Pass
+          Backends.SqliteBackend(path) or Backends.ArcpyBackend() (with table names in a
+          scratch gdb via prefix) to time those instead. columnar=True normalizes to Columnar
+          files in a temp folder and merges from them, as MonthlyParcelUpdate does.
+
+          python Benchmark.py 100000 [--columnar]
+
+          Startup() times the Parcels.py commands that must not load arcpy or NumPy (--help,
+          report, the --dry-run plans) in fresh processes, against StartupBudget.
+
+"""
+
+import datetime, json, math, os, random, shutil, subprocess, sys, tempfile, time
+import Backends, Columnar, FieldMap, Instrument, Pipeline, SpatialIndex
+from Backends import Shape
+
+History = 'BenchmarkHistory.json'
+
+## Seconds Parcels.py may take to answer --help, report and the dry runs
+StartupBudget = 0.2
+
+## Modules those commands must not import
+Heavy = ['arcpy', 'numpy']
+
+StartupCommands = [['--help'], ['report'], ['start', '--dry-run'], ['normalize', '--dry-run'], ['finish', '--dry-run']]
+
+## Share of the parcels in each jurisdiction, roughly the real counts
+Shares = [('NN', 0.36), ('HAM', 0.30), ('YC', 0.16), ('JCC', 0.11), ('NKC', 0.04), ('POQ', 0.02), ('WB', 0.01)]
+
+## Fields the real sources carry that the mapping never reads
+ExtraFields = {'WB': 10, 'YC': 40, 'POQ': 25, 'NN': 60, 'JCC': 30, 'HAM': 35, 'NKC': 45}
+
+## Field types that are not TEXT in the real sources
+NumberFields = {'STRTNUMB': 'LONG', 'HouseNo': 'DOUBLE'}
+
+Streets = ['WARWICK BLVD', 'JEFFERSON AVE', 'MAIN ST', 'HAMPTON RD', 'MERCURY BLVD', 'RICHMOND RD',
+           'GEORGE WASHINGTON MEM HWY', 'VICTORY BLVD', 'KILN CREEK PKWY', 'POCAHONTAS TRL']
+Names = ['SMITH JOHN', 'JONES MARY', 'CITY OF NEWPORT NEWS', 'WILLIAMS ROBERT & LINDA', 'BROWN LLC']
+
+############################################################################################
+
+def Value(field, rng, i):
+    # Plausible value for a source field, going by its name
+    if field in ('PID', 'GPIN', 'MAP_PIN', 'REISID', 'PIN', 'LRSNTXT'):
+        return '%08d' % i
+    if field in ('LOCADDR', 'SITUS', 'REM_PRCL_LOCN'):
+        house = rng.choice(['%d' % rng.randint(1, 9999)] * 8 + ['0%d' % rng.randint(1, 99), ''])
+        return (house + ' ' + rng.choice(Streets)).strip()
+    if field == 'STRTNUMB':
+        return rng.randint(1, 9999)
+    if field == 'HouseNo':
+        return float(rng.randint(1, 9999))
+    if field in ('NUMBSUFX', 'Apt'):
+        return rng.choice(['', '', '', 'A', 'B'])
+    if field in ('STRTNAME', 'Street'):
+        return rng.choice(Streets)
+    if field in ('OWNERSNAME', 'OWNRNAME', 'OwnerNam', 'REM_OWN_NAME'):
+        return rng.choice(Names)
+    return 'LOT %d SEC %d' % (rng.randint(1, 300), rng.randint(1, 20))
+
+def Polygon(rng, x, y, radius):
+    # Clockwise ring of 5 to 60 vertices, most parcels near the low end
+    count = min(60, 4 + int(rng.expovariate(1 / 8.0)))
+    step = 2 * math.pi / count
+    ring = [(x + radius * math.cos(-k * step) * rng.uniform(0.8, 1.0),
+             y + radius * math.sin(-k * step) * rng.uniform(0.8, 1.0)) for k in range(count)]
+    return [ring + ring[:1]]
+
+def Synthetic(backend, parcels=100000, zones=(300, 40), side=300000.0, seed=1, prefix=''):
+    # Creates ZipCode, City and one source table per jurisdiction. Returns {key: table}.
+    rng = random.Random(seed)
+    for name, count, label in (('ZipCode', zones[0], 'ZCTA5CE10'), ('City', zones[1], 'NAMELSAD')):
+        per = int(math.sqrt(count))
+        size = side / per
+        backend.CreateTable(prefix + name, [(label, 'TEXT', 100)])
+        backend.Insert(prefix + name, [label, Shape], (['%s%d' % (name, i), SpatialIndex.Square((i % per) * size, (i // per) * size, size)]
+                                                      for i in range(per * per)))
+    sources = {}
+    first = 0
+    for key, share in Shares:
+        count = max(1, int(parcels * share))
+        fields = FieldMap.SourceFields(FieldMap.FieldMaps[key])
+        schema = [(field, NumberFields.get(field, 'TEXT'), 50) for field in fields]
+        schema += [('%s_EXTRA_%d' % (key, i), 'TEXT', 50) for i in range(ExtraFields[key])]
+        names = [name for name, fieldType, length in schema] + [Shape]
+        filler = ['x' * 12] * ExtraFields[key]
+        table = prefix + key + '_Source'
+        backend.CreateTable(table, schema)
+        backend.Insert(table, names, ([Value(field, rng, first + i) for field in fields] + filler +
+                                      [Polygon(rng, rng.uniform(100, side - 100), rng.uniform(100, side - 100), 40.0)]
+                                      for i in range(count)))
+        sources[key] = table
+        first += count
+    return sources
+
+############################################################################################
+
+class Stages(object):
+    # with stages.Time('merge') as stage: ... stage['rows'] = n
+
+    def __init__(self):
+        self.stages = []
+
+    def Time(self, name):
+        return Stage(self, name)
+
+class Stage(object):
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.record = {'stage': name, 'rows': 0}
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.record
+
+    def __exit__(self, kind, value, traceback):
+        seconds = time.time() - self.start
+        self.record['seconds'] = round(seconds, 3)
+        self.record['rows_per_sec'] = round(self.record['rows'] / seconds, 1) if seconds else 0.0
+        self.record['peak_rss_mb'] = Instrument.PeakRSS()
+        self.stages.stages.append(self.record)
+        print '\t%-10s %8d rows %8.2f s %10.0f rows/sec' % (self.record['stage'], self.record['rows'], seconds,
+                                                            self.record['rows_per_sec'])
+
+def Version():
+    # git commit of this checkout, if there is one
+    try:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=folder,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except Exception:
+        return None
+
+############################################################################################
+
+def Run(parcels=100000, backend=None, history=History, seed=1, prefix='', columnar=False):
+    # All stages on synthetic data, appended to history. Returns the run record.
+    if backend is None:
+        backend = Backends.MemoryBackend()
+    label = backend.__class__.__name__ + ('+Columnar' if columnar else '')
+    print 'Benchmark: %d parcels on %s' % (parcels, label)
+    stages = Stages()
+    folder = tempfile.mkdtemp() if columnar else None
+    files = Columnar.ColumnarBackend(backend)
+
+    with stages.Time('generate') as stage:
+        sources = Synthetic(backend, parcels, seed=seed, prefix=prefix)
+        stage['rows'] = sum(backend.Count(table) for table in sources.values())
+
+    with stages.Time('normalize') as stage:
+        normalized = []
+        for key, share in Shares:
+            if columnar:
+                table = os.path.join(folder, key + Columnar.Extension)
+                FieldMap.Normalize(sources[key], table, key, FieldMap.TempSchema, files, reader=backend)
+            else:
+                table = prefix + key
+                FieldMap.Normalize(sources[key], table, key, FieldMap.TempSchema, backend)
+            normalized.append(table)
+        stage['rows'] = sum((files if columnar else backend).Count(table) for table in normalized)
+        files.Close()
+
+    tempFields = [field for field, fieldType, length in FieldMap.TempSchema]
+    master = prefix + 'Master_Parcels'
+    with stages.Time('merge') as stage:
+        dedup = Pipeline.Dedup(tags=dict(zip(normalized, [key for key, share in Shares])))
+        stage['rows'] = Pipeline.Write(backend, Pipeline.Merge(backend, normalized, tempFields, dedup), master,
+                                       FieldMap.TempSchema, Pipeline.Template(normalized))
+        stage['duplicates'] = dedup.duplicates
+    if folder:
+        shutil.rmtree(folder)
+
+    with stages.Time('assign') as stage:
+        zips = SpatialIndex.Build(backend, prefix + 'ZipCode', 'ZCTA5CE10')
+        cities = SpatialIndex.Build(backend, prefix + 'City', 'NAMELSAD')
+        stage['rows'] = SpatialIndex.Assign(backend, master, [('_Zip_Code_', zips), ('_City_Loc_', cities)])
+
+    with stages.Time('alter') as stage:
+        rows = Pipeline.Merge(backend, [master], tempFields)
+        rows = Pipeline.Areas(backend, rows, 'Square_Feet', 'Acres_US')
+        rows = Pipeline.Addresses(rows, '_HouseNumber_', '_Street_')
+        rows = Pipeline.Map(rows, FieldMap.FinalMap)
+        stage['rows'] = Pipeline.Write(backend, rows, prefix + 'RealPropertyParcel', FieldMap.FinalSchema, master)
+
+    record = {'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'version': Version(),
+              'python': sys.version.split()[0],
+              'backend': label,
+              'parcels': parcels,
+              'seconds': round(sum(stage['seconds'] for stage in stages.stages), 3),
+              'stages': stages.stages}
+    if history:
+        runs = Load(history)
+        runs.append(record)
+        with open(history + '.tmp', 'w') as f:
+            json.dump(runs, f, indent=1)
+        if os.path.exists(history):
+            os.remove(history)
+        os.rename(history + '.tmp', history)
+        Compare(history)
+    return record
+
+def Startup(runs=5, budget=StartupBudget):
+    # Best of runs for each command in a new interpreter. True if all are within budget and
+    # none of them imported a Heavy module.
+    folder = os.path.dirname(os.path.abspath(__file__))
+    code = ('import sys, Parcels\n'
+            'try:\n'
+            '    status = Parcels.Main(sys.argv[1:])\n'
+            'except SystemExit as e:\n'
+            '    status = e.code\n'
+            'sys.stderr.write(",".join(name for name in %r if name in sys.modules))\n'
+            'sys.exit(status)\n' % Heavy)
+    passed = True
+    devnull = open(os.devnull, 'w')
+    for command in StartupCommands:
+        times = []
+        for run in range(runs):
+            start = time.time()
+            child = subprocess.Popen([sys.executable, '-c', code] + command, cwd=folder,
+                                     stdout=devnull, stderr=subprocess.PIPE)
+            heavy = child.communicate()[1].strip().splitlines()[-1:] or ['']
+            times.append(time.time() - start)
+        best = min(times)
+        ok = best <= budget and not heavy[0]
+        passed = passed and ok
+        print '\t%-22s %6.0f ms  %s%s' % (' '.join(command), best * 1000, 'ok' if ok else 'SLOW' if best > budget else 'HEAVY',
+                                         '  imported ' + heavy[0] if heavy[0] else '')
+    devnull.close()
+    print 'Startup %s (budget %.0f ms)' % ('ok' if passed else 'over budget', budget * 1000)
+    return passed
+
+def Load(history=History):
+    if not os.path.exists(history):
+        return []
+    with open(history) as f:
+        return json.load(f)
+
+def Compare(history=History):
+    # Rows/sec of the last run against the previous run with the same backend and size
+    runs = Load(history)
+    if not runs:
+        return None
+    last = runs[-1]
+    before = [run for run in runs[:-1] if run['backend'] == last['backend'] and run['parcels'] == last['parcels']]
+    if not before:
+        print 'No earlier %s run of %d parcels to compare with' % (last['backend'], last['parcels'])
+        return None
+    previous = dict((stage['stage'], stage) for stage in before[-1]['stages'])
+    changes = {}
+    print 'Against %s (%s):' % (before[-1]['date'], before[-1]['version'])
+    for stage in last['stages']:
+        old = previous.get(stage['stage'])
+        if not old or not old['rows_per_sec']:
+            continue
+        change = (stage['rows_per_sec'] - old['rows_per_sec']) / old['rows_per_sec'] * 100.0
+        changes[stage['stage']] = change
+        print '\t%-10s %+6.1f%% rows/sec%s' % (stage['stage'], change, '   <-- slower' if change < -10.0 else '')
+    return changes
+
+def SelfTest(parcels=2000):
+    # Each backend's runs are saved under its own name, so Compare() only matches like with like
+    folder = tempfile.mkdtemp()
+    try:
+        history = os.path.join(folder, History)
+        backends = [(Backends.MemoryBackend(), False, 'MemoryBackend'),
+                    (Backends.SqliteBackend(os.path.join(folder, 'Benchmark.sqlite')), False, 'SqliteBackend'),
+                    (Backends.MemoryBackend(), True, 'MemoryBackend+Columnar')]
+        for backend, columnar, label in backends:
+            assert Run(parcels, backend, history, columnar=columnar)['backend'] == label
+        assert [run['backend'] for run in Load(history)] == [label for backend, columnar, label in backends]
+        assert Compare(history) is None
+        Run(parcels, Backends.MemoryBackend(), history, columnar=True)
+        assert Compare(history) is not None
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print 'Benchmark self test passed'
+
+if __name__ == '__main__':
+    Run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, columnar='--columnar' in sys.argv)
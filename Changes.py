@@ -0,0 +1,259 @@
+"""
+Name:     Changes.py
+Purpose:  What changed in the parcels since last month
+
+          Detect() compares two generations of RealPropertyParcel, normally the
+          OLD_RealPropertyParcel_<date> backup UpdateData() takes of sde against the new one.
+          Each parcel is classified as
+
+          - added / retired       only in the new / old generation
+          - renamed               a new Parcel_ID on a retired parcel's geometry
+          - geometry              same Parcel_ID, different polygon (Geometry.Fingerprint)
+          - owner                 Name_Owner changed
+          - address               HouseNumber, Street or Zip_Code changed
+
+          A parcel can have more than one of these (renamed;owner). The old generation is
+          indexed by Parcel_ID with one small entry per parcel - fingerprint, jurisdiction,
+          owner and address, no geometry - and the new one is streamed past it, each change
+          written to the changes file as it is found. Only the IDs left over on both sides
+          are indexed by fingerprint to find the renames. Parcels without an ID are only
+          matched by geometry. A Parcel_ID repeated in a generation is matched to the entry
+          from the same jurisdiction and geometry first.
+
+          Summary() is the per-jurisdiction table for the email. Benchmark() times Detect()
+          over a service area sized pair of generations.
+
+"""
+
+import csv, os, random, shutil, tempfile, time
+import Backends, Geometry, Publish
+from Backends import Shape
+
+Key = 'Parcel_ID'
+Source = 'Info_Source'
+Owner = 'Name_Owner'
+Address = ['HouseNumber', 'Street', 'Zip_Code']
+
+Kinds = ['added', 'retired', 'renamed', 'geometry', 'owner', 'address']
+
+Columns = ['Change', 'Info_Source', 'Parcel_ID', 'Old_Parcel_ID', 'Old_Name_Owner', 'Name_Owner', 'Old_Address', 'Address']
+
+## Hex digits of Geometry.Fingerprint() kept per parcel
+FingerprintLength = 16
+
+Separator = u'\x1f'
+
+############################################################################################
+
+def Entry(backend, row):
+    # (fingerprint, jurisdiction, owner, address) of a [Key, Source, Owner] + Address + [Shape]
+    # row - fingerprint None without a geometry
+    rings = backend.Rings(row[-1])
+    fingerprint = Geometry.Fingerprint(rings)[:FingerprintLength] if rings else None
+    return (fingerprint, Publish.Value(row[1]), Publish.Value(row[2]),
+            Separator.join(Publish.Value(value) for value in row[3:-1]))
+
+def Fields():
+    return [Key, Source, Owner] + Address + [Shape]
+
+def Index(backend, table):
+    # {Parcel_ID: [entry, ...]} - more than one when a Parcel_ID is repeated
+    index = {}
+    for row in backend.Search(table, Fields()):
+        index.setdefault(Publish.Value(row[0]), []).append(Entry(backend, row))
+    return index
+
+def Pick(entries, entry):
+    # The old entry a new parcel with the same Parcel_ID is compared with
+    for match in (lambda e: e[1] == entry[1] and e[0] == entry[0], lambda e: e[1] == entry[1]):
+        for candidate in entries:
+            if match(candidate):
+                return candidate
+    return entries[0]
+
+def Compare(old, new):
+    kinds = []
+    if old[0] != new[0]:
+        kinds.append('geometry')
+    if old[2] != new[2]:
+        kinds.append('owner')
+    if old[3] != new[3]:
+        kinds.append('address')
+    return kinds
+
+def Display(address):
+    return u' '.join(value for value in address.split(Separator) if value)
+
+def Detect(oldBackend, oldTable, newBackend, newTable, report):
+    # Writes every change to the report csv and returns the counts, in total and
+    # {'sources': {jurisdiction: {kind: count}}}
+    start = time.time()
+    old = Index(oldBackend, oldTable)
+    stats = dict((kind, 0) for kind in Kinds)
+    stats.update({'parcels': 0, 'old_parcels': sum(len(entries) for entries in old.itervalues()),
+                  'unchanged': 0, 'sources': {}, 'report': report})
+    indexed = time.time()
+
+    def Count(source, kind):
+        counts = stats['sources'].setdefault(source, dict((k, 0) for k in Kinds + ['parcels']))
+        counts[kind] += 1
+        if kind != 'parcels':
+            stats[kind] += 1
+
+    with open(report, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(Columns)
+
+        def Write(kinds, parcelId, oldId, previous, entry):
+            for kind in kinds:
+                Count((entry or previous)[1], kind)
+            values = [';'.join(kinds), (entry or previous)[1], parcelId, oldId,
+                      previous[2] if previous else u'', entry[2] if entry else u'',
+                      Display(previous[3]) if previous else u'', Display(entry[3]) if entry else u'']
+            writer.writerow([value.encode('utf-8') for value in values])
+
+        added = []
+        for row in newBackend.Search(newTable, Fields()):
+            parcelId, entry = Publish.Value(row[0]), Entry(newBackend, row)
+            stats['parcels'] += 1
+            Count(entry[1], 'parcels')
+            entries = old.get(parcelId) if parcelId else None
+            if not entries:
+                added.append((parcelId, entry))
+                continue
+            previous = Pick(entries, entry)
+            entries.remove(previous)
+            if not entries:
+                del old[parcelId]
+            kinds = Compare(previous, entry)
+            if kinds:
+                Write(kinds, parcelId, parcelId, previous, entry)
+            else:
+                stats['unchanged'] += 1
+
+        # What's left of the old generation by fingerprint, to find the added parcels on it
+        retired = {}
+        for parcelId, entries in old.iteritems():
+            for entry in entries:
+                retired.setdefault(entry[0], []).append((parcelId, entry))
+        old = None
+        for parcelId, entry in added:
+            matches = retired.get(entry[0]) if entry[0] else None
+            if not matches:
+                Write(['added'], parcelId, u'', None, entry)
+                continue
+            oldId, previous = matches.pop(0)
+            if not matches:
+                del retired[entry[0]]
+            kinds = (['renamed'] if oldId != parcelId else []) + Compare(previous, entry)
+            if kinds:
+                Write(kinds, parcelId, oldId, previous, entry)
+            else:
+                stats['unchanged'] += 1
+        for matches in retired.itervalues():
+            for oldId, previous in matches:
+                Write(['retired'], u'', oldId, previous, None)
+
+    stats['seconds'] = round(time.time() - start, 3)
+    stats['index_seconds'] = round(indexed - start, 3)
+    stats['parcels_per_sec'] = round((stats['parcels'] + stats['old_parcels']) / (time.time() - start), 1)
+    print '\tCompared %d parcels with %d last month in %.1f s: ' % (stats['parcels'], stats['old_parcels'], stats['seconds']) + \
+          ', '.join('%d %s' % (stats[kind], kind) for kind in Kinds)
+    return stats
+
+def Summary(stats):
+    # Per-jurisdiction table of Detect() counts
+    lines = ['%-32s %8s' % ('Parcel changes', 'Parcels') + ''.join(' %8s' % kind.capitalize() for kind in Kinds)]
+    for source, counts in sorted(stats['sources'].items()) + [('Total', dict(stats))]:
+        lines.append('%-32s %8d' % ((source or '(none)')[:32], counts['parcels']) + ''.join(' %8d' % counts[kind] for kind in Kinds))
+    return '\n'.join(lines)
+
+############################################################################################
+
+def Synthetic(parcels, jurisdictions=7, changed=0.01, seed=1):
+    # MemoryBackend with 'Old' and 'New' generations of square parcels in a band per
+    # jurisdiction - changed of them of each kind. Returns (memory, {kind: count}).
+    rng = random.Random(seed)
+    memory = Backends.MemoryBackend()
+    old, new = [], []
+    expected = dict((kind, 0) for kind in Kinds)
+    for n in range(parcels):
+        x, y = (n % 500) * 100.0, (n // 500) * 100.0
+        row = {Key: u'P%07d' % n, Source: u'Jurisdiction %d' % (n * jurisdictions // parcels),
+               Owner: u'OWNER %d' % rng.randint(1, parcels), 'HouseNumber': u'%d' % (n % 900 + 100),
+               'Street': u'MAIN ST', 'Zip_Code': u'236%02d' % (n % 7),
+               Shape: [[(x, y), (x, y + 100), (x + 100, y + 100), (x + 100, y), (x, y)]]}
+        old.append(row)
+        roll = rng.random() / changed
+        if roll >= len(Kinds):
+            new.append(row)
+            continue
+        kind = Kinds[int(roll)]
+        expected[kind] += 1
+        if kind == 'added':
+            new.append(row)
+            old.pop()
+        elif kind == 'retired':
+            pass
+        elif kind == 'renamed':
+            new.append(dict(row, Parcel_ID=u'R%07d' % n))
+        elif kind == 'geometry':
+            reshaped = dict(row)
+            reshaped[Shape] = [[(x, y), (x, y + 100), (x + 90, y + 100), (x + 100, y), (x, y)]]
+            new.append(reshaped)
+        elif kind == 'owner':
+            new.append(dict(row, Name_Owner=u'NEW OWNER %d' % n))
+        else:
+            new.append(dict(row, Street=u'OAK AVE'))
+    # Blank IDs are matched on geometry, null geometries never are
+    old.append({Key: None, Source: u'Jurisdiction 0', Owner: u'UNKNOWN', Shape: [[(-100.0, 0.0), (-100.0, 100.0), (0.0, 0.0), (-100.0, 0.0)]]})
+    new.append({Key: u'', Source: u'Jurisdiction 0', Owner: u'UNKNOWN', Shape: [[(-100.0, 0.0), (-100.0, 100.0), (0.0, 0.0), (-100.0, 0.0)]]})
+    old.append({Key: u'NULL1', Source: u'Jurisdiction 0', Owner: u'NOBODY', Shape: None})
+    new.append({Key: u'NULL2', Source: u'Jurisdiction 0', Owner: u'NOBODY', Shape: None})
+    expected['retired'] += 1
+    expected['added'] += 1
+    # A Parcel_ID in two jurisdictions in both generations, one of them with a new owner
+    for generation in (old, new):
+        for source in (u'Jurisdiction 0', u'Jurisdiction 1'):
+            owner = u'LATER OWNER' if generation is new and source == u'Jurisdiction 1' else u'EARLIER OWNER'
+            generation.append({Key: u'DUP', Source: source, Owner: owner, Shape: [[(0.0, -100.0), (0.0, -50.0), (50.0, -50.0), (0.0, -100.0)]]})
+    expected['owner'] += 1
+    memory.tables['Old'] = old
+    memory.tables['New'] = new
+    return memory, expected
+
+def SelfTest(parcels=20000):
+    memory, expected = Synthetic(parcels)
+    folder = tempfile.mkdtemp()
+    try:
+        report = os.path.join(folder, 'ParcelChanges.csv')
+        stats = Detect(memory, 'Old', memory, 'New', report)
+        for kind in Kinds:
+            assert stats[kind] == expected[kind], (kind, stats[kind], expected[kind])
+        with open(report, 'rb') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == sum(expected.values())
+        renamed = [row for row in rows if row['Change'] == 'renamed'][0]
+        assert renamed['Parcel_ID'] == 'R' + renamed['Old_Parcel_ID'][1:]
+        assert [row['Info_Source'] for row in rows if row['Parcel_ID'] == 'DUP'] == ['Jurisdiction 1']
+        assert sum(counts['parcels'] for counts in stats['sources'].values()) == stats['parcels'] == memory.Count('New')
+        assert stats['unchanged'] == stats['parcels'] - len(rows) + stats['retired']
+        assert Detect(memory, 'New', memory, 'New', report)['unchanged'] == memory.Count('New')
+    finally:
+        shutil.rmtree(folder)
+    print Summary(stats)
+    print 'Changes self test passed'
+
+def Benchmark(parcels=300000):
+    # Detect() over two generations of the service area's size
+    memory, expected = Synthetic(parcels)
+    folder = tempfile.mkdtemp()
+    try:
+        stats = Detect(memory, 'Old', memory, 'New', os.path.join(folder, 'ParcelChanges.csv'))
+    finally:
+        shutil.rmtree(folder)
+    print '\t%.0f parcels/sec, old generation indexed in %.1f s' % (stats['parcels_per_sec'], stats['index_seconds'])
+    return stats
+
+if __name__ == '__main__':
+    SelfTest()
@@ -0,0 +1,133 @@
+"""
+Name:     Checkpoint.py
+Purpose:  Resume a failed monthly run from the stage that failed
+
+          Run() works through a list of stages (name, function, inputs, outputs) and keeps a
+          manifest in the run folder of each finished stage with the signatures of its inputs
+          and outputs. On a rerun a stage is skipped while it is finished and neither its inputs
+          nor its outputs have changed. Once a stage runs, every stage after it runs too.
+
+          fromStage - rerun from this stage on, skipping everything before it
+          only      - run just these stages
+          fresh     - move the run folder aside (never deleted) and start over, copying back
+                      anything in keep (sources saved by hand)
+
+"""
+
+import datetime, json, os, shutil, time
+import Downloader
+
+## Function (path) --> signature string or None, for paths that aren't plain files
+## (feature classes). Set by the caller.
+TableSigner = None
+
+############################################################################################
+
+def Signature(path):
+    # Plain files by content, everything else through TableSigner. None if it doesn't exist.
+    if os.path.isfile(path):
+        return 'sha256:' + Downloader.FileHash(path)
+    if TableSigner is not None:
+        try:
+            return TableSigner(path)
+        except Exception:
+            return None
+    return 'exists' if os.path.exists(path) else None
+
+def Signatures(paths):
+    return dict((path, Signature(path)) for path in paths)
+
+def Load(manifestPath):
+    if not os.path.exists(manifestPath):
+        return {}
+    with open(manifestPath, 'r') as f:
+        return json.load(f)
+
+def Save(manifestPath, manifest):
+    # The first stage may have just made the run folder
+    folder = os.path.dirname(manifestPath)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    tempPath = manifestPath + '.tmp'
+    with open(tempPath, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    if os.path.exists(manifestPath):
+        os.remove(manifestPath)
+    os.rename(tempPath, manifestPath)
+
+def Valid(entry, inputs, outputs):
+    # Finished, same inputs as then, and the outputs are still what it wrote
+    if not entry or entry.get('status') != 'done':
+        return False
+    if Signatures(inputs) != entry.get('inputs'):
+        return False
+    current = Signatures(outputs)
+    return None not in current.values() and current == entry.get('outputs')
+
+def SetAside(folder, keep=()):
+    # --fresh: the old run folder is renamed, never deleted. keep = names in it to copy back.
+    if not os.path.exists(folder):
+        return None
+    aside = folder + '_' + datetime.datetime.now().strftime('%H%M%S')
+    os.rename(folder, aside)
+    print 'Previous run moved to ' + aside
+    for name in keep:
+        if os.path.isdir(os.path.join(aside, name)):
+            shutil.copytree(os.path.join(aside, name), os.path.join(folder, name))
+        elif os.path.exists(os.path.join(aside, name)):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            shutil.copy2(os.path.join(aside, name), os.path.join(folder, name))
+    return aside
+
+############################################################################################
+
+def Run(stages, manifestPath, fromStage=None, only=None, fresh=False, folder=None, keep=()):
+    # stages = [(name, function, inputs, outputs)]. inputs / outputs are functions returning
+    # paths so they are worked out when the stage is reached. Returns {name: status}.
+    names = [name for name, func, inputs, outputs in stages]
+    for name in ([fromStage] if fromStage else []) + list(only or []):
+        if name not in names:
+            raise ValueError('Unknown stage %s - stages are %s' % (name, ', '.join(names)))
+    if fresh:
+        SetAside(folder or os.path.dirname(manifestPath), keep)
+
+    manifest = Load(manifestPath)
+    status = {}
+    rerun = False
+    started = fromStage is None
+    for name, func, inputs, outputs in stages:
+        if name == fromStage:
+            started = rerun = True
+        if only:
+            if name not in only:
+                status[name] = 'skipped'
+                continue
+        elif not started:
+            status[name] = 'skipped'
+            continue
+        elif not rerun and Valid(manifest.get(name), inputs(), outputs()):
+            print 'Stage %s already done %s - skipped' % (name, manifest[name]['finished'])
+            status[name] = 'done earlier'
+            continue
+
+        print 'Stage ' + name
+        rerun = True
+        before = Signatures(inputs())
+        start = time.time()
+        try:
+            func()
+        except Exception as e:
+            manifest[name] = {'status': 'failed', 'error': '%s: %s' % (e.__class__.__name__, e),
+                              'finished': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+            Save(manifestPath, manifest)
+            status[name] = 'failed'
+            print 'Stage %s failed - %s' % (name, manifest[name]['error'])
+            print 'Fix it and run again to continue from %s' % name
+            break
+        manifest[name] = {'status': 'done', 'inputs': before, 'outputs': Signatures(outputs()),
+                          'seconds': round(time.time() - start, 1),
+                          'finished': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        Save(manifestPath, manifest)
+        status[name] = 'done'
+    return status
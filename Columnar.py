@@ -0,0 +1,330 @@
+"""
+Name:     Columnar.py
+Purpose:  Normalized jurisdiction parcels in a compact column file instead of a feature class
+
+          One file per jurisdiction, read through a memory map a batch of rows at a time:
+            DOUBLE / FLOAT  - float64 array, NaN for null
+            LONG / SHORT    - int32 array, -2**31 for null
+            TEXT            - the distinct values once, plus an int32 code per row (-1 for null).
+                              _Info_Source_, _State_ and _City_Loc_ are a handful of values.
+            Shape           - every x, y in one float64 buffer, with the offset of each ring
+                              into it and of each row into the rings
+          _Square_Feet_ / _Acres_US_ left empty are filled from the packed geometry in one pass
+          when the file is saved (Geometry.PackedAreas), in the linear unit of its spatial reference.
+
+          ColumnarBackend has the backend methods FieldMap.Normalize() and Pipeline use, so a
+          file is written and read the same way as a feature class. With NumPy the columns are
+          views of the memory map; without it each batch is copied out with array.
+
+          Layout: column data (8 byte aligned), then the JSON header, its length and Magic.
+
+"""
+
+import array, contextlib, hashlib, json, mmap, os, struct, sys
+import Downloader, Geometry
+from Backends import Shape, OID, Centroid, Writer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+Magic = 'PCOL0001'
+Extension = '.pcol'
+
+## Rows per batch when reading
+Batch = 10000
+
+## Filled from the geometry when written empty
+AreaFields = ('_Square_Feet_', '_Acres_US_')
+
+## Field type --> column kind
+Kinds = {'DOUBLE': 'float', 'FLOAT': 'float', 'LONG': 'int', 'SHORT': 'int', 'TEXT': 'text'}
+
+NullInt = -2 ** 31
+NaN = float('nan')
+
+############################################################################################
+
+def IsColumnar(path):
+    return isinstance(path, basestring) and path.lower().endswith(Extension)
+
+## (path, size, mtime) --> sha256, so a file is only hashed once per run
+hashes = {}
+
+def CacheKey(paths):
+    # Names a file by what it was made from - the same inputs give the same key
+    sha = hashlib.sha1(Magic)
+    for path in paths:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        if key not in hashes:
+            hashes[key] = Downloader.FileHash(path)
+        sha.update(hashes[key])
+    return sha.hexdigest()[:16]
+
+class Builder(object):
+    # Columns of a file being written, kept in arrays until Save()
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.kinds = []
+        for name, fieldType, length in schema:
+            if fieldType.upper() not in Kinds:
+                raise ValueError('%s: %s fields are not supported' % (name, fieldType))
+            self.kinds.append(Kinds[fieldType.upper()])
+        self.data = [array.array('d' if kind == 'float' else 'i') for kind in self.kinds]
+        self.dictionaries = [{} if kind == 'text' else None for kind in self.kinds]
+        names = [name for name, fieldType, length in schema]
+        self.areas = [(names.index(field), i) for i, field in enumerate(AreaFields) if field in names]
+        self.rowRings = array.array('I', [0])
+        self.ringPoints = array.array('I', [0])
+        self.coords = array.array('d')
+        self.rows = 0
+
+    def Add(self, values, rings, areas=None):
+        # values in schema order. areas = (square feet, acres) if already known.
+        if areas:
+            values = list(values)
+            for position, i in self.areas:
+                if values[position] is None:
+                    values[position] = areas[i]
+        for kind, data, dictionary, value in zip(self.kinds, self.data, self.dictionaries, values):
+            if kind == 'float':
+                data.append(NaN if value is None else float(value))
+            elif kind == 'int':
+                data.append(NullInt if value is None else int(value))
+            elif value is None:
+                data.append(-1)
+            else:
+                if not isinstance(value, unicode):
+                    value = str(value).decode('utf-8', 'replace')
+                code = dictionary.get(value)
+                if code is None:
+                    code = dictionary[value] = len(dictionary)
+                data.append(code)
+        for ring in rings or []:
+            self.coords.extend([v for x, y in ring for v in (x, y)])
+            self.ringPoints.append(len(self.coords) // 2)
+        self.rowRings.append(len(self.ringPoints) - 1)
+        self.rows += 1
+
+    def FillAreas(self, wkt):
+        # Areas of every polygon at once for the rows written without them
+        if not self.areas or not any(v != v for position, i in self.areas for v in self.data[position]):
+            return
+        factor = Geometry.SquareFeetPerSquareUnit(Geometry.MetersPerUnit(wkt))
+        areas = Geometry.PackedAreas(self.coords, self.ringPoints, self.rowRings)
+        for position, i in self.areas:
+            data = self.data[position]
+            for r, area in enumerate(areas):
+                if data[r] != data[r] and self.rowRings[r + 1] > self.rowRings[r]:
+                    sqft = area * factor
+                    data[r] = sqft if i == 0 else sqft / Geometry.SquareFeetPerAcre
+
+    def Save(self, path, wkt):
+        # Written to a temp file and renamed, so a reader never sees half a file
+        self.FillAreas(wkt)
+        temp = path + '.tmp'
+        header = {'rows': self.rows, 'byteorder': sys.byteorder, 'wkt': wkt, 'fields': []}
+        with open(temp, 'wb') as f:
+            def Put(data):
+                f.write('\0' * (-f.tell() % 8))
+                offset = f.tell()
+                if isinstance(data, str):
+                    f.write(data)
+                else:
+                    data.tofile(f)
+                return offset
+            for (name, fieldType, length), kind, data, dictionary in zip(self.schema, self.kinds, self.data, self.dictionaries):
+                field = {'name': name, 'type': fieldType, 'length': length, 'kind': kind, 'offset': Put(data)}
+                if kind == 'text':
+                    strings = [value.encode('utf-8') for value in sorted(dictionary, key=dictionary.get)]
+                    offsets = array.array('I', [0])
+                    for value in strings:
+                        offsets.append(offsets[-1] + len(value))
+                    field['count'] = len(strings)
+                    field['strings'] = Put(offsets)
+                    field['blob'] = Put(''.join(strings))
+                header['fields'].append(field)
+            header['geometry'] = {'rings': len(self.ringPoints) - 1, 'points': len(self.coords) // 2,
+                                  'row_rings': Put(self.rowRings), 'ring_points': Put(self.ringPoints),
+                                  'coords': Put(self.coords)}
+            text = json.dumps(header)
+            Put(text)
+            f.write(struct.pack('<Q', len(text)) + Magic)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+
+############################################################################################
+
+class Table(object):
+    # An open file. Column() / Shapes() return rows start..stop.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.map)
+        if size < 16 or self.map[size - 8:] != Magic:
+            self.Close()
+            raise ValueError(path + ' is not a columnar parcel file')
+        length, = struct.unpack('<Q', self.map[size - 16:size - 8])
+        self.header = json.loads(self.map[size - 16 - length:size - 16])
+        self.rows = self.header['rows']
+        self.wkt = self.header['wkt']
+        self.fields = dict((field['name'].upper(), field) for field in self.header['fields'])
+        self.order = '<' if self.header['byteorder'] == 'little' else '>'
+        self.strings = {}
+
+    def Array(self, typecode, offset, start, stop):
+        # Items start..stop of the array at offset - a view of the map with NumPy, a copy without
+        size = 8 if typecode == 'd' else 4
+        if numpy is not None:
+            dtype = self.order + {'d': 'f8', 'i': 'i4', 'I': 'u4'}[typecode]
+            return numpy.frombuffer(self.map, dtype, stop - start, offset + start * size)
+        data = array.array(typecode)
+        data.fromstring(self.map[offset + start * size:offset + stop * size])
+        if self.header['byteorder'] != sys.byteorder:
+            data.byteswap()
+        return data
+
+    def String(self, field, code):
+        offsets = self.Array('I', field['strings'], code, code + 2).tolist()
+        return self.map[field['blob'] + offsets[0]:field['blob'] + offsets[1]].decode('utf-8')
+
+    def Column(self, name, start, stop):
+        field = self.fields[name.upper()]
+        if field['kind'] == 'float':
+            return [None if v != v else v for v in self.Array('d', field['offset'], start, stop).tolist()]
+        if field['kind'] == 'int':
+            return [None if v == NullInt else v for v in self.Array('i', field['offset'], start, stop).tolist()]
+        codes = self.Array('i', field['offset'], start, stop).tolist()
+        if field['count'] <= Batch:
+            # Few distinct values - decoded once
+            if name not in self.strings:
+                self.strings[name] = [self.String(field, code) for code in range(field['count'])]
+            strings = self.strings[name]
+            return [strings[code] if code >= 0 else None for code in codes]
+        return [self.String(field, code) if code >= 0 else None for code in codes]
+
+    def Shapes(self, start, stop):
+        geometry = self.header['geometry']
+        rowRings = self.Array('I', geometry['row_rings'], start, stop + 1).tolist()
+        ringPoints = self.Array('I', geometry['ring_points'], rowRings[0], rowRings[-1] + 1).tolist()
+        coords = self.Array('d', geometry['coords'], 2 * ringPoints[0], 2 * ringPoints[-1]).tolist()
+        first, base = rowRings[0], ringPoints[0]
+        shapes = []
+        for r in range(stop - start):
+            rings = []
+            for k in range(rowRings[r] - first, rowRings[r + 1] - first):
+                xy = coords[2 * (ringPoints[k] - base):2 * (ringPoints[k + 1] - base)]
+                rings.append(zip(xy[0::2], xy[1::2]))
+            shapes.append(rings or None)
+        return shapes
+
+    def Batches(self, fields, size=Batch):
+        # Lists of columns, size rows at a time
+        for start in range(0, self.rows, size):
+            stop = min(start + size, self.rows)
+            shapes = self.Shapes(start, stop) if Shape in fields or Centroid in fields else None
+            columns = []
+            for field in fields:
+                if field == Shape:
+                    columns.append(shapes)
+                elif field == Centroid:
+                    columns.append([Geometry.Centroid(rings) for rings in shapes])
+                elif field == OID:
+                    columns.append(range(start + 1, stop + 1))
+                else:
+                    columns.append(self.Column(field, start, stop))
+            yield columns
+
+    def Close(self):
+        self.map.close()
+        self.file.close()
+
+############################################################################################
+
+class ColumnarBackend(object):
+    # Table names are file paths. shapes = the backend whose geometry is written (ArcpyBackend
+    # when normalizing a feature class) - its areas are kept and its shapes turned into rings.
+
+    def __init__(self, shapes=None):
+        self.shapes = shapes
+        self.created = {}
+        self.open = {}
+
+    def Open(self, table):
+        if table not in self.open:
+            self.open[table] = Table(table)
+        return self.open[table]
+
+    def Close(self, table=None):
+        for path in ([table] if table else list(self.open)):
+            if path in self.open:
+                self.open.pop(path).Close()
+
+    def Rings(self, shape):
+        return shape
+
+    def Center(self, shape):
+        return Geometry.Centroid(shape) if shape else None
+
+    def Areas(self, shape, wkt=None):
+        # wkt - the file's SpatialReference()
+        if shape is None:
+            return (None, None)
+        return Geometry.RingAreas(shape, wkt)
+
+    def Search(self, table, fields, where=None):
+        if where is not None:
+            raise ValueError('Columnar files are read whole - no where clause')
+        for columns in self.Open(table).Batches(list(fields)):
+            for row in zip(*columns):
+                yield row
+
+    def Count(self, table):
+        return self.Open(table).rows
+
+    def Signature(self, table, fields=[]):
+        return 'sha256:' + Downloader.FileHash(table)
+
+    def SpatialReference(self, table):
+        # Well known text the file was written with
+        return self.Open(table).wkt
+
+    def CreateTable(self, table, schema, template=None):
+        # template - a columnar file, anything shapes.SpatialReference() takes or well known text
+        if IsColumnar(template):
+            wkt = self.Open(template).wkt
+        else:
+            if template is not None and hasattr(self.shapes, 'SpatialReference'):
+                template = self.shapes.SpatialReference(template)
+            wkt = template.exportToString() if hasattr(template, 'exportToString') else template
+        self.Close(table)
+        self.created[table] = (schema, wkt)
+
+    @contextlib.contextmanager
+    def Writer(self, table, fields):
+        # The file is written when the stream closes
+        schema, wkt = self.created.pop(table)
+        builder = Builder(schema)
+        positions = [fields.index(name) if name in fields else None for name, fieldType, length in schema]
+        shapeIndex = fields.index(Shape) if Shape in fields else None
+        def Write(row):
+            shape = row[shapeIndex] if shapeIndex is not None else None
+            areas = None
+            if shape is not None and not isinstance(shape, list):
+                areas = self.shapes.Areas(shape)
+                shape = self.shapes.Rings(shape)
+            builder.Add([row[i] if i is not None else None for i in positions], shape, areas)
+        yield Writer(Write)
+        builder.Save(table, wkt)
+
+    def Insert(self, table, fields, rows):
+        with self.Writer(table, fields) as writer:
+            for row in rows:
+                writer.Write(row)
+        return writer.count
@@ -0,0 +1,87 @@
+"""
+Name:     Config.py
+Purpose:  Settings for a run, resolved once from Parcels.cfg
+
+          The workspace, the run date and the switches that used to be edited at the top of
+          MonthlyParcelUpdate.py. Load() reads them from the --config file, the PARCEL_CONFIG
+          environment variable or Parcels.cfg next to the scripts, whichever comes first.
+          Anything the file leaves out keeps its default. Only the standard library is imported
+          here, so Parcels.py can work out the run folder and report without loading arcpy.
+
+          [parcels]
+          workspace     = R:\Divisions\InfoTech\Shared\GIS\Parcels
+          date          = 20170301    (resume an earlier day's run - default today)
+          workers       = 4
+          merge_policy  = flag
+          overlap_limit = 50
+
+"""
+
+import ConfigParser, datetime, os
+
+Section = 'parcels'
+
+Defaults = {'workspace':     r'R:\Divisions\InfoTech\Shared\GIS\Parcels',
+            'date':          '',
+            'workers':       '',
+            'merge_policy':  'flag',
+            'overlap_limit': ''}
+
+## Set by Load()
+Path = None
+Workspace = Defaults['workspace']
+TodaysDate = None
+RunFolder = None
+ReportPath = None
+CheckpointManifest = None
+ArchivePath = None
+Workers = None
+MergePolicy = Defaults['merge_policy']
+OverlapLimit = None
+
+############################################################################################
+
+def Find(path=None):
+    # Config file to read, None if there isn't one
+    if path:
+        if not os.path.exists(path):
+            raise IOError('No config file ' + path)
+        return path
+    if os.environ.get('PARCEL_CONFIG'):
+        return Find(os.environ['PARCEL_CONFIG'])
+    beside = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Parcels.cfg')
+    return beside if os.path.exists(beside) else None
+
+def Folder(date):
+    return Workspace + os.sep + 'UpdateFolder' + os.sep + date
+
+def Integer(value):
+    return int(value) if str(value).strip() else None
+
+def Load(path=None):
+    # Sets the module settings and returns them as a dict
+    global Path, Workspace, TodaysDate, RunFolder, ReportPath, CheckpointManifest, ArchivePath, Workers, MergePolicy, OverlapLimit
+    values = dict(Defaults)
+    Path = Find(path)
+    if Path:
+        parser = ConfigParser.RawConfigParser()
+        parser.read(Path)
+        if parser.has_section(Section):
+            for name, value in parser.items(Section):
+                if name not in Defaults:
+                    raise ValueError('Unknown setting %s in %s - settings are %s' % (name, Path, ', '.join(sorted(Defaults))))
+                values[name] = value.strip()
+    Workspace = values['workspace']
+    TodaysDate = values['date'] or datetime.datetime.today().strftime('%Y%m%d')
+    if len(TodaysDate) != 8 or not TodaysDate.isdigit():
+        raise ValueError('date must be yyyymmdd, not ' + TodaysDate)
+    RunFolder = Folder(TodaysDate)
+    ReportPath = RunFolder + os.sep + 'RunReport.ndjson'
+    CheckpointManifest = RunFolder + os.sep + 'Checkpoint.json'
+    ArchivePath = Workspace + os.sep + 'Data' + os.sep + 'Archive' + os.sep + 'Archive.sqlite'
+    Workers = Integer(values['workers'])
+    MergePolicy = values['merge_policy']
+    OverlapLimit = Integer(values['overlap_limit'])
+    return values
+
+Load()
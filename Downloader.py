@@ -0,0 +1,597 @@
+"""
+Name:     Downloader.py
+Purpose:  Download the HTTP/FTP parcel archives
+
+          - Sources are fetched concurrently (FetchAll)
+          - HTTP requests send If-None-Match/If-Modified-Since from the last run
+          - Interrupted transfers are kept as <archive>.part and resumed (HTTP Range / FTP REST).
+            The ETag/Last-Modified (FTP: MDTM and SIZE) the part was started from is saved next
+            to it, and the transfer only resumes while that is still current (HTTP If-Range) -
+            otherwise it starts over
+          - An archive shorter than the server said it would be is an error, not a download
+          - Failed attempts are retried with exponential backoff
+          - The SHA-256 of every archive is kept in a JSON manifest. An archive that matches the
+            last one is reported as 'unchanged' and the previous extraction is reused (Extract)
+
+          The manifest is shared by the ProcessParallel workers, so it is only read and written
+          holding <manifest>.lock.
+
+          Any url works. StubHttpServer / StubFtpServer stand in for the county sites on
+          localhost, failing transfers on request (SelfTest()).
+
+"""
+
+import contextlib, datetime, email.utils, errno, ftplib, hashlib, json, multiprocessing, os, shutil, socket, tempfile
+import threading, time, urllib2, urlparse, zipfile
+import BaseHTTPServer, Queue, SocketServer
+
+ChunkSize = 1024 * 1024
+
+## A manifest lock older than this was left by a killed process and is taken over
+LockTimeout = 60.0
+
+############################################################################################
+
+@contextlib.contextmanager
+def ManifestLock(manifestPath):
+    # <manifest>.lock, created with O_EXCL - held by one thread of one process at a time
+    lockPath = manifestPath + '.lock'
+    folder = os.path.dirname(lockPath)
+    if folder and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass # another process made it first
+    while True:
+        try:
+            fd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.EACCES):
+                raise
+        try:
+            if time.time() - os.path.getmtime(lockPath) > LockTimeout:
+                os.remove(lockPath)
+                continue
+        except OSError:
+            continue # released in between
+        time.sleep(0.005)
+    try:
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lockPath)
+
+def ReadManifest(manifestPath):
+    if not os.path.exists(manifestPath):
+        return {}
+    with open(manifestPath, 'r') as f:
+        return json.load(f)
+
+def LoadManifest(manifestPath):
+    # Under the lock - UpdateManifest() replaces the file by remove + rename (Windows)
+    with ManifestLock(manifestPath):
+        return ReadManifest(manifestPath)
+
+def UpdateManifest(manifestPath, name, entry):
+    # Re-read before writing so sources fetched from other threads and processes are kept
+    with ManifestLock(manifestPath):
+        manifest = ReadManifest(manifestPath)
+        manifest[name] = entry
+        tempPath = manifestPath + '.tmp'
+        with open(tempPath, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        if os.path.exists(manifestPath):
+            os.remove(manifestPath)
+        os.rename(tempPath, manifestPath)
+
+def FileHash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(ChunkSize), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+############################################################################################
+
+class NotModified(Exception):
+    pass
+
+class PermanentError(Exception):
+    # Not worth retrying (404, bad login, ...)
+    pass
+
+def ValidatorPath(partPath):
+    return partPath + '.json'
+
+def LoadValidator(partPath):
+    # What the part file was started from - {} if there is no part or it can't be trusted
+    if not os.path.exists(partPath) or not os.path.exists(ValidatorPath(partPath)):
+        return {}
+    try:
+        with open(ValidatorPath(partPath), 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def SaveValidator(partPath, etag, lastModified, length):
+    with open(ValidatorPath(partPath), 'w') as f:
+        json.dump({'etag': etag, 'last_modified': lastModified, 'length': length}, f)
+
+def RemovePart(partPath):
+    for path in (partPath, ValidatorPath(partPath)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def ContentRange(headers):
+    # (first byte, total length or None) of a 206 response
+    value = headers.getheader('Content-Range') or ''
+    try:
+        span, total = value.split(' ', 1)[1].split('/')
+        return int(span.split('-')[0]), None if total == '*' else int(total)
+    except (IndexError, ValueError):
+        return None, None
+
+def HttpDownload(url, partPath, previous, timeout):
+    # Returns (etag, last_modified, length). Appends to partPath when the server answers the
+    # Range with 206 - If-Range makes it send the whole file (200) instead if it has changed
+    # since the part was started, and then the part is started over.
+    request = urllib2.Request(url)
+    if previous:
+        if previous.get('etag'):
+            request.add_header('If-None-Match', previous['etag'])
+        if previous.get('last_modified'):
+            request.add_header('If-Modified-Since', previous['last_modified'])
+    validator = LoadValidator(partPath)
+    etag = validator.get('etag')
+    # A weak ETag can't be used in If-Range
+    ifRange = etag if etag and not etag.startswith('W/') else validator.get('last_modified')
+    offset = os.path.getsize(partPath) if ifRange else 0
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+        request.add_header('If-Range', ifRange)
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            raise NotModified()
+        if e.code == 416:
+            # Part file is already complete (or junk) - start over next attempt
+            RemovePart(partPath)
+            raise
+        if 400 <= e.code < 500 and e.code not in (408, 429):
+            raise PermanentError('HTTP %d %s' % (e.code, url))
+        raise
+    try:
+        headers = response.info()
+        etag, lastModified = headers.getheader('ETag'), headers.getheader('Last-Modified')
+        if response.getcode() == 206:
+            first, length = ContentRange(headers)
+            if not offset or first != offset:
+                RemovePart(partPath)
+                raise IOError('HTTP 206 from byte %s, asked for %d - starting over' % (first, offset))
+            mode = 'ab'
+        else:
+            length = int(headers.getheader('Content-Length')) if headers.getheader('Content-Length') else None
+            mode = 'wb'
+        SaveValidator(partPath, etag, lastModified, length)
+        with open(partPath, mode) as f:
+            for chunk in iter(lambda: response.read(ChunkSize), ''):
+                f.write(chunk)
+    finally:
+        response.close()
+    return etag, lastModified, length
+
+def FtpDownload(url, partPath, previous, timeout):
+    # Returns (None, last_modified, length). MDTM stands in for If-Modified-Since, and for
+    # If-Range with SIZE - the part is only resumed (REST) if neither has changed.
+    parts = urlparse.urlparse(url)
+    ftp = ftplib.FTP(timeout=timeout)
+    try:
+        ftp.connect(parts.hostname, parts.port or 21)
+        try:
+            ftp.login(parts.username or 'anonymous', parts.password or '')
+        except ftplib.error_perm as e:
+            raise PermanentError(str(e))
+        ftp.voidcmd('TYPE I')
+        lastModified = None
+        try:
+            lastModified = ftp.sendcmd('MDTM ' + parts.path)[4:].strip()
+        except ftplib.error_perm:
+            pass # server doesn't support MDTM
+        if previous and lastModified and previous.get('last_modified') == lastModified:
+            raise NotModified()
+        length = None
+        try:
+            length = int(ftp.sendcmd('SIZE ' + parts.path)[4:].strip())
+        except (ftplib.error_perm, ValueError):
+            pass
+        validator = LoadValidator(partPath)
+        offset = 0
+        if lastModified and validator.get('last_modified') == lastModified and validator.get('length') == length:
+            offset = os.path.getsize(partPath)
+        SaveValidator(partPath, None, lastModified, length)
+        with open(partPath, 'ab' if offset else 'wb') as f:
+            try:
+                ftp.retrbinary('RETR ' + parts.path, f.write, ChunkSize, offset or None)
+            except ftplib.error_perm as e:
+                if offset:
+                    # REST not supported - start over next attempt
+                    f.truncate(0)
+                    raise ftplib.error_temp(str(e))
+                raise PermanentError(str(e))
+        return None, lastModified, length
+    finally:
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+############################################################################################
+
+def Fetch(name, url, path, manifestPath, timeout=60, retries=4, backoff=2.0):
+    # Download url to path. Returns a result dict with status 'downloaded', 'unchanged' or 'failed'.
+    start = time.time()
+    today = datetime.date.today().strftime('%Y%m%d')
+    previous = LoadManifest(manifestPath).get(name)
+    result = {'name': name, 'url': url, 'path': path, 'status': None, 'sha256': None,
+              'bytes': 0, 'seconds': 0.0, 'attempts': 0, 'error': None}
+
+    if previous and previous.get('checked') == today and os.path.exists(previous.get('path') or ''):
+        # Already fetched today (FetchAll before the jurisdiction functions)
+        result.update(path=previous['path'], status=previous['status'], sha256=previous['sha256'],
+                      bytes=os.path.getsize(previous['path']))
+        return result
+
+    # Conditional requests only make sense if the last archive is still around to fall back on
+    conditional = previous if previous and os.path.exists(previous.get('path') or '') else None
+    download = FtpDownload if url.lower().startswith('ftp://') else HttpDownload
+    partPath = path + '.part'
+    etag = lastModified = None
+    while True:
+        result['attempts'] += 1
+        try:
+            etag, lastModified, length = download(url, partPath, conditional, timeout)
+            size = os.path.getsize(partPath)
+            if length is not None and size != length:
+                if size > length:
+                    RemovePart(partPath)
+                # Otherwise kept for the next attempt to resume
+                raise IOError('%d of %d bytes received' % (size, length))
+            break
+        except NotModified:
+            result['status'] = 'unchanged'
+            break
+        except PermanentError as e:
+            result['status'], result['error'] = 'failed', str(e)
+            break
+        except (IOError, OSError, socket.error, ftplib.Error, urllib2.URLError) as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+            if result['attempts'] > retries:
+                result['status'] = 'failed'
+                break
+            wait = backoff ** result['attempts']
+            print '\t%s attempt %d failed (%s) - retrying in %.0f s' % (name, result['attempts'], result['error'], wait)
+            time.sleep(wait)
+
+    entry = dict(previous or {})
+    if result['status'] == 'unchanged':
+        result.update(path=previous['path'], sha256=previous['sha256'], bytes=os.path.getsize(previous['path']))
+    elif result['status'] is None:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(partPath, path)
+        RemovePart(partPath)
+        sha = FileHash(path)
+        changed = not previous or previous.get('sha256') != sha
+        result.update(status='downloaded' if changed else 'unchanged', sha256=sha,
+                      bytes=os.path.getsize(path), error=None)
+        if changed:
+            entry.pop('extracted', None)
+        entry.update(path=path, etag=etag, last_modified=lastModified)
+    result['seconds'] = time.time() - start
+
+    if result['status'] != 'failed':
+        entry.update(url=url, sha256=result['sha256'], status=result['status'], checked=today)
+        UpdateManifest(manifestPath, name, entry)
+    print '\t%s %s (%d bytes, %.1f s)' % (name, result['status'], result['bytes'], result['seconds'])
+    return result
+
+def FetchAll(sources, manifestPath, workers=4, **kwargs):
+    # sources = {name: (url, path)}. Returns {name: result}.
+    jobs = Queue.Queue()
+    for name in sorted(sources):
+        jobs.put(name)
+    results = {}
+
+    def Worker():
+        while True:
+            try:
+                name = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            url, path = sources[name]
+            try:
+                results[name] = Fetch(name, url, path, manifestPath, **kwargs)
+            except Exception as e:
+                results[name] = {'name': name, 'url': url, 'path': path, 'status': 'failed', 'error': str(e)}
+
+    threads = [threading.Thread(target=Worker) for i in range(min(workers, len(sources)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def Archive(result):
+    # Path of the fetched archive, for reading it in place (ZipSource)
+    if result['status'] == 'failed':
+        raise IOError('%s download failed: %s' % (result['name'], result['error']))
+    return result['path']
+
+def Extract(result, folder, manifestPath):
+    # Returns the folder holding the extracted archive. Unchanged archives are not re-extracted.
+    if result['status'] == 'failed':
+        raise IOError('%s download failed: %s' % (result['name'], result['error']))
+    entry = LoadManifest(manifestPath).get(result['name'], {})
+    extracted = entry.get('extracted')
+    if result['status'] == 'unchanged' and extracted and os.path.isdir(extracted):
+        print '\t%s unchanged - using %s' % (result['name'], extracted)
+        return extracted
+    with zipfile.ZipFile(result['path'], 'r') as z:
+        z.extractall(folder)
+    entry['extracted'] = folder
+    UpdateManifest(manifestPath, result['name'], entry)
+    return folder
+
+############################################################################################
+
+class StubFiles(object):
+    # Files served by the stubs, {path: bytes}. actions are done to the next transfers in turn:
+    # ('cut', None) sends half the file, ('cut', body) also replaces the file with body after.
+
+    def Serve(self, files):
+        self.files = dict(files)
+        self.modified = dict((path, 1483228800.0) for path in files)
+        self.actions = []
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def Change(self, path, body):
+        self.files[path] = body
+        self.modified[path] = self.modified.get(path, 1483228800.0) + 60
+
+    def Next(self, request):
+        # The action for this transfer
+        with self.lock:
+            self.requests.append(request)
+            return self.actions.pop(0) if self.actions else None
+
+class StubHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # ETag / Last-Modified, conditional requests and Range with If-Range
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        body = server.files.get(self.path)
+        if body is None:
+            return self.Send(404, {}, '')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        modified = email.utils.formatdate(server.modified[self.path], usegmt=True)
+        if self.headers.getheader('If-None-Match') == etag or \
+           (not self.headers.getheader('If-None-Match') and self.headers.getheader('If-Modified-Since') == modified):
+            return self.Send(304, {'ETag': etag}, '')
+        action = server.Next((self.path, self.headers.getheader('Range'), self.headers.getheader('If-Range')))
+        status, first = 200, 0
+        headers = {'ETag': etag, 'Last-Modified': modified, 'Accept-Ranges': 'bytes'}
+        if self.headers.getheader('Range') and self.headers.getheader('If-Range') in (None, etag, modified):
+            first = int(self.headers.getheader('Range').split('=')[1].split('-')[0])
+            if first >= len(body):
+                return self.Send(416, {'Content-Range': 'bytes */%d' % len(body)}, '')
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, len(body) - 1, len(body))
+        if action:
+            self.close_connection = 1
+            self.Send(status, headers, body[first:], len(body[first:]) // 2)
+            if action[1] is not None:
+                server.Change(self.path, action[1])
+            return
+        self.Send(status, headers, body[first:])
+
+    def Send(self, status, headers, body, cut=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body[:cut])
+
+    def log_message(self, format, *args):
+        pass
+
+class StubHttpServer(StubFiles, SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # server = StubHttpServer({'/Parcels.zip': data}); server.Start(); Fetch(server.url + '/Parcels.zip', ...)
+    daemon_threads = True
+
+    def __init__(self, files):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHttpHandler)
+        self.Serve(files)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def Start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StubFtpHandler(SocketServer.StreamRequestHandler):
+    # USER/PASS (user 'bad' is refused), TYPE, MDTM, SIZE, REST, PASV, RETR and QUIT.
+    # A 'cut' transfer ends with 426 after half the file when it replaces the file, with 226
+    # (a silently short file) when it doesn't.
+
+    def Reply(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        user, rest, passive = None, 0, None
+        self.Reply('220 stub')
+        for line in iter(self.rfile.readline, ''):
+            command, _, argument = line.strip().partition(' ')
+            command = command.upper()
+            if command == 'USER':
+                user = argument
+                self.Reply('331 password')
+            elif command == 'PASS':
+                self.Reply('530 login incorrect' if user == 'bad' else '230 logged in')
+            elif command == 'TYPE':
+                self.Reply('200 type set')
+            elif command in ('MDTM', 'SIZE', 'RETR') and argument not in server.files:
+                self.Reply('550 %s: no such file' % argument)
+            elif command == 'MDTM':
+                self.Reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(server.modified[argument])))
+            elif command == 'SIZE':
+                self.Reply('213 %d' % len(server.files[argument]))
+            elif command == 'REST':
+                rest = int(argument)
+                self.Reply('350 restarting at %d' % rest)
+            elif command == 'PASV':
+                passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                passive.bind(('127.0.0.1', 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                self.Reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port // 256, port % 256))
+            elif command == 'RETR':
+                action = server.Next((argument, rest))
+                body = server.files[argument][rest:]
+                self.Reply('150 opening binary connection')
+                data, address = passive.accept()
+                data.sendall(body[:len(body) // 2] if action else body)
+                data.close()
+                passive.close()
+                rest = 0
+                if action and action[1] is not None:
+                    server.Change(argument, action[1])
+                    self.Reply('426 connection closed; transfer aborted')
+                else:
+                    self.Reply('226 transfer complete')
+            elif command == 'QUIT':
+                self.Reply('221 bye')
+                return
+            else:
+                self.Reply('502 %s not implemented' % command)
+
+class StubFtpServer(StubFiles, SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), StubFtpHandler)
+        self.Serve(files)
+        self.url = 'ftp://127.0.0.1:%d' % self.server_address[1]
+
+    Start = StubHttpServer.Start.im_func
+    Stop = StubHttpServer.Stop.im_func
+
+############################################################################################
+
+def ManifestWorker(args):
+    manifestPath, worker, entries = args
+    for i in range(entries):
+        UpdateManifest(manifestPath, '%d-%d' % (worker, i), {'worker': worker})
+
+def SelfTest():
+    # Each source through the stub servers: first download, unchanged (304 / MDTM), a resumed
+    # transfer, a file changed between attempts, a short body and errors that aren't retried
+    folder = tempfile.mkdtemp()
+    manifestPath = os.path.join(folder, 'SourceManifest.json')
+    versions = [''.join(chr((i * 7 + v) % 256) for i in range(300000)) for v in range(6)]
+    quick = {'backoff': 0.01, 'timeout': 10}
+
+    def Again(name):
+        # As if the last fetch was on another day
+        entry = LoadManifest(manifestPath)[name]
+        entry['checked'] = ''
+        UpdateManifest(manifestPath, name, entry)
+
+    def Check(result, status, body, attempts=None):
+        assert result['status'] == status, result
+        if body is not None:
+            with open(result['path'], 'rb') as f:
+                assert f.read() == body, result
+        if attempts is not None:
+            assert result['attempts'] == attempts, result
+        assert not os.path.exists(result['path'] + '.part') or status == 'failed', result
+
+    http = StubHttpServer({'/Parcels.zip': versions[0]})
+    ftp = StubFtpServer({'/GIS/jcc_parcels.zip': versions[0]})
+    http.Start()
+    ftp.Start()
+    try:
+        for name, server, path in (('HTTP', http, '/Parcels.zip'), ('FTP', ftp, '/GIS/jcc_parcels.zip')):
+            url, archive = server.url + path, os.path.join(folder, name + '.zip')
+            Check(Fetch(name, url, archive, manifestPath, **quick), 'downloaded', versions[0], 1)
+            Again(name)
+            Check(Fetch(name, url, archive, manifestPath, **quick), 'unchanged', versions[0], 1)
+
+            # Cut off, then resumed from the part file
+            server.Change(path, versions[1])
+            server.actions = [('cut', None)]
+            del server.requests[:]
+            Again(name)
+            Check(Fetch(name, url, archive, manifestPath, **quick), 'downloaded', versions[1], 2)
+            # HTTP records (path, Range, If-Range), FTP (path, REST)
+            half = len(versions[1]) // 2
+            assert server.requests[1][1] in ('bytes=%d-' % half, half), server.requests
+
+            # Cut off, and the file changes before the next attempt - not spliced together
+            server.Change(path, versions[2])
+            server.actions = [('cut', versions[3])]
+            Again(name)
+            Check(Fetch(name, url, archive, manifestPath, **quick), 'downloaded', versions[3], 2)
+
+            # A part left from an earlier month's file is started over
+            server.Change(path, versions[4])
+            with open(archive + '.part', 'wb') as f:
+                f.write(versions[0][:1000])
+            SaveValidator(archive + '.part', '"old"', 'Sun, 01 Jan 2017 00:00:00 GMT', len(versions[0]))
+            Again(name)
+            Check(Fetch(name, url, archive, manifestPath, **quick), 'downloaded', versions[4], 1)
+
+            # Short every time - failed, and the last good archive is left alone
+            server.Change(path, versions[5])
+            server.actions = [('cut', None)] * 3
+            Again(name)
+            Check(Fetch(name, url, archive, manifestPath, retries=2, **quick), 'failed', versions[4], 3)
+            assert LoadManifest(manifestPath)[name]['sha256'] == hashlib.sha256(versions[4]).hexdigest()
+            server.actions = []
+            Check(Fetch(name, url, archive, manifestPath, **quick), 'downloaded', versions[5])
+
+            # Not found - given up on the first attempt
+            Check(Fetch(name + '-missing', server.url + '/missing.zip', archive + '.missing', manifestPath, **quick),
+                  'failed', None, 1)
+        bad = ftp.url.replace('ftp://', 'ftp://bad:secret@') + '/GIS/jcc_parcels.zip'
+        Check(Fetch('FTP-login', bad, os.path.join(folder, 'login.zip'), manifestPath, **quick), 'failed', None, 1)
+    finally:
+        http.Stop()
+        ftp.Stop()
+
+    # Workers in other processes don't lose each other's manifest entries
+    pool = multiprocessing.Pool(4)
+    try:
+        pool.map(ManifestWorker, [(manifestPath, worker, 25) for worker in range(4)])
+    finally:
+        pool.close()
+        pool.join()
+    manifest = LoadManifest(manifestPath)
+    assert all('%d-%d' % (worker, i) in manifest for worker in range(4) for i in range(25))
+    shutil.rmtree(folder)
+    print 'Downloader self test passed'
+
+if __name__ == '__main__':
+    SelfTest()
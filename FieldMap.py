@@ -0,0 +1,337 @@
+"""
+Name:     FieldMap.py
+Purpose:  Declarative field mapping for each jurisdiction
+
+          Each jurisdiction has a list of (temp field, source) pairs. CalculateFields fills
+          every temp field for a row in a single cursor pass instead of one CalculateField
+          call (one full table scan and rewrite) per field.
+
+          Normalize goes one step further - the output is created once with exactly the temp
+          field schema and the mapped rows are streamed into it from the source, so there is
+          no AddField for the temp fields and no DeleteField for the source fields. Rows are
+          mapped Batch at a time, so the house number and street of a SplitAddress field come
+          from one Address.Split() of the whole batch rather than two splits of every address.
+
+"""
+
+import datetime, itertools, time
+import Address
+from Backends import Shape
+
+## Rows mapped at a time by Normalize
+Batch = 1000
+
+## SplitAddress parts
+HousePart = 0
+StreetPart = 1
+
+############################################################################################
+
+class Field(object):
+    # Copy a source field
+    def __init__(self, name):
+        self.name = name
+        self.fields = [name]
+
+    def __call__(self, values):
+        return values[self.name]
+
+class Const(object):
+    # Same value for every row
+    def __init__(self, value):
+        self.value = value
+        self.fields = []
+
+    def __call__(self, values):
+        return self.value
+
+class Today(object):
+    # Today's date as format, taken when the mapping is run (Bind()) - not at import, which
+    # would stamp a long running process with the day it started
+    def __init__(self, format):
+        self.format = format
+        self.fields = []
+
+    def __call__(self, values):
+        return datetime.datetime.today().strftime(self.format)
+
+class Expr(object):
+    # Python function of one or more source fields
+    def __init__(self, func, *fields):
+        self.func = func
+        self.fields = list(fields)
+
+    def __call__(self, values):
+        return self.func(*[values[field] for field in self.fields])
+
+def Text(value):
+    # Numbers written to a TEXT field as CalculateField did - a Long house number reads 123 and
+    # NN's Double HouseNo 123.0, so last month's parcels don't all show as changed
+    if value is None:
+        return ''
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    return value
+
+def HouseNumber(FIELD):
+    # Same as '!LOCADDR!.split(" ")[0]' - empty for a null address (unjoined NKC parcels)
+    return Text(FIELD).split(" ")[0]
+
+def Street(FIELD):
+    # Same as the old codeblock_Street
+    x = Text(FIELD).split(" ")
+    x.remove(x[0])
+    y = " ".join(x)
+    return y
+
+class SplitAddress(object):
+    # House number (HousePart) or street (StreetPart) of an address field - HouseNumber() /
+    # Street() row by row, one Address.Split() per batch in MapBatch()
+    def __init__(self, name, part):
+        self.name = name
+        self.part = part
+        self.fields = [name]
+
+    def __call__(self, values):
+        return (HouseNumber, Street)[self.part](values[self.name])
+
+def Concat(first, second):
+    # Number plus suffix/apartment, e.g. STRTNUMB + NUMBSUFX
+    return Text(first) + Text(second)
+
+############################################################################################
+
+FieldMaps = {
+    'WB': [
+        ('_Parcel_ID_',    Field('PID')),
+        ('_Legal_Desc_',   Field('LUCat')),
+        ('_Info_Source_',  Const('Williamsburg GIS Website')),
+        ],
+    'YC': [
+        ('_Parcel_ID_',    Field('GPIN')),
+        ('_Name_Owner_',   Field('OWNERSNAME')),
+        ('_HouseNumber_',  SplitAddress('LOCADDR', HousePart)),
+        ('_Street_',       SplitAddress('LOCADDR', StreetPart)),    # or STRTNAME
+        ('_Sub_Name_',     Field('SUBDIVISION')),
+        ('_Legal_Desc_',   Field('TABLDIST_DESC')),             # or LEGLDESC
+        ('_Info_Source_',  Const('York County GIS Manager')),
+        ],
+    'POQ': [
+        ('_Parcel_ID_',    Field('MAP_PIN')),
+        ('_Name_Owner_',   Field('OWNRNAME')),
+        ('_HouseNumber_',  Expr(Concat, 'STRTNUMB', 'NUMBSUFX')),  # Long + Apt number
+        ('_Street_',       Field('STRTNAME')),
+        ('_Sub_Name_',     Field('PROPDESC')),
+        ('_Legal_Desc_',   Field('LEGLDESC')),
+        ('_Info_Source_',  Const('Poquoson Assessor Office')),
+        ],
+    'NN': [
+        ('_Parcel_ID_',    Field('REISID')),
+        ('_Name_Owner_',   Field('OwnerNam')),
+        ('_HouseNumber_',  Expr(Concat, 'HouseNo', 'Apt')),     # Double + Apt number
+        ('_Street_',       Field('Street')),
+        ('_Sub_Name_',     Field('SubdivName')),
+        ('_Legal_Desc_',   Field('LeglDesc')),
+        ('_Info_Source_',  Const('NN Dept of Engineering')),
+        ],
+    'JCC': [
+        ('_Parcel_ID_',    Field('PIN')),
+        ('_HouseNumber_',  SplitAddress('LOCADDR', HousePart)),
+        ('_Street_',       SplitAddress('LOCADDR', StreetPart)),
+        ('_Sub_Name_',     Field('SUBNAME')),                   # might need to remove
+        ('_Legal_Desc_',   Field('Legal1')),
+        ('_Info_Source_',  Const('James City County GIS Website')),
+        ],
+    'HAM': [
+        ('_Parcel_ID_',    Field('LRSNTXT')),
+        ('_HouseNumber_',  SplitAddress('SITUS', HousePart)),
+        ('_Street_',       SplitAddress('SITUS', StreetPart)),      # or FRONT_ST
+        ('_Sub_Name_',     Field('Sub_Div')),
+        ('_Info_Source_',  Const('Hampton IT GIS')),
+        ],
+    'NKC': [
+        ('_Parcel_ID_',    Field('GPIN')),
+        ('_Name_Owner_',   Field('REM_OWN_NAME')),
+        ('_HouseNumber_',  SplitAddress('REM_PRCL_LOCN', HousePart)),
+        ('_Street_',       SplitAddress('REM_PRCL_LOCN', StreetPart)),
+        ('_Sub_Name_',     Field('SUBDIVISION')),
+        ('_Legal_Desc_',   Field('VNS_STYLE_DESC')),
+        ('_Info_Source_',  Const('New Kent County GIS')),
+        ],
+    }
+
+## RealPropertyParcel fields (name, type, length) - same as AlterFields()
+FinalSchema = [('Parcel_ID',   'TEXT',   50),
+               ('Name_Owner',  'TEXT',   150),
+               ('HouseNumber', 'TEXT',   50),
+               ('Street',      'TEXT',   50),
+               ('City_Loc',    'TEXT',   50),
+               ('State',       'TEXT',   20),
+               ('Zip_Code',    'TEXT',   10),
+               ('Square_Feet', 'DOUBLE', 20),
+               ('Acres_US',    'DOUBLE', 20),
+               ('Sub_Name',    'TEXT',   150),
+               ('Legal_Desc',  'TEXT',   150),
+               ('Info_Source', 'TEXT',   50),
+               ('EditDate',    'TEXT',   10),
+               ('EditBy',      'TEXT',   50)]
+
+## Temp fields have the same types and lengths (AddTempFieldsTo()) - _Parcel_ID_ etc.
+TempSchema = [('_' + name + '_', fieldType, length) for name, fieldType, length in FinalSchema]
+
+## Temp fields --> RealPropertyParcel, the CalculateField expressions of AlterFields().
+## Square_Feet and Acres_US come from the shape (Pipeline.Areas), HouseNumber and Street
+## from FixHouseNo/FixStreet over whole columns (Pipeline.Addresses).
+FinalMap = [
+    ('Parcel_ID',    Field('_Parcel_ID_')),
+    ('Name_Owner',   Field('_Name_Owner_')),
+    ('City_Loc',     Field('_City_Loc_')),
+    ('State',        Const('VA')),
+    ('Zip_Code',     Field('_Zip_Code_')),
+    ('Sub_Name',     Field('_Sub_Name_')),
+    ('Legal_Desc',   Field('_Legal_Desc_')),
+    ('Info_Source',  Field('_Info_Source_')),
+    ('EditDate',     Today('%Y%m%d')),    # codeblock_Date
+    ('EditBy',       Const('bkingery')),
+    ]
+
+############################################################################################
+
+def CursorFields(mapping):
+    # Temp fields first, then any source fields they read from
+    fields = []
+    for target, source in mapping:
+        if target not in fields:
+            fields.append(target)
+    for target, source in mapping:
+        for field in source.fields:
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+def Bind(mapping):
+    # mapping with each Today fixed to the date it is run on
+    return [(target, Const(source(None)) if isinstance(source, Today) else source) for target, source in mapping]
+
+def MapRow(mapping, values):
+    for target, source in mapping:
+        values[target] = source(values)
+    return values
+
+def MapBatch(mapping, batch):
+    # MapRow() of each of batch, every SplitAddress field split once for the whole batch
+    splits = {}
+    for target, source in mapping:
+        if isinstance(source, SplitAddress) and source.name not in splits:
+            splits[source.name] = Address.Split([Text(values[source.name]) for values in batch])
+    for i, values in enumerate(batch):
+        for target, source in mapping:
+            if isinstance(source, SplitAddress):
+                values[target] = splits[source.name][source.part][i]
+            else:
+                values[target] = source(values)
+    return batch
+
+def CalculateFields(table, key, backend=None):
+    if backend is None:
+        import Backends
+        backend = Backends.ArcpyBackend()
+    mapping = Bind(FieldMaps[key])
+    fields = CursorFields(mapping)
+
+    def Fill(row):
+        values = MapRow(mapping, dict(zip(fields, row)))
+        return [values[field] for field in fields]
+
+    start = time.time()
+    count = backend.UpdateRows(table, fields, Fill)
+    elapsed = time.time() - start
+    rate = count / elapsed if elapsed else 0.0
+    print '\t%s: %d rows in %.1f s (%.0f rows/sec)' % (key, count, elapsed, rate)
+    return count, elapsed
+
+def SourceFields(mapping):
+    # Source fields read by the mapping, in order
+    fields = []
+    for target, source in mapping:
+        for field in source.fields:
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+def Normalize(source, output, key, schema, backend=None, reader=None, template=None):
+    # schema = [(name, type, length)] - output has these fields and nothing else. source is
+    # read with reader (default backend, or a ZipSource reader) and template gives output its
+    # spatial reference (default source).
+    if backend is None:
+        import Backends
+        backend = Backends.ArcpyBackend()
+    if reader is None:
+        reader = backend
+        if template is None:
+            template = source
+    mapping = Bind(FieldMaps[key])
+    reads = SourceFields(mapping) + [Shape]
+    writes = [name for name, fieldType, length in schema] + [Shape]
+
+    start = time.time()
+    backend.CreateTable(output, schema, template)
+    rows = reader.Search(source, reads)
+    with backend.Writer(output, writes) as writer:
+        while True:
+            batch = [dict(zip(reads, row)) for row in itertools.islice(rows, Batch)]
+            if not batch:
+                break
+            for values in MapBatch(mapping, batch):
+                writer.Write([values.get(field) for field in writes])
+    elapsed = time.time() - start
+    rate = writer.count / elapsed if elapsed else 0.0
+    print '\t%s: %d rows in %.1f s (%.0f rows/sec)' % (key, writer.count, elapsed, rate)
+    return writer.count, elapsed
+
+############################################################################################
+
+def SyntheticSource(backend, table, key, rows=100000, extraFields=60):
+    # A wide source table like NN/YC - the fields the mapping reads plus extraFields others
+    import random
+    random.seed(1)
+    fields = SourceFields(FieldMaps[key])
+    schema = [(field, 'TEXT', 50) for field in fields] + [('EXTRA_%d' % i, 'TEXT', 50) for i in range(extraFields)]
+    backend.CreateTable(table, schema)
+    def Rows():
+        for i in range(rows):
+            x, y = (i % 1000) * 100.0, (i // 1000) * 100.0
+            ring = [(x, y), (x, y + 90.0), (x + 90.0, y + 90.0), (x + 90.0, y), (x, y)]
+            values = ['%d %s ST' % (random.randint(1, 9999), random.choice('ABCDEFG')) for field in fields]
+            yield values + ['x' * 20] * extraFields + [[ring]]
+    backend.Insert(table, [name for name, fieldType, length in schema] + [Shape], Rows())
+    return table
+
+def CompareSchemaApproaches(workspace, key='NN', rows=100000, extraFields=60, schema=None):
+    # Times AddField + CalculateFields + DeleteField (FieldCalc()) against Normalize on a
+    # synthetic wide table in workspace (a scratch file geodatabase)
+    import arcpy, Backends
+    backend = Backends.ArcpyBackend()
+    if schema is None:
+        schema = TempSchema
+    source = SyntheticSource(backend, workspace + '/Synthetic_' + key, key, rows, extraFields)
+    names = [name for name, fieldType, length in schema]
+
+    start = time.time()
+    old = workspace + '/Synthetic_' + key + '_Old'
+    arcpy.CopyFeatures_management(source, old)
+    for name, fieldType, length in schema:
+        arcpy.AddField_management(old, name, fieldType, "", "", length)
+    CalculateFields(old, key, backend)
+    for field in arcpy.ListFields(old):
+        if not field.required and field.name not in names:
+            arcpy.DeleteField_management(old, field.name)
+    oldTime = time.time() - start
+
+    start = time.time()
+    Normalize(source, workspace + '/Synthetic_' + key + '_New', key, schema, backend)
+    newTime = time.time() - start
+
+    print 'Add/calculate/delete fields: %.1f s' % oldTime
+    print 'Schema first:                %.1f s (%.1fx)' % (newTime, oldTime / newTime if newTime else 0.0)
+    return oldTime, newTime
@@ -0,0 +1,273 @@
+"""
+Name:     Geometry.py
+Purpose:  Plain Python polygon helpers shared by the parcel update stages
+
+          A polygon is a list of rings and a ring is a list of (x, y) tuples, first point
+          repeated at the end the same as a shapefile. Outer rings are clockwise, holes are
+          counterclockwise.
+
+          PackedAreas() is the area of many polygons at once from packed coordinates (the
+          Columnar layout) - one shoelace pass over every vertex with NumPy, a loop without.
+          Areas come out in map units; SquareFeetPerSquareUnit() converts them the way arcpy's
+          SQUAREFEET does, from the layer's linear unit (US survey feet for the state plane data).
+
+"""
+
+import array, hashlib, json, random, re, struct, time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SquareFeetPerAcre = 43560.0
+
+## SQUAREFEET / ACRES in arcpy are international feet, the state plane data is in US survey feet
+MetersPerFoot = 0.3048
+MetersPerUSFoot = 1200.0 / 3937.0
+
+## Coordinates are rounded to this many map units (US survey feet) before fingerprinting so
+## the same parcel read from the file gdb and from sde hashes the same
+Precision = 0.01
+
+############################################################################################
+
+def Quantize(rings, precision=Precision):
+    return [[(int(round(x / precision)), int(round(y / precision))) for x, y in ring] for ring in rings]
+
+def Fingerprint(rings, precision=Precision):
+    # Same polygon --> same fingerprint, regardless of where it was read from
+    sha = hashlib.sha1()
+    for ring in Quantize(rings or [], precision):
+        # One pack per ring - the same bytes as a pack per point
+        sha.update(struct.pack('<I%dq' % (2 * len(ring)), len(ring), *[v for point in ring for v in point]))
+    return sha.hexdigest()
+
+def Area(rings):
+    # Signed planar area of all rings in map units - negative for clockwise outer rings
+    area = 0.0
+    for ring in rings or []:
+        if not ring:
+            continue
+        x0, y0 = ring[0]
+        for i in range(1, len(ring) - 1):
+            x1, y1 = ring[i]
+            x2, y2 = ring[i + 1]
+            area += (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    return area / 2.0
+
+def Centroid(rings):
+    # Area weighted centroid of all rings - holes wind the other way so they subtract.
+    # Worked relative to the first vertex to keep precision with state plane coordinates.
+    points = [point for ring in rings or [] for point in ring]
+    if not points:
+        return None
+    x0, y0 = points[0]
+    area = cx = cy = 0.0
+    for ring in rings:
+        for i in range(len(ring) - 1):
+            x1, y1 = ring[i][0] - x0, ring[i][1] - y0
+            x2, y2 = ring[i + 1][0] - x0, ring[i + 1][1] - y0
+            cross = x1 * y2 - x2 * y1
+            area += cross
+            cx += (x1 + x2) * cross
+            cy += (y1 + y2) * cross
+    if area == 0.0:
+        # Degenerate - average the vertices
+        return (sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points))
+    return (x0 + cx / (3.0 * area), y0 + cy / (3.0 * area))
+
+def Pack(rings):
+    # <ring count> then <point count><x y x y ...> for each ring
+    if rings is None:
+        return None
+    data = [struct.pack('<I', len(rings))]
+    for ring in rings:
+        data.append(struct.pack('<I', len(ring)))
+        data.append(struct.pack('<%dd' % (2 * len(ring)), *[v for point in ring for v in point]))
+    return ''.join(data)
+
+def Unpack(data):
+    if data is None:
+        return None
+    data = str(data)
+    count, = struct.unpack_from('<I', data, 0)
+    offset = 4
+    rings = []
+    for i in range(count):
+        points, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        values = struct.unpack_from('<%dd' % (2 * points), data, offset)
+        offset += 16 * points
+        rings.append(zip(values[0::2], values[1::2]))
+    return rings
+
+############################################################################################
+
+def MetersPerUnit(wkt):
+    # Linear unit of a projected coordinate system's well known text. No spatial reference is
+    # taken to be feet, as the synthetic data is.
+    if not wkt:
+        return MetersPerFoot
+    if not wkt.startswith('PROJCS'):
+        raise ValueError('Not projected - areas need state plane coordinates')
+    name, meters = re.findall(r'UNIT\["([^"]+)",\s*([0-9.eE+-]+)', wkt)[-1]
+    return float(meters)
+
+def SameCoordinates(wkt, other):
+    # False only when both are known and are different coordinate systems - the XY
+    # resolution and tolerance after the ';' of exportToString() don't move anything
+    if not wkt or not other:
+        return True
+    return wkt.split(';')[0].strip() == other.split(';')[0].strip()
+
+def SquareFeetPerSquareUnit(metersPerUnit):
+    # 1.000004 for US survey feet - what getArea('PLANAR', 'SQUAREFEET') multiplies by
+    return (metersPerUnit / MetersPerFoot) ** 2
+
+## SquareFeetPerSquareUnit() of each well known text RingAreas() has seen
+Factors = {}
+
+def RingAreas(rings, wkt=None):
+    # (square feet, acres) of rings in the units of wkt, as getArea('PLANAR', ...) gives them
+    factor = Factors.get(wkt)
+    if factor is None:
+        factor = Factors[wkt] = SquareFeetPerSquareUnit(MetersPerUnit(wkt))
+    sqft = abs(Area(rings)) * factor
+    return (sqft, sqft / SquareFeetPerAcre)
+
+def PackedAreas(coords, ringPoints, rowRings):
+    # Unsigned planar area of every row in map units, holes taken out.
+    # coords     = x, y, x, y, ... of every ring, first point repeated at the end
+    # ringPoints = first point of each ring, plus one past the last point
+    # rowRings   = first ring of each row, plus one past the last ring
+    # Each ring is worked relative to its first vertex, the same as Area().
+    if numpy is None:
+        areas = []
+        for r in range(len(rowRings) - 1):
+            total = 0.0
+            for k in range(rowRings[r], rowRings[r + 1]):
+                a, b = ringPoints[k], ringPoints[k + 1]
+                x0, y0 = coords[2 * a], coords[2 * a + 1]
+                for i in range(a + 1, b - 1):
+                    total += (coords[2 * i] - x0) * (coords[2 * i + 3] - y0) - (coords[2 * i + 2] - x0) * (coords[2 * i + 1] - y0)
+            areas.append(abs(total) / 2.0)
+        return areas
+    xy = Numbers(coords, 'd').reshape(-1, 2)
+    ringPoints = Numbers(ringPoints, 'I').astype('i8')
+    rowRings = Numbers(rowRings, 'I').astype('i8')
+    rings, rows = len(ringPoints) - 1, len(rowRings) - 1
+    if len(xy) < 2:
+        return [0.0] * rows
+    counts = numpy.diff(ringPoints)
+    starts = numpy.minimum(ringPoints[:-1], len(xy) - 1)
+    ringOf = numpy.repeat(numpy.arange(rings), counts)
+    dx = xy[:, 0] - numpy.repeat(xy[starts, 0], counts)
+    dy = xy[:, 1] - numpy.repeat(xy[starts, 1], counts)
+    # Each vertex with the next one, only within a ring
+    cross = numpy.where(ringOf[:-1] == ringOf[1:], dx[:-1] * dy[1:] - dx[1:] * dy[:-1], 0.0)
+    ringAreas = numpy.bincount(ringOf[:-1], weights=cross, minlength=rings)
+    rowOf = numpy.repeat(numpy.arange(rows), numpy.diff(rowRings))
+    return (numpy.abs(numpy.bincount(rowOf, weights=ringAreas, minlength=rows)) / 2.0).tolist()
+
+def Numbers(values, typecode):
+    # NumPy array of values - a view when they are already an array of typecode (Columnar)
+    if isinstance(values, array.array) and values.typecode == typecode:
+        return numpy.frombuffer(values, {'d': 'f8', 'I': 'u4'}[typecode])
+    return numpy.asarray(values, {'d': 'f8', 'I': 'i8'}[typecode])
+
+def Packed(polygons):
+    # (coords, ringPoints, rowRings) arrays of a list of polygons
+    coords, ringPoints, rowRings = array.array('d'), array.array('I', [0]), array.array('I', [0])
+    for rings in polygons:
+        for ring in rings or []:
+            coords.extend([v for point in ring for v in point])
+            ringPoints.append(len(coords) // 2)
+        rowRings.append(len(ringPoints) - 1)
+    return coords, ringPoints, rowRings
+
+############################################################################################
+
+def RecordAreas(backend, table, path, limit=1000):
+    # Fixture for CheckAreas() - rings of the first limit polygons with the areas backend
+    # reports for them (ArcpyBackend = arcpy's getArea), and the layer's linear unit
+    wkt = None
+    if hasattr(backend, 'SpatialReference'):
+        spatialReference = backend.SpatialReference(table)
+        wkt = spatialReference.exportToString() if hasattr(spatialReference, 'exportToString') else spatialReference
+    parcels = []
+    for shape, in backend.Search(table, ['SHAPE@']):
+        if shape is None:
+            continue
+        sqft, acres = backend.Areas(shape, wkt)
+        parcels.append({'rings': backend.Rings(shape), 'square_feet': sqft, 'acres': acres})
+        if len(parcels) >= limit:
+            break
+    with open(path, 'w') as f:
+        json.dump({'table': table, 'meters_per_unit': MetersPerUnit(wkt), 'parcels': parcels}, f)
+    return len(parcels)
+
+def CheckAreas(path, tolerance=0.005):
+    # PackedAreas() against a RecordAreas() fixture. tolerance in square feet, or a billionth
+    # of the area for very large parcels. Returns the parcels outside it.
+    with open(path) as f:
+        fixture = json.load(f)
+    factor = SquareFeetPerSquareUnit(fixture['meters_per_unit'])
+    areas = PackedAreas(*Packed([parcel['rings'] for parcel in fixture['parcels']]))
+    wrong = []
+    for parcel, area in zip(fixture['parcels'], areas):
+        sqft = area * factor
+        if abs(sqft - parcel['square_feet']) > max(tolerance, parcel['square_feet'] * 1e-9) or \
+           abs(sqft / SquareFeetPerAcre - parcel['acres']) > max(tolerance, parcel['square_feet'] * 1e-9) / SquareFeetPerAcre:
+            wrong.append((parcel['square_feet'], sqft))
+    print '%s: %d of %d parcels within %.3f sq ft' % (path, len(areas) - len(wrong), len(areas), tolerance)
+    return wrong
+
+def AreaSelfTest(polygons=2000, seed=1):
+    # Squares with holes of known area, and PackedAreas() against Area() on random polygons
+    wkt = 'PROJCS["NAD_1983_StatePlane_Virginia_South_FIPS_4502_Feet",UNIT["Foot_US",0.3048006096012192]]'
+    assert abs(MetersPerUnit(wkt) - MetersPerUSFoot) < 1e-15
+    outer = [(0.0, 0.0), (0.0, 100.0), (100.0, 100.0), (100.0, 0.0), (0.0, 0.0)]
+    hole = [(10.0, 10.0), (20.0, 10.0), (20.0, 20.0), (10.0, 20.0), (10.0, 10.0)]
+    offset = [[(x + 12000000.0, y + 3500000.0) for x, y in ring] for ring in (outer, hole)]
+    areas = PackedAreas(*Packed([[outer, hole], offset, None, [outer]]))
+    assert areas == [9900.0, 9900.0, 0.0, 10000.0], areas
+    sqft = 9900.0 * SquareFeetPerSquareUnit(MetersPerUnit(wkt))
+    assert abs(sqft - 9900.0396) < 0.0001, sqft
+
+    rng = random.Random(seed)
+    shapes = [RandomPolygon(rng) for i in range(polygons)]
+    for area, rings in zip(PackedAreas(*Packed(shapes)), shapes):
+        assert abs(area - abs(Area(rings))) <= 1e-6 * max(1.0, area), (area, Area(rings))
+    print 'Area self test passed (%s)' % ('NumPy' if numpy is not None else 'pure Python')
+
+def RandomPolygon(rng, vertices=20, radius=50.0):
+    # Clockwise star shaped ring in state plane range, sometimes with a hole
+    import math
+    x, y = rng.uniform(11e6, 13e6), rng.uniform(3e6, 4e6)
+    step = 2 * math.pi / vertices
+    ring = [(x + radius * rng.uniform(0.5, 1.0) * math.cos(-k * step),
+             y + radius * rng.uniform(0.5, 1.0) * math.sin(-k * step)) for k in range(vertices)]
+    rings = [ring + ring[:1]]
+    if rng.random() < 0.2:
+        hole = [(x + 5 * math.cos(k * step), y + 5 * math.sin(k * step)) for k in range(vertices)]
+        rings.append(hole + hole[:1])
+    return rings
+
+def AreaBenchmark(vertices=5000000, seed=1):
+    # PackedAreas() against Area() one polygon at a time, on about vertices vertices
+    rng = random.Random(seed)
+    shapes = [RandomPolygon(rng) for i in range(vertices // 22)]
+    packed = Packed(shapes)
+    count = len(packed[0]) // 2
+    start = time.time()
+    PackedAreas(*packed)
+    packedSeconds = time.time() - start
+    start = time.time()
+    for rings in shapes:
+        abs(Area(rings))
+    loopSeconds = time.time() - start
+    print '%d polygons, %d vertices' % (len(shapes), count)
+    print '\tPackedAreas (%s) %6.2f s %12.0f vertices/sec' % ('NumPy' if numpy is not None else 'Python', packedSeconds, count / packedSeconds)
+    print '\tArea() per polygon %6.2f s %12.0f vertices/sec' % (loopSeconds, count / loopSeconds)
+    return packedSeconds, loopSeconds
@@ -0,0 +1,280 @@
+"""
+Name:     Instrument.py
+Purpose:  Stage timing, row counts, I/O, memory and errors for every step of the update
+
+          @Instrument.Stage(inputs=..., outputs=...) wraps a function. Each call appends one JSON
+          line to ReportPath with the stage name, duration, input/output row counts (Counter),
+          bytes read/written by the process, peak memory and the error if there was one.
+          Functions that catch their own errors call Instrument.Error(message) so the stage is
+          still reported as failed.
+
+          Summary() and EmailBody() are built from the report file, so stages run by the
+          Scheduler worker processes are included. The file is appended to by every rerun of
+          the day (Resume()), so Load() keeps only the latest record of each stage - a stage
+          that failed and then passed on the rerun is reported as passed.
+
+          Profiling - set Instrument.Profile = ['AlterFields'] (or the PARCEL_PROFILE environment
+          variable to "AlterFields,MergeParcels") and those stages run under cProfile, with a
+          tracemalloc snapshot when it is available. Stats are saved next to the report.
+
+"""
+
+import datetime, functools, json, os, sys, time, traceback
+
+## NDJSON report - None keeps records in memory only
+ReportPath = None
+
+## Function (table) --> row count or None, set by the caller (arcpy GetCount, Backend.Count, ...)
+Counter = None
+
+## Stage names to profile
+Profile = [name for name in os.environ.get('PARCEL_PROFILE', '').split(',') if name]
+
+## Records of this process
+Records = []
+
+## Stages currently running, innermost last
+Running = []
+
+############################################################################################
+
+def PeakRSS():
+    # Peak resident memory of this process in MB so far, None if it can't be read
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / (1024.0 * 1024.0)
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+        class Counters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / (1024.0 * 1024.0)
+    except Exception:
+        return None
+
+def IOCounters():
+    # (bytes read, bytes written) by this process so far, None if they can't be read
+    try:
+        import psutil
+        io = psutil.Process().io_counters()
+        return (io.read_bytes, io.write_bytes)
+    except Exception:
+        pass
+    if os.path.exists('/proc/self/io'):
+        values = {}
+        for line in open('/proc/self/io'):
+            name, value = line.split(':')
+            values[name] = int(value)
+        return (values.get('rchar', 0), values.get('wchar', 0))
+    try:
+        import ctypes
+        class Counters(ctypes.Structure):
+            _fields_ = [(name, ctypes.c_ulonglong) for name in ('ReadOperationCount', 'WriteOperationCount',
+                        'OtherOperationCount', 'ReadTransferCount', 'WriteTransferCount', 'OtherTransferCount')]
+        counters = Counters()
+        ctypes.windll.kernel32.GetProcessIoCounters(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters))
+        return (counters.ReadTransferCount, counters.WriteTransferCount)
+    except Exception:
+        return None
+
+def Count(tables):
+    # {table: rows} using Counter, None for tables that can't be counted
+    counts = {}
+    for table in tables or []:
+        try:
+            counts[table] = Counter(table) if Counter else None
+        except Exception:
+            counts[table] = None
+    return counts
+
+############################################################################################
+
+def Error(message):
+    # Marks the running stage failed without raising - for the functions that catch their own errors
+    print message
+    if Running:
+        Running[-1].setdefault('errors', []).append(message)
+
+def Write(record):
+    Records.append(record)
+    if not ReportPath:
+        return
+    folder = os.path.dirname(ReportPath)
+    if folder and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass # another process made it first
+    with open(ReportPath, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def Profiled(name, func, args, kwargs, record):
+    # func run under cProfile (and tracemalloc if there is one), stats saved next to the report
+    import cProfile, pstats
+    folder = os.path.dirname(ReportPath) if ReportPath else os.getcwd()
+    stamp = datetime.datetime.now().strftime('%H%M%S')
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, '%s_%s.prof' % (name, stamp))
+        profile.dump_stats(path)
+        record['profile'] = path
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
+        if tracemalloc is not None:
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            record['tracemalloc'] = [str(line) for line in top]
+            tracemalloc.stop()
+
+def Stage(name=None, inputs=None, outputs=None):
+    # inputs / outputs are functions returning the tables to count, called when the stage
+    # starts / ends so they see paths set at run time (RunJurisdiction)
+    def Decorate(func):
+        stage = name or func.__name__
+
+        @functools.wraps(func)
+        def Run(*args, **kwargs):
+            record = {'stage': stage, 'pid': os.getpid(),
+                      'parent': Running[-1]['stage'] if Running else None,
+                      'start': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+            if args:
+                record['args'] = [str(arg) for arg in args]
+            if inputs:
+                record['input_rows'] = Count(inputs())
+            io = IOCounters()
+            start = time.time()
+            Running.append(record)
+            try:
+                if stage in Profile:
+                    return Profiled(stage, func, args, kwargs, record)
+                return func(*args, **kwargs)
+            except Exception as e:
+                record['exception'] = '%s: %s' % (e.__class__.__name__, e)
+                record['traceback'] = traceback.format_exc()
+                raise
+            finally:
+                Running.pop()
+                record['seconds'] = round(time.time() - start, 3)
+                after = IOCounters()
+                if io and after:
+                    record['bytes_read'] = after[0] - io[0]
+                    record['bytes_written'] = after[1] - io[1]
+                record['peak_rss_mb'] = PeakRSS()
+                if outputs:
+                    record['output_rows'] = Count(outputs())
+                record['status'] = 'failed' if record.get('exception') or record.get('errors') else 'ok'
+                Write(record)
+        return Run
+    return Decorate
+
+############################################################################################
+
+def Load(path=None, latest=True):
+    # Records from the report file, or this process's records if there is no file. With latest
+    # only the last record of each stage (and its args) is kept, in the order they finished.
+    path = path or ReportPath
+    if not path or not os.path.exists(path):
+        records = list(Records)
+    else:
+        records = []
+        for line in open(path):
+            if line.strip():
+                records.append(json.loads(line))
+    return Latest(records) if latest else records
+
+def Latest(records):
+    last = {}
+    for i, r in enumerate(records):
+        last[(r['stage'], tuple(r.get('args') or ()))] = i
+    return [r for i, r in enumerate(records) if last[(r['stage'], tuple(r.get('args') or ()))] == i]
+
+def Rows(counts):
+    if not counts:
+        return ''
+    known = [v for v in counts.values() if v is not None]
+    return '%d' % sum(known) if known else '?'
+
+def Summary(records=None):
+    # Stages in the order they finished, one line each, failures with their errors
+    records = Load() if records is None else records
+    lines = []
+    failed = [r for r in records if r['status'] == 'failed']
+    lines.append('%d stages, %d failed' % (len(records), len(failed)))
+    for r in records:
+        stage = r['stage'] + ('(%s)' % ', '.join(r['args']) if r.get('args') else '')
+        line = '%-7s %-24s %8.1f s' % (r['status'].upper(), stage, r['seconds'])
+        if r.get('input_rows'):
+            line += '  in %s' % Rows(r['input_rows'])
+        if r.get('output_rows'):
+            line += '  out %s' % Rows(r['output_rows'])
+        if r.get('bytes_written') is not None:
+            line += '  wrote %.1f MB' % (r['bytes_written'] / (1024.0 * 1024.0))
+        if r.get('peak_rss_mb') is not None:
+            line += '  peak %.0f MB' % r['peak_rss_mb']
+        lines.append(line)
+        if r.get('join'):
+            lines.append('        join: %(matched)d matched, %(unmatched)d unmatched, %(duplicate_table_keys)d duplicate keys' % r['join'])
+        if r.get('merge'):
+            lines.append('        merge: %(duplicates)d duplicate parcel IDs, %(resolved)d dropped (%(policy)s)' % r['merge'])
+        if r.get('cache'):
+            cache = r['cache']
+            lines.append('        cache: %d hits, %d misses, %.1f%% hit rate' % (cache['hits'], cache['misses'], 100 * cache['hit_rate']))
+        if r.get('overlap'):
+            lines.append('        overlap: %(overlaps)d overlapping parcels (%(overlap_square_feet).0f sq ft), %(slivers)d slivers' % r['overlap'])
+        if r.get('publish'):
+            lines.append('        publish: %(rows_per_sec).0f rows/sec in batches of %(batch_size)d' % r['publish'])
+        if r.get('swap'):
+            lines.append('        swap: %(parcels)d parcels, switchover %(switchover_seconds).3f s' % r['swap'])
+        if r.get('changes'):
+            lines.append('        changes: %(added)d added, %(retired)d retired, %(renamed)d renamed, %(geometry)d reshaped, '
+                         '%(owner)d new owners, %(address)d new addresses' % r['changes'])
+        if r.get('archive'):
+            lines.append('        archive: %(rows)d parcels, %(new_objects)d new objects, dedup ratio %(dedup_ratio).1f' % r['archive'])
+        if r.get('restore'):
+            lines.append('        restore: %(rows)d parcels, %(rows_per_sec).0f rows/sec' % r['restore'])
+        if r.get('rest'):
+            lines.append('        rest: %(features)d features, %(pages)d pages, %(features_per_sec).0f features/sec, %(retries)d retries' % r['rest'])
+        for error in r.get('errors', []):
+            lines.append('        ' + error)
+        if r.get('exception'):
+            lines.append('        ' + r['exception'])
+    return '\n'.join(lines)
+
+def Failed(records=None):
+    records = Load() if records is None else records
+    return [r for r in records if r['status'] == 'failed']
+
+def EmailBody(records=None):
+    records = Load() if records is None else records
+    if not records:
+        return 'Parcel update operation successful'
+    if Failed(records):
+        heading = 'Parcel update finished with %d failed stage(s)' % len(Failed(records))
+    else:
+        heading = 'Parcel update operation successful'
+    return heading + '\r\n\r\n' + Summary(records).replace('\n', '\r\n')
@@ -0,0 +1,79 @@
+"""
+Name:     Join.py
+Purpose:  Attribute join of a table onto parcels in one pass - no layer file, AddJoin or export
+
+          HashJoin() reads the table once into a dict keyed on its join field, then streams the
+          parcels through it and writes the joined feature class with a single insert cursor.
+          Same result as AddJoin KEEP_ALL: every parcel is kept, unmatched ones with empty
+          table fields, and the first row wins when the table repeats a key.
+
+          Used for New Kent County - CountyGIS.gdb Parcels AV_PID = VISION_CURRENT REM_PID.
+
+"""
+
+import time
+from Backends import Shape
+
+############################################################################################
+
+def Key(value):
+    # AV_PID and REM_PID aren't always the same field type - 1234, 1234.0 and ' 1234' all match
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, (int, long)):
+        return unicode(value)
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return value.strip() or None
+
+def Index(backend, table, key, fields):
+    # ({key: values}, duplicate key count) - first row of a repeated key kept
+    index = {}
+    duplicates = 0
+    for row in backend.Search(table, [key] + list(fields)):
+        k = Key(row[0])
+        if k is None:
+            continue
+        if k in index:
+            duplicates += 1
+            continue
+        index[k] = row[1:]
+    return index, duplicates
+
+def HashJoin(backend, parcels, parcelKey, parcelFields, table, tableKey, tableFields, output, schema, template=None):
+    # output gets parcelFields + tableFields (schema, in that order) and the parcel shape.
+    # Returns the counts, which are also printed.
+    start = time.time()
+    index, duplicates = Index(backend, table, tableKey, tableFields)
+    counts = {'parcels': 0, 'matched': 0, 'unmatched': 0, 'null_keys': 0,
+              'duplicate_table_keys': duplicates, 'duplicate_parcel_keys': 0}
+    empty = [None] * len(tableFields)
+    seen = set()
+
+    backend.CreateTable(output, schema, template)
+    with backend.Writer(output, list(parcelFields) + list(tableFields) + [Shape]) as writer:
+        for row in backend.Search(parcels, [parcelKey] + list(parcelFields) + [Shape]):
+            counts['parcels'] += 1
+            k = Key(row[0])
+            if k is None:
+                counts['null_keys'] += 1
+                values = empty
+            else:
+                if k in seen:
+                    counts['duplicate_parcel_keys'] += 1
+                seen.add(k)
+                values = index.get(k)
+                if values is None:
+                    counts['unmatched'] += 1
+                    values = empty
+                else:
+                    counts['matched'] += 1
+            writer.Write(list(row[1:-1]) + list(values) + [row[-1]])
+
+    elapsed = time.time() - start
+    print '\tJoined %(parcels)d parcels: %(matched)d matched, %(unmatched)d unmatched, %(null_keys)d null keys' % counts
+    print '\tDuplicate keys: %(duplicate_table_keys)d in the table, %(duplicate_parcel_keys)d in the parcels' % counts + \
+          ' (%.1f s, %.0f rows/sec)' % (elapsed, counts['parcels'] / elapsed if elapsed else 0.0)
+    return counts
@@ -41,11 +41,14 @@ County Data
 
 Order of Operations
 
+0 python MonthlyParcelUpdate.py (or Resume()) runs Start, each jurisdiction and Finish, skipping the stages
+  already done today - rerun after fixing a failure to continue where it stopped.
+  --from-stage NN, --only NN,Finish and --fresh (sets today's folder aside) as needed
 1 Start()
     - A folder of TodaysDate will be created at R:\Divisions\InfoTech\Shared\GIS\Parcels containing a file geodatabase
 2 Import data to correct CityData folder
-    - Williamsburg - Pulls data from url automatically
-    - York County - Save parcels from rest service directly to main geodatabase
+    - Williamsburg - Pulls data from url automatically, read straight from Parcels.zip
+    - York County - Paged from the AGOServices Parcels feature service automatically (see RestSource.py)
     - Poquoson - Save zipfile received from WorldView
     - Newport News - Save zipfile received from NN IT
     - James City County - Pulls data from url automatically
@@ -53,18 +56,30 @@ Order of Operations
     - New Kent County - Download CountyGIS.gdb.zip for NKC
         - Created folder in CityData folder named CountyGIS.gdb
         - Right click zip file --> Extract All... to CountyGIS.gdb folder
-        - Run NKCParcels() --> Open Arcmap --> Add .lyr and export to GDB as NKC    
+        - NKCParcels() joins Parcels to VISION_CURRENT and writes NKC itself (see Join.py)
 3 ProcessData()
 4 FieldCalc()
-    - AddTempFields()
+    - Each municipality is written with only the temp fields to a Columnar file (NormalizeParcels())
+        - Zipped sources that haven't changed since last month reuse last month's file
         - If any error messages occur, investigate and run specific function for select municipality that errored
     - SendEmail()
+3/4 ProcessParallel() can be run instead of ProcessData() and FieldCalc()
+    - Each jurisdiction runs on its own process into UpdateFolder\TodaysDate\Scratch\<key>.gdb and <key>.pcol
+    - Prints done/failed for each jurisdiction; rerun RunJurisdiction('<key>') for any that failed
 5 Finish()
-    - MergeParcels()
-    - ZipCodeJoin()
-    - CityJoin()
-    - AlterFields()
+    - Streams merge --> zip code / city --> final fields straight into RealPropertyParcel (see Pipeline.py)
+    - A Parcel_ID from two jurisdictions is listed in UpdateFolder\TodaysDate\DuplicateParcels.csv;
+      MergePolicy = 'precedence' or --merge-policy precedence keeps only the one from MergePrecedence
+    - Finish(keepIntermediates=True) or --keep-intermediates also writes Master_Parcels_<date>
+      and Master_Join_2_City for checking
+    - CheckOverlaps() lists parcels overlapping across jurisdictions in UpdateFolder\TodaysDate\OverlapParcels.csv
     - SendEmail()
+    - ArchiveParcels() once published keeps RealPropertyParcel and the sde backup in Data\Archive (see Archive.py),
+      RestoreParcels('<yyyymmdd>') rebuilds one
+    - DetectChanges() lists the parcels added, retired, renamed or changed since last month in
+      UpdateFolder\TodaysDate\ParcelChanges.csv, DetectChanges(email=True) also sends the summary
+    - Step by step instead: MergeParcels(), AssignLocation() (replaces ZipCodeJoin() and CityJoin()), AlterFields(),
+      CheckOverlaps()
 
 Final Product
 
@@ -72,13 +87,17 @@ Feature Class named RealPropertyParcel properly formatted ready to be copied to
 
 """
 
-import arcpy, datetime, os, zipfile, urllib
+import arcpy, datetime, functools, glob, os, zipfile
+import Archive, AssignmentCache, Backends, Changes, Checkpoint, Columnar, Config, Downloader, FieldMap, Geometry, Instrument, Join, Overlap, Pipeline, Publish, RestSource, SpatialIndex, Staging, ZipSource
 from arcpy import env
 
-env.workspace = r'R:\Divisions\InfoTech\Shared\GIS\Parcels'
+## Workspace, run date and switches come from Parcels.cfg (see Config.py)
+env.workspace = Config.Workspace
 env.overwriteoutput = True
 
-TodaysDate = datetime.datetime.today().strftime('%Y%m%d') # today's date in yyyymmdd format
+TodaysDate = Config.TodaysDate # today's date in yyyymmdd format, unless Parcels.cfg sets another
+
+RunFolder = Config.RunFolder
 
 ## Temporary fields are used so no duplicates cause errors when added to each feature class
 TempFields   = ['_Parcel_ID_','_Name_Owner_','_HouseNumber_','_Street_','_City_Loc_','_State_','_Zip_Code_',
@@ -103,19 +122,40 @@ CleanedParcels      = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysD
 OldParcels          = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'Parcels_' + TodaysDate + '.gdb' + os.sep + 'OLD_RealPropertyParcel_' + TodaysDate
 
 
+## Archives pulled from the web each month {key: (url, archive)}. The manifest keeps the
+## ETag/Last-Modified and SHA-256 of each so unchanged archives are not downloaded or extracted again.
+SourceArchives = {
+    'WB':  ('http://www.williamsburgva.gov/Modules/ShowDocument.aspx?documentid=3604',
+            env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'Williamsburg' + os.sep + 'Parcels.zip'),
+##    'JCC': ('ftp://property.jamescitycountyva.gov/GIS/layers/jcc_parcels.zip', ...
+    'JCC': ('ftp://property.jamescitycountyva.gov/GIS/JCC_Parcels.zip',
+            env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'JamesCityCounty' + os.sep + 'jcc_parcels.zip'),
+    }
+SourceManifest = env.workspace + os.sep + 'Data' + os.sep + 'SourceManifest.json'
+
+## Sources read straight out of their archive by NormalizeParcels() - nothing is extracted
+## or copied into the gdb first {key: (archive, member)}
+ZipArchives = {
+    'WB':  (SourceArchives['WB'][1], 'Parcels.shp'),
+    'POQ': (RunFolder + os.sep + 'CityData' + os.sep + 'Poquoson' + os.sep + 'Waterworks.zip', 'Waterworks/Waterworks.gdb/Tax_Parcels'),
+    'JCC': (SourceArchives['JCC'][1], 'JCC_Parcels.shp'),
+    'HAM': (RunFolder + os.sep + 'CityData' + os.sep + 'Hampton' + os.sep + 'Parcel.zip', 'Parcel/PropertyPolygons.shp'),
+    }
+
+## Each jurisdiction gets its own scratch geodatabase when run in parallel (ProcessParallel)
+ScratchFolder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'Scratch'
+
 ZipCodeFC   = env.workspace + os.sep + 'Data' + os.sep + 'Data.gdb' + os.sep + 'ZipCode'
 CityFC      = env.workspace + os.sep + 'Data' + os.sep + 'Data.gdb' + os.sep + 'City'
+## Packed spatial indexes of ZipCodeFC and CityFC - rebuilt automatically when Data.gdb changes
+IndexFolder = env.workspace + os.sep + 'Data' + os.sep + 'SpatialIndex'
+## Normalized zipped sources as Columnar files, kept between runs (the others go in ScratchFolder)
+NormalizedFolder = env.workspace + os.sep + 'Data' + os.sep + 'Normalized'
 
 codeblock_Date = """def Date():
     import datetime
     return datetime.datetime.today().strftime('%Y%m%d')"""
 
-codeblock_Street = """def Street(FIELD):
-    x = FIELD.split(" ")
-    x.remove(x[0])
-    y = " ".join(x)
-    return y"""
-
 ## Do not want to include HouseNo that start with 0. If this was not an issue, could do the following...
 ##def FixStreet(HouseNo, Street):
 ##    try:
@@ -146,18 +186,37 @@ codeblock_FixHouseNo = """def FixHouseNo(HouseNo):
     except:
         return "--" """
 
+## Every stage adds a line to the run report - SendEmail() sends the summary (see Instrument.py)
+Instrument.ReportPath = Config.ReportPath
+def CountRows(table):
+    if Columnar.IsColumnar(table):
+        if not os.path.exists(table):
+            return None
+        files = Columnar.ColumnarBackend()
+        try:
+            return files.Count(table)
+        finally:
+            files.Close()
+    return int(arcpy.GetCount_management(table).getOutput(0)) if arcpy.Exists(table) else None
+
+Instrument.Counter = CountRows
+
+## RealPropertyParcel and temp field schemas, and the AlterFields() mapping (see FieldMap.py)
+FinalSchema = FieldMap.FinalSchema
+TempSchema  = FieldMap.TempSchema
+FinalMap    = FieldMap.FinalMap
+
 ############################################################################################
 
+@Instrument.Stage()
 def Start():
     CreateFolder()
     CreateFileGeodatabase()
 
 def CreateFolder():
+    # Anything already in today's folder is kept - use Resume(fresh=True) to start over
     global folder
-    folder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate
-    if arcpy.Exists(folder):
-        arcpy.Delete_management(folder)
-    os.makedirs(folder)
+    folder = RunFolder
     CityData  = folder + os.sep + 'CityData'
     WBfolder  = CityData + os.sep + 'Williamsburg'
     POQfolder = CityData + os.sep + 'Poquoson'
@@ -165,26 +224,28 @@ def CreateFolder():
     JCCfolder = CityData + os.sep + 'JamesCityCounty'
     HAMfolder = CityData + os.sep + 'Hampton'
     NKCfolder = CityData + os.sep + 'NewKentCounty'
-    os.makedirs(CityData)
-    os.makedirs(WBfolder)
-    os.makedirs(POQfolder)
-    os.makedirs(NNfolder)
-    os.makedirs(JCCfolder)
-    os.makedirs(HAMfolder)
-    os.makedirs(NKCfolder)
+    for path in [folder, CityData, WBfolder, POQfolder, NNfolder, JCCfolder, HAMfolder, NKCfolder]:
+        if not os.path.exists(path):
+            os.makedirs(path)
     print 'Project Folder = ' + folder
         
 def CreateFileGeodatabase():
     global gdb
     gdb = 'Parcels_' + TodaysDate + '.gdb'
-    if arcpy.Exists(folder + os.sep + gdb):
-        arcpy.Delete_management(folder + os.sep + gdb)
-    arcpy.CreateFileGDB_management(folder, gdb)
+    if not arcpy.Exists(folder + os.sep + gdb):
+        arcpy.CreateFileGDB_management(folder, gdb)
     print 'GDB = ' + gdb
 
 ############################################################################################
     
+@Instrument.Stage()
+def FetchSources(workers=4):
+    # Download every web source at once - WBParcels()/JCCParcels() then reuse today's archives
+    return Downloader.FetchAll(SourceArchives, SourceManifest, workers)
+
+@Instrument.Stage()
 def ProcessData():
+    FetchSources()
     WBParcels()
     YCParcels()
     POQParcels()
@@ -193,37 +254,60 @@ def ProcessData():
     HAMParcels()
     NKCParcels()
 
+@Instrument.Stage()
+def ProcessParallel(workers=Config.Workers, keys=None):
+    # Replaces ProcessData() + FieldCalc() - each jurisdiction is fetched, copied and normalized
+    # in its own process and scratch geodatabase. MergeParcels() picks up the scratch outputs.
+    import Scheduler
+    status = Scheduler.Run(keys or [key for key, fetch, normalize in Jurisdictions], workers)
+    SendEmail()
+    return status
+
+@Instrument.Stage(outputs=lambda: [WB])
 def WBParcels():
+    # Read from Parcels.zip by Williamsburg()
     try:
-        WBfolder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'Williamsburg'
-        url = 'http://www.williamsburgva.gov/Modules/ShowDocument.aspx?documentid=3604'
-        WBParcels = urllib.URLopener()
-        WBZip = WBfolder + os.sep + 'Parcels.zip'
-        WBParcels.retrieve(url,WBZip)
-        with zipfile.ZipFile(WBZip, "r") as z:
-            z.extractall(WBfolder)
-        SHP = WBfolder + os.sep + 'Parcels.shp'
-        arcpy.CopyFeatures_management(SHP, WB)
-        print 'WB parcels copied to main database'
-    except:
-        print 'Check URL'
-
+        url, WBZip = SourceArchives['WB']
+        result = Downloader.Fetch('WB', url, WBZip, SourceManifest)
+        print 'WB parcels in ' + Downloader.Archive(result)
+    except Exception as e:
+        Instrument.Error('Check URL - ' + str(e))
+
+## York County AGOServices Parcels feature service layer
+YCService = 'http://maps.yorkcounty.gov/arcgis/rest/services/AGOServices/Parcels/FeatureServer/0'
+
+def RestSpatialReference(spatialReference):
+    # Layer's spatialReference from the service --> arcpy.SpatialReference
+    if not spatialReference:
+        return None
+    if spatialReference.get('wkt'):
+        return SpatialReference(spatialReference['wkt'])
+    return arcpy.SpatialReference(spatialReference.get('latestWkid') or spatialReference['wkid'])
+
+@Instrument.Stage(outputs=lambda: [YC])
 def YCParcels():
-    # Save from Rest Server
-    pass
-
+    # Only the fields the YC field map reads, paged straight into YC
+    try:
+        fields = FieldMap.SourceFields(FieldMap.FieldMaps['YC'])
+        stats = RestSource.Fetch(YCService, Backends.ArcpyBackend(), YC, fields, template=RestSpatialReference)
+        stats.pop('checksums')
+        Instrument.Running[-1]['rest'] = stats
+        print 'YC parcels saved from ' + YCService
+    except Exception as e:
+        Instrument.Error('Check York County feature service - ' + str(e))
+
+@Instrument.Stage(outputs=lambda: [POQ])
 def POQParcels():
+    # Read from Waterworks.zip by Poquoson()
     try:
-        POQfolder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'Poquoson'
-        POQZip = POQfolder + os.sep + 'Waterworks.zip'
-        with zipfile.ZipFile(POQZip, "r") as z:
-            z.extractall(POQfolder)
-        FC = POQfolder + '\Waterworks\Waterworks.gdb\Tax_Parcels'
-        arcpy.CopyFeatures_management(FC, POQ)
-        print 'POQ parcels copied to main database'
+        POQZip = ZipArchives['POQ'][0]
+        if not zipfile.is_zipfile(POQZip):
+            raise IOError(POQZip)
+        print 'POQ parcels in ' + POQZip
     except:
-        print 'Make sure Waterworks.zip is saved to POQ folder.'
+        Instrument.Error('Make sure Waterworks.zip is saved to POQ folder.')
 
+@Instrument.Stage(outputs=lambda: [NN])
 def NNParcels():
     try:
 ##        NNfolder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'NewportNews'
@@ -237,91 +321,159 @@ def NNParcels():
         
         print 'NN parcels copied to main database'
     except:
-        print 'Make sure NNParcels.zip is saved to NN folder.'    
+        Instrument.Error('Make sure NNParcels.zip is saved to NN folder.')    
 
+@Instrument.Stage(outputs=lambda: [JCC])
 def JCCParcels():
+    # Read from jcc_parcels.zip by JamesCityCounty()
     try:
-        JCCfolder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'JamesCityCounty'
-##        url = "ftp://property.jamescitycountyva.gov/GIS/layers/jcc_parcels.zip"
-        url = "ftp://property.jamescitycountyva.gov/GIS/JCC_Parcels.zip"
-        JCCParcels = urllib.URLopener()
-        JCCZip = JCCfolder + os.sep + 'jcc_parcels.zip'
-        JCCParcels.retrieve(url,JCCZip)
-        with zipfile.ZipFile(JCCZip, "r") as z:
-            z.extractall(JCCfolder)
-##        SHP = JCCfolder + os.sep + 'parcel_public.shp'
-        SHP = JCCfolder + os.sep + 'JCC_Parcels.shp'
-        arcpy.CopyFeatures_management(SHP, JCC)
-        print 'JCC parcels copied to main database'
-    except:
-        print 'Check URL' 
-
+        url, JCCZip = SourceArchives['JCC']
+        result = Downloader.Fetch('JCC', url, JCCZip, SourceManifest)
+##        SHP = 'parcel_public.shp'
+        print 'JCC parcels in ' + Downloader.Archive(result)
+    except Exception as e:
+        Instrument.Error('Check URL - ' + str(e))
+
+@Instrument.Stage(outputs=lambda: [HAM])
 def HAMParcels():
+    # Read from Parcel.zip by Hampton()
     try:
-        HAMfolder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'Hampton'
-        HAMZip = HAMfolder + os.sep + 'Parcel.zip'
-        with zipfile.ZipFile(HAMZip, "r") as z:
-            z.extractall(HAMfolder)
-        SHP = HAMfolder + os.sep + 'Parcel' + os.sep + 'PropertyPolygons.shp'
-        arcpy.CopyFeatures_management(SHP, HAM)
-        print 'HAM parcels copied to main database'
+        HAMZip = ZipArchives['HAM'][0]
+        if not zipfile.is_zipfile(HAMZip):
+            raise IOError(HAMZip)
+        print 'HAM parcels in ' + HAMZip
     except:
-        print 'Make sure Parcel.zip is saved to HAM folder.'
+        Instrument.Error('Make sure Parcel.zip is saved to HAM folder.')
         
+## New Kent County parcels and assessment table, joined on AV_PID = REM_PID by NKCParcels()
+NKCParcelsFC = RunFolder + os.sep + 'CityData' + os.sep + 'NewKentCounty' + os.sep + 'CountyGIS.gdb\Cadastral\Parcels'
+NKCTable = RunFolder + os.sep + 'CityData' + os.sep + 'NewKentCounty' + os.sep + 'CountyGIS.gdb\VISION_CURRENT'
+
+@Instrument.Stage(inputs=lambda: [NKCParcelsFC, NKCTable], outputs=lambda: [NKC])
 def NKCParcels():
+    # Only the fields the NKC field map reads, each from whichever side has it
     try:
-        NKCfolder = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'CityData' + os.sep + 'NewKentCounty'
-        CountyGISParcels = NKCfolder + os.sep + 'CountyGIS.gdb\Cadastral\Parcels'
-        ParcelLayer = arcpy.MakeFeatureLayer_management(CountyGISParcels, 'NKCParcels')
-        LayerFile = NKCfolder + os.sep + 'NKCParcels.lyr'
-        arcpy.SaveToLayerFile_management(ParcelLayer, LayerFile)
-        Table = NKCfolder + os.sep + 'CountyGIS.gdb\VISION_CURRENT'
-        arcpy.AddJoin_management(LayerFile, "AV_PID", Table, "REM_PID", "KEEP_ALL")        
-        print 'NKCParcels.lyr created and joined with VISION_CURRENT'
-        print 'Open Arcmap --> Add NKCParcels.lyr --> Export data to GDB as NKC'       
+        backend = Backends.ArcpyBackend()
+        parcelNames = set(field.name.upper() for field in arcpy.ListFields(NKCParcelsFC))
+        needed = FieldMap.SourceFields(FieldMap.FieldMaps['NKC'])
+        parcelFields = [field for field in needed if field.upper() in parcelNames]
+        tableFields = [field for field in needed if field.upper() not in parcelNames]
+        schema = backend.Schema(NKCParcelsFC, parcelFields) + backend.Schema(NKCTable, tableFields)
+        counts = Join.HashJoin(backend, NKCParcelsFC, 'AV_PID', parcelFields, NKCTable, 'REM_PID', tableFields,
+                               NKC, schema, NKCParcelsFC)
+        Instrument.Running[-1]['join'] = counts
+        print 'NKC parcels joined with VISION_CURRENT'
     except:
-        print 'Make sure CountyGIS.gdb is saved to NKC folder.'
+        Instrument.Error('Make sure CountyGIS.gdb is saved to NKC folder.')
 
 ############################################################################################
 
+@Instrument.Stage()
 def FieldCalc():
     
-    AddTempFields()
-    
     try:
         Williamsburg()
     except:
-        print 'Error Williamsburg()'
+        Instrument.Error('Error Williamsburg()')
     try:
         YorkCounty()
     except:
-        print 'Error YorkCounty()'
+        Instrument.Error('Error YorkCounty()')
     try:
         Poquoson()
     except:
-        print 'Error Poquoson()'
+        Instrument.Error('Error Poquoson()')
     try:
         NewportNews()
     except:
-        print 'Error NewportNews()'
+        Instrument.Error('Error NewportNews()')
     try:
         JamesCityCounty()
     except:
-        print 'Error JamesCityCounty()'
+        Instrument.Error('Error JamesCityCounty()')
     try:
         Hampton()
     except:
-        print 'Error Hampton()'
+        Instrument.Error('Error Hampton()')
     try:
         NewKentCounty()
     except:
-        print 'Error NewKentCounty()'
+        Instrument.Error('Error NewKentCounty()')
 
     SendEmail()
 
+def ZipArchive(key):
+    # Today's download, or the earlier one the manifest says is unchanged
+    archive, member = ZipArchives[key]
+    if key in SourceArchives:
+        archive = Downloader.LoadManifest(SourceManifest).get(key, {}).get('path') or archive
+    return archive, member
+
+def SpatialReference(wkt):
+    if not wkt:
+        return None
+    spatialReference = arcpy.SpatialReference()
+    spatialReference.loadFromString(wkt)
+    return spatialReference
+
+def ZipReader(key):
+    # (reader, source, template) for FieldMap.Normalize()
+    archive, member = ZipArchive(key)
+    if member.lower().endswith('.shp'):
+        reader = ZipSource.ZipReader(archive)
+        return reader, member, SpatialReference(reader.Projection(member))
+    dataset, layer = member.rsplit('/', 1)
+    try:
+        reader = ZipSource.OgrReader(archive, dataset)
+        return reader, layer, SpatialReference(reader.Projection(layer))
+    except ImportError:
+        # No GDAL - extract just the geodatabase, not the whole archive
+        gdbPath = ZipSource.ExtractMembers(archive, dataset + '/', os.path.dirname(archive))
+        return Backends.ArcpyBackend(), gdbPath + os.sep + layer, gdbPath + os.sep + layer
+
+def NormalizedPath(key):
+    # Columnar file NormalizeParcels() writes. Zipped sources are named by the archive and
+    # FieldMap.py, so an unchanged archive maps to last run's file.
+    if key in ZipArchives and os.path.exists(ZipArchive(key)[0]):
+        fieldMap = os.path.splitext(FieldMap.__file__)[0] + '.py'
+        name = key + '_' + Columnar.CacheKey([ZipArchive(key)[0], fieldMap])
+        return NormalizedFolder + os.sep + name + Columnar.Extension
+    return ScratchFolder + os.sep + key + Columnar.Extension
+
+def NormalizeParcels(key):
+    # Copied source (WB, YC, ...) is written to NormalizedPath(key) with only TempSchema - no
+    # AddTempFields() or DeleteField loop. Zipped sources (ZipArchives) are read straight from
+    # the archive, and not at all if it hasn't changed.
+    output = NormalizedPath(key)
+    if not os.path.exists(os.path.dirname(output)):
+        try:
+            os.makedirs(os.path.dirname(output))
+        except OSError:
+            pass # another task made it first
+    files = Columnar.ColumnarBackend(Backends.ArcpyBackend())
+    if key in ZipArchives:
+        if os.path.exists(output):
+            print '\t' + key + ' unchanged - using ' + output
+            return
+        reader, source, template = ZipReader(key)
+        print '\tWriting ' + key + ' fields from ' + ZipArchive(key)[0]
+        FieldMap.Normalize(source, output, key, TempSchema, files, reader, template)
+        # Last month's file is kept as well, in case of a rollback
+        for old in sorted(glob.glob(NormalizedFolder + os.sep + key + '_*' + Columnar.Extension), key=os.path.getmtime)[:-2]:
+            os.remove(old)
+        return
+    print '\tWriting ' + key + ' fields'
+    FieldMap.Normalize(globals()[key], output, key, TempSchema, files, files.shapes, globals()[key])
+
+## AddTempFields() / AddTempFieldsTo() are no longer part of FieldCalc() - NormalizeParcels()
+## creates the temp fields with the table
 def AddTempFields():
     env.workspace = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'Parcels_' + TodaysDate + '.gdb'
 
+    for fc in arcpy.ListFeatureClasses():
+        AddTempFieldsTo(fc)
+
+def AddTempFieldsTo(fc):
     fieldName1  = "_Parcel_ID_"
     fieldName2  = "_Name_Owner_"
     fieldName3  = "_HouseNumber_"
@@ -340,137 +492,181 @@ def AddTempFields():
     fieldType1  = "TEXT"
     fieldType2  = "DOUBLE"
 
-    for fc in arcpy.ListFeatureClasses():
-        print 'Adding fields to ' + fc
-        arcpy.AddField_management(fc, fieldName1,  fieldType1, "", "", 50)
-        arcpy.AddField_management(fc, fieldName2,  fieldType1, "", "", 150)
-        arcpy.AddField_management(fc, fieldName3,  fieldType1, "", "", 50)
-        arcpy.AddField_management(fc, fieldName4,  fieldType1, "", "", 50)
-        arcpy.AddField_management(fc, fieldName5,  fieldType1, "", "", 50)
-        arcpy.AddField_management(fc, fieldName6,  fieldType1, "", "", 20)
-        arcpy.AddField_management(fc, fieldName7,  fieldType1, "", "", 10)
-        arcpy.AddField_management(fc, fieldName8,  fieldType2, "", "", 20)
-        arcpy.AddField_management(fc, fieldName9,  fieldType2, "", "", 20)
-        arcpy.AddField_management(fc, fieldName10, fieldType1, "", "", 150)
-        arcpy.AddField_management(fc, fieldName11, fieldType1, "", "", 150)
-        arcpy.AddField_management(fc, fieldName12, fieldType1, "", "", 50)
-        arcpy.AddField_management(fc, fieldName13, fieldType1, "", "", 10)
-        arcpy.AddField_management(fc, fieldName14, fieldType1, "", "", 50)
-
+    print 'Adding fields to ' + fc
+    arcpy.AddField_management(fc, fieldName1,  fieldType1, "", "", 50)
+    arcpy.AddField_management(fc, fieldName2,  fieldType1, "", "", 150)
+    arcpy.AddField_management(fc, fieldName3,  fieldType1, "", "", 50)
+    arcpy.AddField_management(fc, fieldName4,  fieldType1, "", "", 50)
+    arcpy.AddField_management(fc, fieldName5,  fieldType1, "", "", 50)
+    arcpy.AddField_management(fc, fieldName6,  fieldType1, "", "", 20)
+    arcpy.AddField_management(fc, fieldName7,  fieldType1, "", "", 10)
+    arcpy.AddField_management(fc, fieldName8,  fieldType2, "", "", 20)
+    arcpy.AddField_management(fc, fieldName9,  fieldType2, "", "", 20)
+    arcpy.AddField_management(fc, fieldName10, fieldType1, "", "", 150)
+    arcpy.AddField_management(fc, fieldName11, fieldType1, "", "", 150)
+    arcpy.AddField_management(fc, fieldName12, fieldType1, "", "", 50)
+    arcpy.AddField_management(fc, fieldName13, fieldType1, "", "", 10)
+    arcpy.AddField_management(fc, fieldName14, fieldType1, "", "", 50)
+
+@Instrument.Stage(outputs=lambda: [NormalizedPath('WB')])
 def Williamsburg():
     print 'Williamsburg'
-    print '\tField calculating'
-    arcpy.CalculateField_management(WB, "_Parcel_ID_", '!PID!', "PYTHON_9.3")
-    arcpy.CalculateField_management(WB, "_Legal_Desc_", '!LUCat!', "PYTHON_9.3")
-    arcpy.CalculateField_management(WB, "_Info_Source_", '"Williamsburg GIS Website"', "PYTHON_9.3")
-    print '\tDeleting unnecessary fields'
-    for field in arcpy.ListFields(WB):
-        if not field.required and field.name not in TempFields:
-            arcpy.DeleteField_management(WB, field.name)
+    NormalizeParcels('WB')
 
+@Instrument.Stage(outputs=lambda: [NormalizedPath('YC')])
 def YorkCounty():
     print 'York County'
-    print '\tField calculating'
-    arcpy.CalculateField_management(YC, "_Parcel_ID_", '!GPIN!', "PYTHON_9.3")
-    arcpy.CalculateField_management(YC, "_Name_Owner_", '!OWNERSNAME!', "PYTHON_9.3")
-    arcpy.CalculateField_management(YC, "_HouseNumber_", '!LOCADDR!.split(" ")[0]', "PYTHON_9.3")
-    arcpy.CalculateField_management(YC, "_Street_", 'Street(!LOCADDR!)', "PYTHON_9.3", codeblock_Street)#"_Street_", '!STRTNAME!', "PYTHON_9.3")
-    arcpy.CalculateField_management(YC, "_Sub_Name_", '!SUBDIVISION!', "PYTHON_9.3")
-    arcpy.CalculateField_management(YC, "_Legal_Desc_", '!TABLDIST_DESC!', "PYTHON_9.3")#'[LEGLDESC]', "VB")
-    arcpy.CalculateField_management(YC, "_Info_Source_", '"York County GIS Manager"', "PYTHON_9.3")
-    print '\tDeleting unnecessary fields'
-    for field in arcpy.ListFields(YC):
-        if not field.required and field.name not in TempFields:
-            arcpy.DeleteField_management(YC, field.name)
+    NormalizeParcels('YC')
             
+@Instrument.Stage(outputs=lambda: [NormalizedPath('POQ')])
 def Poquoson():
     print 'Poquoson'
-    print '\tField calculating'
-    arcpy.CalculateField_management(POQ, "_Parcel_ID_", '!MAP_PIN!', "PYTHON_9.3")
-    arcpy.CalculateField_management(POQ, "_Name_Owner_", '!OWNRNAME!', "PYTHON_9.3")
-    arcpy.CalculateField_management(POQ, "_HouseNumber_", '!STRTNUMB!', "PYTHON_9.3") # Long - so recalc below to add to text
-    arcpy.CalculateField_management(POQ, "_HouseNumber_", '!_HouseNumber_! + !NUMBSUFX!', "PYTHON_9.3") # To add Apt number
-    arcpy.CalculateField_management(POQ, "_Street_", '!STRTNAME!', "PYTHON_9.3")
-    arcpy.CalculateField_management(POQ, "_Sub_Name_", '!PROPDESC!', "PYTHON_9.3")
-    arcpy.CalculateField_management(POQ, "_Legal_Desc_", '[LEGLDESC]', "VB")#'!LEGLDESC!', "PYTHON_9.3")
-    arcpy.CalculateField_management(POQ, "_Info_Source_", '"Poquoson Assessor Office"', "PYTHON_9.3")
-    print '\tDeleting unnecessary fields'
-    for field in arcpy.ListFields(POQ):
-        if not field.required and field.name not in TempFields:
-            arcpy.DeleteField_management(POQ, field.name)
+    NormalizeParcels('POQ')
             
+@Instrument.Stage(outputs=lambda: [NormalizedPath('NN')])
 def NewportNews():
     print 'Newport News'
-    print '\tField calculating'
-    arcpy.CalculateField_management(NN, "_Parcel_ID_", '!REISID!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NN, "_Name_Owner_", '!OwnerNam!', "PYTHON_9.3")    
-    arcpy.CalculateField_management(NN, "_HouseNumber_", '!HouseNo!', "PYTHON_9.3") # Double - so recalc below to add to text
-    arcpy.CalculateField_management(NN, "_HouseNumber_", '!_HouseNumber_! + !Apt!', "PYTHON_9.3") # To add Apt number
-    arcpy.CalculateField_management(NN, "_Street_", '!Street!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NN, "_Sub_Name_", '!SubdivName!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NN, "_Legal_Desc_", '!LeglDesc!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NN, "_Info_Source_", '"NN Dept of Engineering"', "PYTHON_9.3")
-    print '\tDeleting unnecessary fields'
-    for field in arcpy.ListFields(NN):
-        if not field.required and field.name not in TempFields:
-            arcpy.DeleteField_management(NN, field.name)
+    NormalizeParcels('NN')
 
+@Instrument.Stage(outputs=lambda: [NormalizedPath('JCC')])
 def JamesCityCounty():
     print 'James City County'
-    print '\tField calculating'
-    arcpy.CalculateField_management(JCC, "_Parcel_ID_", '!PIN!', "PYTHON_9.3")
-    arcpy.CalculateField_management(JCC, "_HouseNumber_", '!LOCADDR!.split(" ")[0]', "PYTHON_9.3")
-    arcpy.CalculateField_management(JCC, "_Street_", 'Street(!LOCADDR!)', "PYTHON_9.3", codeblock_Street)
-    arcpy.CalculateField_management(JCC, "_Sub_Name_", '!SUBNAME!', "PYTHON_9.3") # might need to remove  
-    arcpy.CalculateField_management(JCC, "_Legal_Desc_", '!Legal1!', "PYTHON_9.3")
-    arcpy.CalculateField_management(JCC, "_Info_Source_", '"James City County GIS Website"', "PYTHON_9.3")
-    print '\tDeleting unnecessary fields'
-    for field in arcpy.ListFields(JCC):
-        if not field.required and field.name not in TempFields:
-            arcpy.DeleteField_management(JCC, field.name)
+    NormalizeParcels('JCC')
 
+@Instrument.Stage(outputs=lambda: [NormalizedPath('HAM')])
 def Hampton():
     print 'Hampton'
-    print '\tField calculating'
-    arcpy.CalculateField_management(HAM, "_Parcel_ID_", '!LRSNTXT!', "PYTHON_9.3")
-    arcpy.CalculateField_management(HAM, "_HouseNumber_", '!SITUS!.split(" ")[0]', "PYTHON_9.3")
-    arcpy.CalculateField_management(HAM, "_Street_", 'Street(!SITUS!)', "PYTHON_9.3", codeblock_Street) # or !FRONT_ST!
-    arcpy.CalculateField_management(HAM, "_Sub_Name_", '[Sub_Div]', "VB")
-    arcpy.CalculateField_management(HAM, "_Info_Source_", '"Hampton IT GIS"', "PYTHON_9.3")
-    print '\tDeleting unnecessary fields'
-    for field in arcpy.ListFields(HAM):
-        if not field.required and field.name not in TempFields:
-            arcpy.DeleteField_management(HAM, field.name)
+    NormalizeParcels('HAM')
 
+@Instrument.Stage(outputs=lambda: [NormalizedPath('NKC')])
 def NewKentCounty():
     print 'New Kent County'
-    print '\tField calculating'
-    arcpy.CalculateField_management(NKC, "_Parcel_ID_", '!GPIN!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NKC, "_Name_Owner_", '!REM_OWN_NAME!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NKC, "_HouseNumber_", '!REM_PRCL_LOCN!.split(" ")[0]', "PYTHON_9.3")
-    arcpy.CalculateField_management(NKC, "_Street_", 'Street(!REM_PRCL_LOCN!)', "PYTHON_9.3", codeblock_Street)
-    arcpy.CalculateField_management(NKC, "_Sub_Name_", '!SUBDIVISION!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NKC, "_Legal_Desc_", '!VNS_STYLE_DESC!', "PYTHON_9.3")
-    arcpy.CalculateField_management(NKC, "_Info_Source_", '"New Kent County GIS"', "PYTHON_9.3")
-    print '\tDeleting unnecessary fields'
-    for field in arcpy.ListFields(NKC):
-        if not field.required and field.name not in TempFields:
-            arcpy.DeleteField_management(NKC, field.name)
+    NormalizeParcels('NKC')
+
+## (key, fetch, normalize) - each chain is independent until MergeParcels()
+Jurisdictions = [('WB',  WBParcels,  Williamsburg),
+                 ('YC',  YCParcels,  YorkCounty),
+                 ('POQ', POQParcels, Poquoson),
+                 ('NN',  NNParcels,  NewportNews),
+                 ('JCC', JCCParcels, JamesCityCounty),
+                 ('HAM', HAMParcels, Hampton),
+                 ('NKC', NKCParcels, NewKentCounty)]
+
+## A Parcel_ID merged from two jurisdictions (see Pipeline.Dedup) - 'flag' keeps both and lists
+## them in DuplicateReport, 'precedence' keeps the one from the first key in MergePrecedence.
+## Cities before the counties around them.
+MergePolicy = Config.MergePolicy
+MergePrecedence = ['WB', 'POQ', 'NN', 'HAM', 'JCC', 'YC', 'NKC']
+DuplicateReport = RunFolder + os.sep + 'DuplicateParcels.csv'
+
+## Parcels of two jurisdictions that overlap in RealPropertyParcel (see Overlap.py). More than
+## OverlapLimit overlaps fails the CheckOverlaps() stage - None only reports them.
+OverlapReport = RunFolder + os.sep + 'OverlapParcels.csv'
+OverlapLimit = Config.OverlapLimit
+
+def ScratchFC(key):
+    return ScratchFolder + os.sep + key + '.gdb' + os.sep + key
+
+@Instrument.Stage()
+def RunJurisdiction(key):
+    # Called by Scheduler in a worker process, so pointing the module level path
+    # (WB, YC, ...) at the scratch geodatabase only affects this task
+    for name, fetch, normalize in Jurisdictions:
+        if name == key:
+            break
+    else:
+        raise ValueError('Unknown jurisdiction ' + key)
+    fc = ScratchFC(key)
+    gdbPath = os.path.dirname(fc)
+    if not os.path.exists(ScratchFolder):
+        try:
+            os.makedirs(ScratchFolder)
+        except OSError:
+            pass # another task made it first
+    if arcpy.Exists(gdbPath):
+        arcpy.Delete_management(gdbPath)
+    arcpy.CreateFileGDB_management(ScratchFolder, os.path.basename(gdbPath))
+
+    mainFC = globals()[key]
+    globals()[key] = fc
+    try:
+        fetch()
+        if key in ZipArchives:
+            # Read from the archive by normalize()
+            if not os.path.exists(ZipArchive(key)[0]):
+                raise RuntimeError(fetch.__name__ + '() did not get ' + ZipArchive(key)[0])
+        elif not arcpy.Exists(fc) and arcpy.Exists(mainFC):
+            # Saved to the main geodatabase by hand (York County when the service is down)
+            arcpy.CopyFeatures_management(mainFC, fc)
+        if key not in ZipArchives and not arcpy.Exists(fc):
+            raise RuntimeError(fetch.__name__ + '() did not create ' + key)
+        normalize()
+    finally:
+        # Put it back for the next stage when run in this process (Resume())
+        globals()[key] = mainFC
+    return NormalizedPath(key)
+
+def JurisdictionFC(key):
+    # Normalized Columnar file if there is one, otherwise the scratch output from
+    # ProcessParallel() or the main geodatabase
+    if os.path.exists(NormalizedPath(key)):
+        return NormalizedPath(key)
+    if arcpy.Exists(ScratchFC(key)):
+        return ScratchFC(key)
+    return globals()[key]
 
 ############################################################################################
 
-def Finish():
-    MergeParcels()
-    ZipCodeJoin()
-    CityJoin()
-    AlterFields()
+@Instrument.Stage(inputs=lambda: JurisdictionFCs(), outputs=lambda: [CleanedParcels])
+def Finish(keepIntermediates=False):
+    # Merge, zip code / city and AlterFields() in one pass - RealPropertyParcel is the only
+    # feature class written unless keepIntermediates
+    print 'Building ' + FinalFCname
+    backend = Backends.ArcpyBackend()
+    targets = LocationIndexes(backend, Pipeline.Wkt(backend, Pipeline.Template(MergeInputs())))
+    intermediates = {}
+    if keepIntermediates:
+        intermediates = {'merge': (MasterParcels, TempSchema), 'locate': (MasterCityJoinFC, TempSchema)}
+    cache = AssignmentCache.AssignmentCache(IndexFolder + os.sep + 'Assignments.sqlite', SpatialIndex.CacheSignature(targets))
+    dedup = MergeDedup()
+    try:
+        Pipeline.Run(backend, MergeInputs(), TempFields, CleanedParcels, FinalSchema, FinalMap, targets, cache, intermediates, dedup)
+    finally:
+        cache.Close()
+        Instrument.Running[-1]['merge'] = dedup.Stats()
+        Instrument.Running[-1]['cache'] = cache.Stats()
+    CheckOverlaps()
     SendEmail()
-    
+
+def JurisdictionFCs():
+    return [JurisdictionFC(key) for key, fetch, normalize in Jurisdictions]
+
+def MergeInputs():
+    inputs = []
+    for key, fetch, normalize in Jurisdictions:
+        fc = JurisdictionFC(key)
+        if Columnar.IsColumnar(fc) or arcpy.Exists(fc):
+            inputs.append(fc)
+        else:
+            print '\t' + key + ' missing - not merged'
+    return inputs
+
+def MergeDedup():
+    return Pipeline.Dedup('_Parcel_ID_', MergePolicy, MergePrecedence,
+                          dict((JurisdictionFC(key), key) for key, fetch, normalize in Jurisdictions), DuplicateReport)
+
+@Instrument.Stage(inputs=lambda: JurisdictionFCs(), outputs=lambda: [MasterParcels])
 def MergeParcels():
     print 'Merging all parcels to Master'
-    # http://resources.arcgis.com/en/help/main/10.2/index.html#/Merge/001700000055000000/
-    arcpy.Merge_management([WB, YC, POQ, NN, JCC, HAM, NKC], MasterParcels)
+    # Same as Merge_management, which can't read the Columnar files
+    backend = Backends.ArcpyBackend()
+    inputs = MergeInputs()
+    dedup = MergeDedup()
+    Pipeline.Write(backend, Pipeline.Merge(backend, inputs, TempFields, dedup), MasterParcels, TempSchema, Pipeline.Template(inputs))
+    print Pipeline.MergeSummary(dedup.Stats())
+    Instrument.Running[-1]['merge'] = dedup.Stats()
                               
+@Instrument.Stage(inputs=lambda: [MasterParcels], outputs=lambda: [MasterZipCodeJoinFC])
 def ZipCodeJoin():
     print 'Joining to ZipCode FC'
     arcpy.SpatialJoin_analysis(MasterParcels, ZipCodeFC, MasterZipCodeJoinFC, "JOIN_ONE_TO_ONE", "KEEP_ALL", "", "HAVE_THEIR_CENTER_IN")#"COMPLETELY_WITHIN")
@@ -481,6 +677,7 @@ def ZipCodeJoin():
         if not field.required and field.name not in TempFields:
             arcpy.DeleteField_management(MasterZipCodeJoinFC, field.name)
             
+@Instrument.Stage(inputs=lambda: [MasterZipCodeJoinFC], outputs=lambda: [MasterCityJoinFC])
 def CityJoin():
     print 'Joining to City FC'
     arcpy.SpatialJoin_analysis(MasterZipCodeJoinFC, CityFC, MasterCityJoinFC, "JOIN_ONE_TO_ONE", "KEEP_ALL", "", "HAVE_THEIR_CENTER_IN")#"COMPLETELY_WITHIN")
@@ -491,11 +688,45 @@ def CityJoin():
         if not field.required and field.name not in TempFields:
             arcpy.DeleteField_management(MasterCityJoinFC, field.name)
 
-def AlterFields():
+@Instrument.Stage(outputs=lambda: [MasterParcels])
+def AssignLocation():
+    # Replaces ZipCodeJoin() + CityJoin() - same HAVE_THEIR_CENTER_IN result, written straight
+    # to MasterParcels in one pass (see SpatialIndex.py)
+    print 'Assigning zip code and city'
+    backend = Backends.ArcpyBackend()
+    targets = LocationIndexes(backend, arcpy.Describe(MasterParcels).spatialReference.exportToString())
+    # Parcels whose geometry hasn't changed since an earlier run reuse that run's answer
+    cache = AssignmentCache.AssignmentCache(IndexFolder + os.sep + 'Assignments.sqlite', SpatialIndex.CacheSignature(targets))
+    try:
+        SpatialIndex.Assign(backend, MasterParcels, targets, cache)
+    finally:
+        cache.Close()
+        Instrument.Running[-1]['cache'] = cache.Stats()
+    return cache.Stats()
+
+def LocationIndexes(backend, wkt):
+    # Zip code and city polygons projected to the parcels' spatial reference (wkt)
+    zips = SpatialIndex.Cached(backend, ZipCodeFC, 'ZCTA5CE10', IndexFolder + os.sep + 'ZipCode.pidx', wkt)
+    cities = SpatialIndex.Cached(backend, CityFC, 'NAMELSAD', IndexFolder + os.sep + 'City.pidx', wkt)
+    return [('_Zip_Code_', zips), ('_City_Loc_', cities)]
+
+@Instrument.Stage(inputs=lambda: [CleanedParcels])
+def CheckOverlaps():
+    print 'Checking for parcels overlapping across jurisdictions'
+    sqftPerUnit = Geometry.SquareFeetPerSquareUnit(arcpy.Describe(CleanedParcels).spatialReference.metersPerUnit)
+    stats = Overlap.Check(Backends.ArcpyBackend(), CleanedParcels, OverlapReport, 'Parcel_ID', 'Info_Source', sqftPerUnit)
+    Instrument.Running[-1]['overlap'] = stats
+    if OverlapLimit is not None and stats['overlaps'] > OverlapLimit:
+        Instrument.Error('%d overlapping parcels (limit %d) - see %s' % (stats['overlaps'], OverlapLimit, OverlapReport))
+    return stats
+
+@Instrument.Stage(outputs=lambda: [CleanedParcels])
+def AlterFields(source=MasterParcels):
+    # source is MasterCityJoinFC if ZipCodeJoin() and CityJoin() were run instead of AssignLocation()
 
     out_path = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'Parcels_' + TodaysDate + '.gdb'
     out_name = FinalFCname
-    arcpy.FeatureClassToFeatureClass_conversion(MasterCityJoinFC, out_path, out_name)
+    arcpy.FeatureClassToFeatureClass_conversion(source, out_path, out_name)
     
     print FinalFCname
     # Run this to match field names to current schema and delete temporary fields
@@ -541,8 +772,12 @@ def AlterFields():
     arcpy.CalculateField_management(CleanedParcels, "City_Loc",      '!_City_Loc_!',    "PYTHON_9.3")
     arcpy.CalculateField_management(CleanedParcels, "State",         '"VA"',            "PYTHON_9.3")
     arcpy.CalculateField_management(CleanedParcels, "Zip_Code",      '!_Zip_Code_!',    "PYTHON_9.3")   
-    arcpy.CalculateField_management(CleanedParcels, "Square_Feet",   'round(!shape.area@SQUAREFEET!, 2)',       "PYTHON_9.3")
-    arcpy.CalculateField_management(CleanedParcels, "Acres_US",      'round(!shape.area@ACRES!, 2)',            "PYTHON_9.3")
+    # Square_Feet and Acres_US from one area per polygon in the layer's linear unit, instead of
+    # round(!shape.area@SQUAREFEET!, 2) and round(!shape.area@ACRES!, 2) as two passes
+    sqftPerUnit = Geometry.SquareFeetPerSquareUnit(arcpy.Describe(CleanedParcels).spatialReference.metersPerUnit)
+    Backends.ArcpyBackend().UpdateRows(CleanedParcels, ['SHAPE@AREA', 'Square_Feet', 'Acres_US'],
+                                       lambda row: [row[0], round(row[0] * sqftPerUnit, 2),
+                                                    round(row[0] * sqftPerUnit / Geometry.SquareFeetPerAcre, 2)])
     arcpy.CalculateField_management(CleanedParcels, "Sub_Name",      '!_Sub_Name_!',    "PYTHON_9.3")
     arcpy.CalculateField_management(CleanedParcels, "Legal_Desc",    '[_Legal_Desc_]',  "VB")
     arcpy.CalculateField_management(CleanedParcels, "Info_Source",   '!_Info_Source_!', "PYTHON_9.3")
@@ -563,8 +798,14 @@ def SendEmail():
         mailSender = '%s <%s@nnva.gov>' % (os.environ['USERNAME'], os.environ['USERNAME'])
 
         subject = 'Parcel Update'
+        if Instrument.Failed():
+            subject += ' - check failed stages'
         
-        body  = '\nParcel update operation successful\r\n'
+        body  = '\n' + Instrument.EmailBody() + '\r\n'
+        if os.path.exists(ChangeSummary):
+            # Written by DetectChanges()
+            with open(ChangeSummary) as f:
+                body += '\r\n' + f.read().replace('\n', '\r\n') + '\r\n'
         
         message  = ''
         message += 'From: %s\r\n' % mailSender
@@ -580,39 +821,197 @@ def SendEmail():
 
 ############################################################################################
 
-def UpdateData():
+## Saved batches of the publish to sde - UpdateData() resumes from here if it was interrupted
+PublishProgress = RunFolder + os.sep + 'PublishProgress.json'
+
+## Connection to the bkingery version made by UpdateData() - the edit session has to be on the
+## same version as the cursors, and the .sde file connects to DEFAULT
+VersionConnection = RunFolder + os.sep + 'OS_Conway_sdeVector_bkingery.sde'
+
+@Instrument.Stage(inputs=lambda: [CleanedParcels])
+def UpdateData(delta=True, dryRun=False, batchSize=Publish.BatchSize):
     # Add a Database connection to sdeVector using SQL Server on Conway using Operating System Authentication
         # Rename to OS_Conway_sdeVector.sde
     # Create version (using ArcMap Version Manager) - bkingery
+    # delta=True only applies the parcels that changed since last month (see Publish.py),
+    # delta=False deletes every parcel and appends them all again.
+    # dryRun=True only prints the inserts/updates/deletes delta would make.
+    # Each batch of batchSize parcels is saved to the version on its own (see Publish.py). Run
+    # UpdateData() again after a failure to carry on from the last saved batch.
 
     DatabaseServer_Database_sde = r'R:\Divisions\InfoTech\Shared\GIS\Parcels\OS_Conway_sdeVector.sde'
+    MASTER = r'R:\Divisions\InfoTech\Shared\GIS\Parcels\OS_Conway_sdeVector.sde\sdeVector.SDEDATAOWNER.Cadastral\sdeVector.SDEDATAOWNER.RealPropertyParcel'
+
+    if dryRun:
+        return Publish.DeltaUpdate(CleanedParcels, MASTER, None, FinalFields, dryRun=True)
+
     # Set local variables
     inWorkspace = DatabaseServer_Database_sde
     parentVersion = "sde.DEFAULT"
     versionName = "bkingery"
-    # Execute CreateVersion
-    arcpy.CreateVersion_management(inWorkspace, parentVersion, versionName, "PROTECTED")
-    print 'version created'
+    resuming = Publish.InProgress(PublishProgress)
+    if resuming:
+        # The version and the backup are from the interrupted run - the backup must not be
+        # retaken from the half published layer
+        print 'Resuming the publish recorded in ' + PublishProgress
+    else:
+        # Execute CreateVersion
+        arcpy.CreateVersion_management(inWorkspace, parentVersion, versionName, "PROTECTED")
+        print 'version created'
+
+        # Copy outdated parcels to project gdb as a backup
+        arcpy.CopyFeatures_management(MASTER, OldParcels)
+        print 'Old version of Parcels copied to Parcels_' + TodaysDate + '.gdb'
+
+    # Create the layers - through a connection to the version, which the edit session is
+    # opened on too. An editor on the .sde file would be editing DEFAULT, not the version
+    # the layer writes to, and the per batch saves would never reach bkingery.
+    versionWorkspace = Backends.ArcpyBackend().ConnectVersion(inWorkspace, 'BKINGERY.' + versionName, VersionConnection)
+    arcpy.MakeFeatureLayer_management(versionWorkspace + MASTER[len(inWorkspace):],'parcel_lyr')
+    print 'make layer complete'
 
-    MASTER = r'R:\Divisions\InfoTech\Shared\GIS\Parcels\OS_Conway_sdeVector.sde\sdeVector.SDEDATAOWNER.Cadastral\sdeVector.SDEDATAOWNER.RealPropertyParcel'
+    target = Backends.ArcpyBackend(versionWorkspace)
+    if delta:
+        changes = Publish.DeltaUpdate(CleanedParcels, OldParcels, 'parcel_lyr', FinalFields, target=target,
+                                      batchSize=batchSize, progress=PublishProgress)
+    else:
+        # Every parcel deleted and inserted again, in the same saved batches
+        changes = Publish.FullUpdate(CleanedParcels, 'parcel_lyr', FinalFields, target=target,
+                                     batchSize=batchSize, progress=PublishProgress)
+    Instrument.Running[-1]['publish'] = changes['published']
+    print 'Parcels updated'
+
+## Unversioned RealPropertyParcel, replaced whole by SwapUpdate() (see Staging.py)
+SwapWorkspace = r'R:\Divisions\InfoTech\Shared\GIS\Parcels\OS_Conway_sdeVector.sde'
+SwapParcels = SwapWorkspace + r'\sdeVector.SDEDATAOWNER.Cadastral\sdeVector.SDEDATAOWNER.RealPropertyParcel'
+
+@Instrument.Stage(inputs=lambda: [CleanedParcels])
+def SwapUpdate():
+    # Instead of UpdateData() - RealPropertyParcel_Staging is loaded and indexed next to the
+    # live layer, then renamed into its place. The layer it replaces is kept as
+    # RealPropertyParcel_Previous for RollbackUpdate(). The services need to release their
+    # schema locks for the renames.
+    target = Backends.ArcpyBackend(SwapWorkspace)
+    count = Staging.Load(Backends.ArcpyBackend(), CleanedParcels, target, SwapParcels, FinalFields, FinalSchema, SwapParcels)
+    seconds = Staging.Promote(target, SwapParcels)
+    Instrument.Running[-1]['swap'] = {'parcels': count, 'switchover_seconds': round(seconds, 3)}
+
+@Instrument.Stage()
+def RollbackUpdate():
+    # Puts RealPropertyParcel_Previous back (run again to undo)
+    Staging.Rollback(Backends.ArcpyBackend(SwapWorkspace), SwapParcels)
+
+## Every month's RealPropertyParcel, each unchanged parcel stored once (see Archive.py)
+ArchivePath = Config.ArchivePath
+
+@Instrument.Stage(inputs=lambda: [CleanedParcels])
+def ArchiveParcels():
+    # RealPropertyParcel as snapshot <date> and, once UpdateData() has taken it, the sde backup
+    # as <date>_OLD. Either can be rebuilt with RestoreParcels() after the month's geodatabase
+    # has been deleted.
+    store = Archive.Store(ArchivePath)
+    try:
+        stats = {'rows': 0, 'new_objects': 0}
+        for name, fc in [(TodaysDate, CleanedParcels), (TodaysDate + '_OLD', OldParcels)]:
+            if arcpy.Exists(fc):
+                wkt = arcpy.Describe(fc).spatialReference.exportToString()
+                stored = store.Store(name, Backends.ArcpyBackend(), fc, FinalFields, FinalSchema, wkt)
+                stats['rows'] += stored['rows']
+                stats['new_objects'] += stored['new_objects']
+        stats['dedup_ratio'] = store.Stats()['dedup_ratio']
+        Instrument.Running[-1]['archive'] = stats
+    finally:
+        store.Close()
+
+@Instrument.Stage()
+def RestoreParcels(name, output=None):
+    # Snapshot name (yyyymmdd or yyyymmdd_OLD) --> output, by default RealPropertyParcel_<name>
+    # in today's geodatabase
+    output = output or os.path.dirname(CleanedParcels) + os.sep + FinalFCname + '_' + name
+    store = Archive.Store(ArchivePath)
+    try:
+        Instrument.Running[-1]['restore'] = store.Restore(name, Backends.ArcpyBackend(), output)
+    finally:
+        store.Close()
+    return output
+
+## Parcels added, retired, renamed or changed since last month (see Changes.py)
+ChangesReport = RunFolder + os.sep + 'ParcelChanges.csv'
+ChangeSummary = RunFolder + os.sep + 'ParcelChanges.txt'
+
+@Instrument.Stage(inputs=lambda: [CleanedParcels])
+def DetectChanges(old=None, email=False):
+    # RealPropertyParcel against old - by default the OLD_RealPropertyParcel_<date> backup
+    # UpdateData() takes, or the sde layer itself before it has been published. After
+    # SwapUpdate() pass SwapParcels + Staging.Previous.
+    if old is None:
+        old = OldParcels if arcpy.Exists(OldParcels) else SwapParcels
+    print 'Comparing %s with %s' % (FinalFCname, old)
+    backend = Backends.ArcpyBackend()
+    stats = Changes.Detect(backend, old, backend, CleanedParcels, ChangesReport)
+    with open(ChangeSummary, 'w') as f:
+        f.write(Changes.Summary(stats) + '\n')
+    Instrument.Running[-1]['changes'] = dict((kind, stats[kind]) for kind in Changes.Kinds)
+    if email:
+        SendEmail()
+    return stats
 
-    # Copy outdated parcels to project gdb as a backup
-    arcpy.CopyFeatures_management(MASTER, OldParcels)
-    print 'Old version of Parcels copied to Parcels_' + TodaysDate + '.gdb'
+############################################################################################
 
-    # Create the layers
-    arcpy.MakeFeatureLayer_management(MASTER,'parcel_lyr')
-    print 'make layer complete'
-    arcpy.ChangeVersion_management('parcel_lyr','TRANSACTIONAL','BKINGERY.bkingery')
-    print 'change version'
-    
-    # Delete rows in versioned feature class
-    arcpy.DeleteFeatures_management('parcel_lyr')
-    print 'Parcels deleted'
+## Finished stages of today's run (see Checkpoint.py)
+CheckpointManifest = Config.CheckpointManifest
+
+## Where each jurisdiction's data comes from - a stage is rerun when one of these changes
+def SourceInputs(key):
+    if key in ZipArchives:
+        return [ZipArchive(key)[0]]
+    return {'YC':  [],
+            'NN':  [r'T:\GIS.gdb\Parcel_Polygon'],
+            'NKC': [NKCParcelsFC, NKCTable]}[key]
+
+def TableSignature(path):
+    # Row count, extent and fields - not the gdb file times, which change whenever anything
+    # else in the same geodatabase is written
+    if not arcpy.Exists(path):
+        return None
+    describe = arcpy.Describe(path)
+    if describe.dataType in ('Workspace', 'Folder'):
+        return 'exists'
+    return '%s|%s|%s' % (arcpy.GetCount_management(path).getOutput(0), describe.extent,
+                         ','.join(field.name for field in arcpy.ListFields(path)))
+
+Checkpoint.TableSigner = TableSignature
+
+def Stages(keepIntermediates=False):
+    # (name, function, inputs, outputs) in run order
+    stages = [('Start', Start, lambda: [], lambda: [RunFolder + os.sep + 'Parcels_' + TodaysDate + '.gdb'])]
+    for key, fetch, normalize in Jurisdictions:
+        stages.append((key, functools.partial(RunJurisdiction, key),
+                       functools.partial(SourceInputs, key), lambda key=key: [NormalizedPath(key)]))
+    stages.append(('Finish', functools.partial(Finish, keepIntermediates),
+                   JurisdictionFCs, lambda: [CleanedParcels]))
+    return stages
+
+def Resume(fromStage=None, only=None, fresh=False, keepIntermediates=False):
+    # Start, each jurisdiction and Finish, skipping what is already done today. fresh sets
+    # today's folder aside (CityData is copied back) and starts over.
+    return Checkpoint.Run(Stages(keepIntermediates), CheckpointManifest, fromStage, only, fresh,
+                          RunFolder, keep=['CityData'])
 
-    # Append new values to versioned feature class
-    try:
-        arcpy.Append_management(CleanedParcels, 'parcel_lyr', "TEST")
-        print 'Parcels updated'
-    except:
-        print 'Error, but still check the version, it might have worked'
+############################################################################################
+
+if __name__ == '__main__':
+    # Resume() only - Parcels.py has the other steps
+    import argparse
+    parser = argparse.ArgumentParser(description='Run or resume the monthly parcel update')
+    parser.add_argument('--keep-intermediates', action='store_true',
+                        help='also write Master_Parcels_<date> and Master_Join_2_City for debugging')
+    parser.add_argument('--from-stage', help='rerun from this stage on (Start, WB, YC, POQ, NN, JCC, HAM, NKC, Finish)')
+    parser.add_argument('--only', help='comma separated stages to run, e.g. NN,Finish')
+    parser.add_argument('--fresh', action='store_true',
+                        help="set today's folder aside and start over (nothing is deleted)")
+    parser.add_argument('--merge-policy', choices=Pipeline.Dedup.Policies, default=MergePolicy,
+                        help='parcel IDs in two jurisdictions: flag keeps both, precedence keeps MergePrecedence order')
+    args = parser.parse_args()
+    MergePolicy = args.merge_policy
+    Resume(args.from_stage, args.only.split(',') if args.only else None, args.fresh, args.keep_intermediates)
@@ -0,0 +1,333 @@
+"""
+Name:     Overlap.py
+Purpose:  Parcels from two jurisdictions that overlap in the merged layer
+
+          Check() packs the merged parcels into the same arrays as SpatialIndex, puts their
+          bounding boxes in an STR-tree and only pairs up boxes that intersect and have
+          different Info_Source values. A pair belongs to the tile holding the lower left corner
+          of the intersection of the two boxes, so no pair is in two tiles. The tiles are
+          measured on a process pool. The workers map the packed file instead of being sent
+          the geometry.
+
+          The overlap area is exact for polygons with holes. The boundary of A and B is the part
+          of A's rings inside B plus the part of B's rings inside A, and the shoelace sum over
+          those pieces is its area. Shared edges only count when they run the same way, so
+          parcels that just touch overlap by 0.
+
+          The report lists each pair with the overlap in square feet and as a percent of each
+          parcel. Overlaps under MinSquareFeet are digitizing slivers and are only counted.
+
+"""
+
+import csv, math, multiprocessing, os, random, shutil, tempfile, time
+import Backends, Geometry, Join, SpatialIndex
+from Backends import Shape
+
+## Boxes per STR-tree node
+NodeCapacity = 16
+
+## Smaller overlaps are counted but not listed in the report
+MinSquareFeet = 1.0
+
+## Tiles per worker, so a tile along a busy county line doesn't hold up the pool
+TilesPerWorker = 4
+
+## Separates source and Parcel_ID in the packed labels
+Separator = u'\x1f'
+
+############################################################################################
+
+class STRTree(object):
+    # Packed R-tree over boxes, built bottom up by Sort-Tile-Recursive. Nodes are
+    # (xmin, ymin, xmax, ymax, children); leaf entries have the item number in place of children.
+
+    def __init__(self, bounds, capacity=NodeCapacity):
+        # bounds = xmin, ymin, xmax, ymax per item
+        nodes = [(bounds[4 * i], bounds[4 * i + 1], bounds[4 * i + 2], bounds[4 * i + 3], i)
+                 for i in range(len(bounds) // 4)]
+        self.depth = 0
+        while len(nodes) > 1 or self.depth == 0:
+            nodes = Pack(nodes, capacity)
+            self.depth += 1
+        self.root = nodes
+
+    def Query(self, xmin, ymin, xmax, ymax):
+        # Items whose box intersects (touching counts)
+        found = []
+        stack = list(self.root)
+        while stack:
+            node = stack.pop()
+            if node[0] > xmax or node[2] < xmin or node[1] > ymax or node[3] < ymin:
+                continue
+            if isinstance(node[4], list):
+                stack.extend(node[4])
+            else:
+                found.append(node[4])
+        return found
+
+def Pack(entries, capacity):
+    # One level up: vertical slices by x center, then runs of capacity by y center in each
+    count = len(entries)
+    slices = int(math.ceil(math.sqrt(math.ceil(count / float(capacity)))))
+    per = slices * capacity
+    entries = sorted(entries, key=lambda e: e[0] + e[2])
+    nodes = []
+    for s in range(0, count, per):
+        strip = sorted(entries[s:s + per], key=lambda e: e[1] + e[3])
+        for k in range(0, len(strip), capacity):
+            group = strip[k:k + capacity]
+            nodes.append((min(e[0] for e in group), min(e[1] for e in group),
+                          max(e[2] for e in group), max(e[3] for e in group), group))
+    return nodes
+
+############################################################################################
+
+def Oriented(rings):
+    # Float rings with the outer rings clockwise (the esri order) so both polygons of a pair
+    # wind the same way
+    rings = [[(float(x), float(y)) for x, y in ring] for ring in rings]
+    if Geometry.Area(rings) > 0:
+        return [list(reversed(ring)) for ring in rings]
+    return rings
+
+def Side(rings, edges, x, y, dx, dy, tolerance):
+    # 1 inside rings, 0 outside, 2 on an edge running the same way as (dx, dy), 0 on one
+    # running the other way
+    for (x3, y3), (x4, y4) in edges:
+        if min(x3, x4) - tolerance <= x <= max(x3, x4) + tolerance and \
+           min(y3, y4) - tolerance <= y <= max(y3, y4) + tolerance and \
+           SpatialIndex.SegmentDistance(x, y, x3, y3, x4, y4) <= tolerance:
+            return 2 if dx * (x4 - x3) + dy * (y4 - y3) > 0 else 0
+    inside = False
+    for (x1, y1), (x2, y2) in edges:
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return 1 if inside else 0
+
+def Boundary(rings, other, shared, tolerance):
+    # Twice the shoelace sum over the pieces of rings inside other. shared also takes the
+    # pieces on an edge of other running the same way.
+    edges = [(ring[k], ring[k + 1]) for ring in other for k in range(len(ring) - 1)]
+    total = 0.0
+    for ring in rings:
+        for k in range(len(ring) - 1):
+            (x1, y1), (x2, y2) = ring[k], ring[k + 1]
+            dx, dy = x2 - x1, y2 - y1
+            length2 = dx * dx + dy * dy
+            if length2 == 0.0:
+                continue
+            cuts = [0.0, 1.0]
+            for (x3, y3), (x4, y4) in edges:
+                ex, ey = x4 - x3, y4 - y3
+                denom = dx * ey - dy * ex
+                if denom != 0.0:
+                    t = ((x3 - x1) * ey - (y3 - y1) * ex) / denom
+                    u = ((x3 - x1) * dy - (y3 - y1) * dx) / denom
+                    if 0.0 < t < 1.0 and 0.0 <= u <= 1.0:
+                        cuts.append(t)
+                else:
+                    # Parallel - the ends of a collinear edge cut this one
+                    for x, y in ((x3, y3), (x4, y4)):
+                        t = ((x - x1) * dx + (y - y1) * dy) / length2
+                        if 0.0 < t < 1.0 and SpatialIndex.SegmentDistance(x, y, x1, y1, x2, y2) <= tolerance:
+                            cuts.append(t)
+            cuts.sort()
+            for t0, t1 in zip(cuts, cuts[1:]):
+                if t1 - t0 <= 1e-12:
+                    continue
+                side = Side(other, edges, x1 + dx * (t0 + t1) / 2.0, y1 + dy * (t0 + t1) / 2.0, dx, dy, tolerance)
+                if side == 1 or (shared and side == 2):
+                    px, py = x1 + dx * t0, y1 + dy * t0
+                    qx, qy = x1 + dx * t1, y1 + dy * t1
+                    total += px * qy - qx * py
+    return total
+
+def IntersectionArea(a, b, tolerance=SpatialIndex.Tolerance):
+    # Area of a and b (rings of (x, y)) in map units
+    a, b = Oriented(a), Oriented(b)
+    return abs(Boundary(a, b, True, tolerance) + Boundary(b, a, False, tolerance)) / 2.0
+
+############################################################################################
+
+def Read(backend, table, idField, sourceField):
+    # PolygonIndex of table labelled source + Separator + Parcel_ID
+    index = SpatialIndex.PolygonIndex()
+    for parcelId, source, shape in backend.Search(table, [idField, sourceField, Shape]):
+        rings = backend.Rings(shape)
+        if rings:
+            index.Add((Join.Key(source) or u'') + Separator + (Join.Key(parcelId) or u''), rings)
+    return index
+
+def Pairs(index, sources, tiles):
+    # {(column, row): [(i, j)]} of intersecting boxes from different sources, i < j
+    b = index.bounds
+    count = len(sources)
+    if not count:
+        return {}
+    tree = STRTree(b)
+    xmin, ymin = min(b[0::4]), min(b[1::4])
+    columns = int(math.ceil(math.sqrt(tiles)))
+    width = max((max(b[2::4]) - xmin) / columns, 1e-9)
+    height = max((max(b[3::4]) - ymin) / columns, 1e-9)
+    pairs = {}
+    for i in range(count):
+        for j in tree.Query(b[4 * i], b[4 * i + 1], b[4 * i + 2], b[4 * i + 3]):
+            if j <= i or sources[j] == sources[i]:
+                continue
+            x = max(b[4 * i], b[4 * j])
+            y = max(b[4 * i + 1], b[4 * j + 1])
+            tile = (min(int((x - xmin) / width), columns - 1), min(int((y - ymin) / height), columns - 1))
+            pairs.setdefault(tile, []).append((i, j))
+    return pairs
+
+def Polygon(index, i):
+    rings = []
+    for ring in range(index.ringStart[i], index.ringStart[i + 1]):
+        coords = index.Ring(ring)
+        rings.append(zip(coords[0::2], coords[1::2]))
+    return rings
+
+def Measure(task):
+    # Runs in the worker: [(i, j, overlap, area i, area j)] for the pairs of one tile, map units
+    path, pairs = task
+    index = SpatialIndex.Load(path)
+    polygons = {}
+    results = []
+    for i, j in pairs:
+        for k in (i, j):
+            if k not in polygons:
+                polygons[k] = Polygon(index, k)
+        area = IntersectionArea(polygons[i], polygons[j])
+        if area > 0.0:
+            results.append((i, j, area, abs(Geometry.Area(polygons[i])), abs(Geometry.Area(polygons[j]))))
+    return results
+
+def Check(backend, table, report, idField='Parcel_ID', sourceField='Info_Source', squareFeetPerUnit=1.0,
+          workers=None, minSquareFeet=MinSquareFeet):
+    # Writes the overlaps of table to the report CSV, largest first, and returns the counts
+    start = time.time()
+    index = Read(backend, table, idField, sourceField)
+    labels = [label.split(Separator, 1) for label in index.labels]
+    sources = [source for source, parcelId in labels]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    tiles = Pairs(index, sources, workers * TilesPerWorker)
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'Parcels.pidx')
+    try:
+        SpatialIndex.Save(index, path, '')
+        tasks = [(path, pairs) for tile, pairs in sorted(tiles.items())]
+        if workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            try:
+                results = pool.map(Measure, tasks, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [Measure(task) for task in tasks]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    overlaps = sorted((r for tile in results for r in tile), key=lambda r: -r[2])
+    stats = {'parcels': len(labels), 'candidates': sum(len(pairs) for pairs in tiles.values()),
+             'tiles': len(tiles), 'workers': workers, 'overlaps': 0, 'slivers': 0,
+             'overlap_square_feet': 0.0, 'sources': {}, 'report': report}
+    with open(report, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Parcel_ID_1', 'Info_Source_1', 'Parcel_ID_2', 'Info_Source_2',
+                         'Overlap_Square_Feet', 'Percent_Of_1', 'Percent_Of_2'])
+        for i, j, area, areaI, areaJ in overlaps:
+            squareFeet = area * squareFeetPerUnit
+            if squareFeet < minSquareFeet:
+                stats['slivers'] += 1
+                continue
+            stats['overlaps'] += 1
+            stats['overlap_square_feet'] += squareFeet
+            pair = ' / '.join(sorted([sources[i], sources[j]]))
+            stats['sources'][pair] = stats['sources'].get(pair, 0) + 1
+            writer.writerow([labels[i][1].encode('utf-8'), sources[i].encode('utf-8'),
+                             labels[j][1].encode('utf-8'), sources[j].encode('utf-8'), round(squareFeet, 2),
+                             round(100.0 * area / areaI, 2) if areaI else '', round(100.0 * area / areaJ, 2) if areaJ else ''])
+    stats['overlap_square_feet'] = round(stats['overlap_square_feet'], 2)
+    stats['seconds'] = round(time.time() - start, 3)
+    print '\tChecked %(parcels)d parcels, %(candidates)d candidate pairs in %(tiles)d tiles on %(workers)d workers' % stats
+    print '\t%(overlaps)d overlaps (%(overlap_square_feet).0f sq ft), %(slivers)d slivers under' % stats + \
+          ' %g sq ft (%.1f s)' % (minSquareFeet, stats['seconds'])
+    for pair, count in sorted(stats['sources'].items()):
+        print '\t\t%-60s %6d' % (pair, count)
+    return stats
+
+############################################################################################
+
+def SelfTest():
+    # Known overlap areas, then Check() against every pair measured by brute force
+    square = lambda x, y, size: SpatialIndex.Square(x, y, size)[0]
+    hole = [(2.0, 2.0), (8.0, 2.0), (8.0, 8.0), (2.0, 8.0), (2.0, 2.0)]
+    cases = [([square(0, 0, 10)], [square(5, 5, 10)], 25.0),
+             ([square(0, 0, 10)], [square(0, 0, 10)], 100.0),
+             ([square(0, 0, 10)], [square(10, 0, 10)], 0.0),
+             ([square(0, 0, 10)], [square(0, 0, 5)], 25.0),
+             ([square(0, 0, 10), hole], [square(3, 3, 4)], 0.0),
+             ([square(0, 0, 10), hole], [square(-5, 0, 10)], 32.0),
+             ([square(0, 0, 10)], [[(5.0, 5.0), (5.0, 15.0), (15.0, 5.0), (5.0, 5.0)]], 25.0),
+             ([square(0, 0, 10)], [list(reversed(square(5, 0, 10)))], 50.0)]
+    for a, b, expected in cases:
+        for first, second in ((a, b), (b, a)):
+            area = IntersectionArea(first, second)
+            assert abs(area - expected) < 1e-6, (first, second, area, expected)
+
+    memory = Synthetic(2000, seed=3)
+    report = os.path.join(tempfile.mkdtemp(), 'Overlaps.csv')
+    stats = Check(memory, 'Parcels', report, workers=2, minSquareFeet=0.0)
+    rows = memory.tables['Parcels']
+    boxes = [(min(x for x, y in row[Shape][0]), min(y for x, y in row[Shape][0]),
+              max(x for x, y in row[Shape][0]), max(y for x, y in row[Shape][0])) for row in rows]
+    expected = 0
+    for i in range(len(rows)):
+        for j in range(i + 1, len(rows)):
+            if rows[i]['Info_Source'] != rows[j]['Info_Source'] and \
+               boxes[i][0] <= boxes[j][2] and boxes[j][0] <= boxes[i][2] and \
+               boxes[i][1] <= boxes[j][3] and boxes[j][1] <= boxes[i][3] and \
+               IntersectionArea(rows[i][Shape], rows[j][Shape]) > 0.0:
+                expected += 1
+    assert stats['overlaps'] == expected, (stats['overlaps'], expected)
+    shutil.rmtree(os.path.dirname(report))
+    print 'Overlap self test passed: %d cases, %d overlaps found by brute force and by Check()' % (len(cases), expected)
+
+def Synthetic(parcels, jurisdictions=7, size=100.0, shift=0.5, seed=1):
+    # A grid of parcels (12 vertices each) in vertical bands, one per jurisdiction. The first
+    # column of each band is pushed left by shift so it overlaps the band before it, and a few
+    # parcels are jittered more.
+    rng = random.Random(seed)
+    columns = int(math.sqrt(parcels)) or 1
+    band = int(math.ceil(columns / float(jurisdictions)))
+    memory = Backends.MemoryBackend()
+    rows = []
+    for n in range(parcels):
+        c, r = n % columns, n // columns
+        x, y = c * size, r * size
+        if c and c % band == 0:
+            x -= shift
+        if rng.random() < 0.01:
+            x += rng.uniform(-size / 4, size / 4)
+        corners = [(x, y), (x, y + size), (x + size, y + size), (x + size, y), (x, y)]
+        ring = []
+        for (x1, y1), (x2, y2) in zip(corners, corners[1:]):
+            ring.extend([(x1 + (x2 - x1) * k / 3.0, y1 + (y2 - y1) * k / 3.0) for k in range(3)])
+        ring.append(ring[0])
+        rows.append({'Parcel_ID': 'P%d' % n, 'Info_Source': 'Source %d' % (c // band), Shape: [ring]})
+    memory.tables['Parcels'] = rows
+    return memory
+
+def Benchmark(parcels=300000, workers=None):
+    # Check() on a synthetic service area, no arcpy needed
+    memory = Synthetic(parcels)
+    report = os.path.join(tempfile.mkdtemp(), 'Overlaps.csv')
+    stats = Check(memory, 'Parcels', report, workers=workers)
+    shutil.rmtree(os.path.dirname(report))
+    print '%d parcels: %.1f s (%.0f parcels/sec)' % (parcels, stats['seconds'], parcels / stats['seconds'])
+    return stats
+
+if __name__ == '__main__':
+    SelfTest()
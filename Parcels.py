@@ -0,0 +1,238 @@
+"""
+Name:     Parcels.py
+Purpose:  One command line for the monthly update
+
+          python Parcels.py [--config Parcels.cfg] <command>
+
+          start      [--fresh] [--dry-run]          today's folder and geodatabase
+          fetch      [--workers N]                  download the web archives (FetchSources)
+          normalize  [KEY ...] [--parallel] [--dry-run]
+                                                    fetch and normalize jurisdictions, all by default
+          finish     [--keep-intermediates] [--merge-policy flag|precedence] [--dry-run]
+                                                    merge --> RealPropertyParcel, overlap check, email
+          publish    [--full | --swap | --rollback] [--dry-run]
+                                                    apply RealPropertyParcel to sde (UpdateData), or
+                                                    stage it and swap it in (SwapUpdate)
+          report     [--date yyyymmdd]              run report and checkpoint status of a run
+          changes    [--old FC] [--email]           parcels added, retired, renamed or changed (Changes.py)
+          archive    [--list | --restore NAME [--output FC] | --drop NAME | --gc [--keep N]]
+                                                    store today's parcels in Data\Archive (Archive.py)
+          bench      [PARCELS] [--columnar] [--startup]
+                                                    stage benchmark, or command line startup times
+
+          Settings come from Config.py, resolved once before anything else. arcpy (through
+          MonthlyParcelUpdate) and NumPy are only imported by the commands that run stages, so
+          --help, report and the --dry-run plans start quickly. Benchmark.Startup() times them.
+          start, normalize and finish go through Resume(), so finished stages are skipped. A
+          --dry-run lists what the checkpoint manifest says about each stage instead.
+
+"""
+
+import argparse, os, sys
+import Config
+
+## Stages of Resume() in run order
+Keys = ['WB', 'YC', 'POQ', 'NN', 'JCC', 'HAM', 'NKC']
+Stages = ['Start'] + Keys + ['Finish']
+
+############################################################################################
+
+def Update():
+    # MonthlyParcelUpdate (and arcpy) on first use
+    import MonthlyParcelUpdate
+    return MonthlyParcelUpdate
+
+def Plan(names, fresh=False):
+    # What Resume(only=names) would do going by the checkpoint manifest - no arcpy
+    import Checkpoint
+    manifest = {} if fresh else Checkpoint.Load(Config.CheckpointManifest)
+    print 'Run folder %s (%s)' % (Config.RunFolder, Config.Path or 'default settings')
+    if fresh and os.path.exists(Config.RunFolder):
+        print '\tthe folder would be set aside first'
+    for name in names:
+        entry = manifest.get(name)
+        if not entry:
+            status = 'would run'
+        elif entry['status'] == 'failed':
+            status = 'would run again - failed %s: %s' % (entry['finished'], entry['error'])
+        else:
+            status = 'done %s - skipped unless its inputs or outputs changed' % entry['finished']
+        print '\t%-8s %s' % (name, status)
+    return 0
+
+def Resume(names, args, keepIntermediates=False):
+    if args.dry_run:
+        return Plan(names, getattr(args, 'fresh', False))
+    status = Update().Resume(only=names, fresh=getattr(args, 'fresh', False), keepIntermediates=keepIntermediates)
+    return 1 if 'failed' in status.values() else 0
+
+############################################################################################
+
+def StartCommand(args):
+    return Resume(['Start'], args)
+
+def FetchCommand(args):
+    Update().FetchSources(args.workers)
+    return 0
+
+def NormalizeCommand(args):
+    keys = args.keys or Keys
+    for key in keys:
+        if key not in Keys:
+            raise SystemExit('Unknown jurisdiction %s - jurisdictions are %s' % (key, ', '.join(Keys)))
+    if args.parallel and not args.dry_run:
+        status = Update().ProcessParallel(args.workers, keys)
+        return 1 if [s for s in status.values() if s['status'] != 'done'] else 0
+    return Resume(keys, args)
+
+def FinishCommand(args):
+    if not args.dry_run:
+        update = Update()
+        update.MergePolicy = args.merge_policy
+    return Resume(['Finish'], args, args.keep_intermediates)
+
+def PublishCommand(args):
+    if args.dry_run and (args.swap or args.rollback):
+        # The renames only - SwapUpdate() would also load and index the staging layer first
+        import Backends, Staging
+        update = Update()
+        print '%s of %s would:' % ('Rollback' if args.rollback else 'Swap', update.SwapParcels)
+        for step in Staging.Plan(Backends.ArcpyBackend(update.SwapWorkspace), update.SwapParcels, args.rollback):
+            print '\t' + step
+        return 0
+    if args.rollback:
+        Update().RollbackUpdate()
+    elif args.swap:
+        Update().SwapUpdate()
+    else:
+        Update().UpdateData(delta=not args.full, dryRun=args.dry_run, batchSize=args.batch_size)
+    return 0
+
+def ReportCommand(args):
+    import Checkpoint, Instrument
+    folder = Config.Folder(args.date) if args.date else Config.RunFolder
+    records = Instrument.Load(folder + os.sep + 'RunReport.ndjson')
+    print 'Run folder ' + folder
+    if records:
+        print Instrument.Summary(records)
+    else:
+        print 'No run report'
+    manifest = Checkpoint.Load(folder + os.sep + 'Checkpoint.json')
+    for name in Stages:
+        if name in manifest:
+            entry = manifest[name]
+            print '\t%-8s %-6s %s' % (name, entry['status'], entry['finished'])
+    return 1 if Instrument.Failed(records) else 0
+
+def ChangesCommand(args):
+    Update().DetectChanges(args.old, args.email)
+    return 0
+
+def ArchiveCommand(args):
+    if args.restore:
+        Update().RestoreParcels(args.restore, args.output)
+        return 0
+    if not (args.list or args.drop or args.gc):
+        Update().ArchiveParcels()
+    import Archive
+    store = Archive.Store(Config.ArchivePath)
+    try:
+        if args.drop and not store.Drop(args.drop):
+            raise SystemExit('No snapshot %s in %s' % (args.drop, Config.ArchivePath))
+        if args.gc:
+            store.Collect(args.keep)
+        if args.list:
+            for name, created, rows in store.Snapshots():
+                print '\t%-14s %8d parcels  stored %s' % (name, rows, created)
+        print Archive.Report(store.Stats())
+    finally:
+        store.Close()
+    return 0
+
+def BenchCommand(args):
+    import Benchmark
+    if args.startup:
+        return 0 if Benchmark.Startup(args.runs) else 1
+    Benchmark.Run(args.parcels, columnar=args.columnar)
+    Benchmark.Compare()
+    return 0
+
+############################################################################################
+
+def Parser():
+    parser = argparse.ArgumentParser(prog='Parcels.py', description='Monthly parcel update')
+    parser.add_argument('--config', help='settings file (default PARCEL_CONFIG or Parcels.cfg next to the scripts)')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('start', help="today's folder and geodatabase")
+    command.add_argument('--fresh', action='store_true', help="set today's folder aside and start over (nothing is deleted)")
+    command.add_argument('--dry-run', action='store_true', help='only show what would run')
+    command.set_defaults(run=StartCommand)
+
+    command = commands.add_parser('fetch', help='download the web archives')
+    command.add_argument('--workers', type=int, default=4)
+    command.set_defaults(run=FetchCommand)
+
+    command = commands.add_parser('normalize', help='fetch and normalize jurisdictions')
+    command.add_argument('keys', nargs='*', metavar='KEY', help=', '.join(Keys) + ' (default all)')
+    command.add_argument('--parallel', action='store_true', help='one process per jurisdiction (ProcessParallel)')
+    command.add_argument('--workers', type=int, default=Config.Workers)
+    command.add_argument('--dry-run', action='store_true', help='only show what would run')
+    command.set_defaults(run=NormalizeCommand)
+
+    command = commands.add_parser('finish', help='merge, assign, RealPropertyParcel, overlap check and email')
+    command.add_argument('--keep-intermediates', action='store_true',
+                         help='also write Master_Parcels_<date> and Master_Join_2_City for debugging')
+    command.add_argument('--merge-policy', choices=['flag', 'precedence'], default=Config.MergePolicy,
+                         help='parcel IDs in two jurisdictions: flag keeps both, precedence keeps MergePrecedence order')
+    command.add_argument('--dry-run', action='store_true', help='only show what would run')
+    command.set_defaults(run=FinishCommand)
+
+    command = commands.add_parser('publish', help='apply RealPropertyParcel to sde')
+    mode = command.add_mutually_exclusive_group()
+    mode.add_argument('--full', action='store_true', help='delete and append every parcel instead of the changes')
+    mode.add_argument('--swap', action='store_true', help='load and index a staging layer, then rename it into place')
+    mode.add_argument('--rollback', action='store_true', help='swap the layer from before the last --swap back in')
+    command.add_argument('--batch-size', type=int, default=1000, help='parcels saved to the version at a time')
+    command.add_argument('--dry-run', action='store_true',
+                         help='count the inserts/updates/deletes, or with --swap/--rollback list the renames (reads sde)')
+    command.set_defaults(run=PublishCommand)
+
+    command = commands.add_parser('report', help='run report and checkpoint status')
+    command.add_argument('--date', help='yyyymmdd of an earlier run (default the configured date)')
+    command.set_defaults(run=ReportCommand)
+
+    command = commands.add_parser('changes', help='parcels added, retired, renamed or changed since last month')
+    command.add_argument('--old', metavar='FC', help='last month\'s parcels (default the OLD_RealPropertyParcel backup, else sde)')
+    command.add_argument('--email', action='store_true', help='send the run email with the per-jurisdiction summary')
+    command.set_defaults(run=ChangesCommand)
+
+    command = commands.add_parser('archive', help="store today's parcels in the dedup archive")
+    command.add_argument('--list', action='store_true', help='list the snapshots')
+    command.add_argument('--restore', metavar='NAME', help='rebuild snapshot NAME (yyyymmdd or yyyymmdd_OLD)')
+    command.add_argument('--output', metavar='FC', help="feature class to restore to (default RealPropertyParcel_NAME in today's gdb)")
+    command.add_argument('--drop', metavar='NAME', help='forget snapshot NAME (its parcels are freed by --gc)')
+    command.add_argument('--gc', action='store_true', help='delete what no snapshot uses and compact the store')
+    command.add_argument('--keep', type=int, help='with --gc, drop all but the newest N snapshots first')
+    command.set_defaults(run=ArchiveCommand)
+
+    command = commands.add_parser('bench', help='stage benchmark on synthetic data')
+    command.add_argument('parcels', nargs='?', type=int, default=100000)
+    command.add_argument('--columnar', action='store_true', help='normalize to Columnar files')
+    command.add_argument('--startup', action='store_true', help='time --help, report and the dry runs instead')
+    command.add_argument('--runs', type=int, default=5)
+    command.set_defaults(run=BenchCommand)
+    return parser
+
+def Main(argv=None):
+    # --config first, so the other defaults come from it
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument('--config')
+    known, rest = pre.parse_known_args(argv)
+    if known.config:
+        Config.Load(known.config)
+    args = Parser().parse_args(argv)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,261 @@
+"""
+Name:     Pipeline.py
+Purpose:  Finish() as one stream of rows instead of a feature class per step
+
+          Merge --> zip code / city --> area --> address --> final schema --> RealPropertyParcel
+
+          Each stage is a generator of {field: value} rows. The jurisdiction feature classes
+          are read once and RealPropertyParcel is written once through a single insert
+          cursor - no Master_Parcels, Master_Join_1_ZipCode, Master_Join_2_City copies and no
+          AddField/CalculateField passes over the finished table. Tee() writes a stage out
+          when the intermediates are wanted for debugging.
+
+          Dedup indexes _Parcel_ID_ by jurisdiction as the rows are merged, to catch a parcel
+          delivered by two jurisdictions along a shared boundary (JCC/WB, YC/POQ).
+
+"""
+
+import csv, itertools, time
+import Address, Columnar, FieldMap, Geometry, Join, SpatialIndex
+from Backends import Shape
+
+############################################################################################
+
+class Dedup(object):
+    # Parcel ID index across the merged jurisdictions - only the ID and a jurisdiction number
+    # are kept per parcel, never the rows.
+    # policy 'flag'       - every row is kept, duplicates are counted and written to report
+    #        'precedence' - inputs are merged in precedence order and a parcel already merged
+    #                       from another jurisdiction is dropped
+    # tags = {input: jurisdiction}. The same ID twice in one jurisdiction is left alone.
+    Policies = ('flag', 'precedence')
+
+    def __init__(self, field='_Parcel_ID_', policy='flag', precedence=(), tags=None, report=None):
+        if policy not in self.Policies:
+            raise ValueError('Merge policy must be one of ' + ', '.join(self.Policies))
+        self.field = field
+        self.policy = policy
+        self.precedence = list(precedence)
+        self.tags = tags or {}
+        self.report = report
+        self.file = None
+        self.index = {}
+        self.names = []
+        self.numbers = {}
+        self.rows = {}
+        self.kept = {}
+        self.duplicates = self.resolved = self.repeats = self.missing = 0
+
+    def Tag(self, table):
+        return self.tags.get(table, table)
+
+    def Order(self, inputs):
+        if self.policy != 'precedence':
+            return list(inputs)
+        rank = dict((tag, i) for i, tag in enumerate(self.precedence))
+        return sorted(inputs, key=lambda table: rank.get(self.Tag(table), len(rank)))
+
+    def Keep(self, tag, row):
+        # True if row goes on to the output
+        self.rows[tag] = self.rows.get(tag, 0) + 1
+        key = Join.Key(row.get(self.field))
+        if key is None:
+            self.missing += 1
+        else:
+            if tag not in self.numbers:
+                self.numbers[tag] = len(self.names)
+                self.names.append(tag)
+            number = self.numbers[tag]
+            first = self.index.get(key)
+            if first is None:
+                self.index[key] = number
+            elif first == number:
+                self.repeats += 1
+            else:
+                self.duplicates += 1
+                drop = self.policy == 'precedence'
+                self.Report(key, self.names[first], tag, 'dropped' if drop else 'kept both')
+                if drop:
+                    self.resolved += 1
+                    return False
+        self.kept[tag] = self.kept.get(tag, 0) + 1
+        return True
+
+    def Report(self, key, first, second, action):
+        if not self.report:
+            return
+        if self.file is None:
+            self.file = open(self.report, 'wb')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(['Parcel_ID', 'Merged_From', 'Duplicate_From', 'Action'])
+        self.writer.writerow([key.encode('utf-8'), first, second, action])
+
+    def Close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def Stats(self):
+        return {'policy': self.policy, 'rows': self.rows, 'kept': self.kept, 'duplicates': self.duplicates,
+                'resolved': self.resolved, 'repeats': self.repeats, 'missing_ids': self.missing,
+                'report': self.report if self.duplicates else None}
+
+def Merge(backend, inputs, fields, dedup=None, wkt=None):
+    # Same rows as Merge_management of the inputs, keeping only fields. Inputs can be tables
+    # of backend or Columnar files, and are read one after another as a stream. A Columnar
+    # file's rings are in the spatial reference it was written with - with the output's wkt
+    # they are projected to it like Merge_management does, or refused if backend can't.
+    columns = list(fields) + [Shape]
+    files = Columnar.ColumnarBackend()
+    try:
+        for table in (dedup.Order(inputs) if dedup else inputs):
+            reader = files if Columnar.IsColumnar(table) else backend
+            tag = dedup.Tag(table) if dedup else None
+            project = None
+            if reader is files and not Geometry.SameCoordinates(files.SpatialReference(table), wkt):
+                if not hasattr(backend, 'Project'):
+                    raise ValueError('%s is not in the output spatial reference and %s cannot project it'
+                                     % (table, backend.__class__.__name__))
+                project = (files.SpatialReference(table), wkt)
+                print '	Projecting ' + table
+            for row in reader.Search(table, columns):
+                row = dict(zip(columns, row))
+                if project and row[Shape]:
+                    row[Shape] = backend.Project(row[Shape], *project)
+                if dedup is None or dedup.Keep(tag, row):
+                    yield row
+    finally:
+        files.Close()
+        if dedup is not None:
+            dedup.Close()
+
+def MergeSummary(stats):
+    # One line per jurisdiction and the duplicate counts, for the log
+    lines = ['\t%-8s %8d rows %8d merged' % (tag, rows, stats['kept'].get(tag, 0))
+             for tag, rows in sorted(stats['rows'].items())]
+    lines.append('\t%(duplicates)d parcel IDs in more than one jurisdiction, %(resolved)d dropped (%(policy)s), '
+                 '%(repeats)d repeated within one, %(missing_ids)d without an ID' % stats)
+    return '\n'.join(lines)
+
+def Locate(backend, rows, targets, cache=None, chunk=SpatialIndex.Chunk):
+    # targets = [(field, PolygonIndex)] - same answer as SpatialIndex.Assign()
+    while True:
+        block = list(itertools.islice(rows, chunk))
+        if not block:
+            break
+        if cache is not None:
+            found = SpatialIndex.Locate(backend, [(i, row[Shape]) for i, row in enumerate(block)], targets, cache)
+        for i, row in enumerate(block):
+            if cache is not None:
+                values = found[i]
+            else:
+                center = backend.Center(row[Shape])
+                values = [index.Lookup(*center) if center else None for field, index in targets]
+            for (field, index), value in zip(targets, values):
+                row[field] = value
+            yield row
+
+def Areas(backend, rows, squareFeet, acres, stored=None, wkt=None):
+    # Same as round(!shape.area@SQUAREFEET!, 2) and round(!shape.area@ACRES!, 2). stored =
+    # (square feet, acres) fields already holding the areas, as Columnar files do. wkt is the
+    # spatial reference of shapes read as rings.
+    for row in rows:
+        if stored and row.get(stored[0]) is not None:
+            sqft, ac = row[stored[0]], row[stored[1]]
+        else:
+            sqft, ac = backend.Areas(row[Shape], wkt)
+        row[squareFeet] = round(sqft, 2) if sqft is not None else None
+        row[acres] = round(ac, 2) if ac is not None else None
+        yield row
+
+def Addresses(rows, houseNumber, street, chunk=SpatialIndex.Chunk):
+    # FixHouseNo() / FixStreet() of the temp fields, a block of rows at a time (Address.Fix)
+    while True:
+        block = list(itertools.islice(rows, chunk))
+        if not block:
+            break
+        fixedHouse, fixedStreet = Address.Fix([row[houseNumber] for row in block], [row[street] for row in block])
+        for row, h, s in zip(block, fixedHouse, fixedStreet):
+            row['HouseNumber'] = h
+            row['Street'] = s
+            yield row
+
+def Map(rows, mapping):
+    # FieldMap mapping of (target, source) applied to each row
+    mapping = FieldMap.Bind(mapping)
+    for row in rows:
+        yield FieldMap.MapRow(mapping, row)
+
+def Tee(backend, rows, table, schema, template=None):
+    # Writes a copy of every row passing through to table
+    fields = [name for name, fieldType, length in schema] + [Shape]
+    backend.CreateTable(table, schema, template)
+    with backend.Writer(table, fields) as writer:
+        for row in rows:
+            writer.Write([row.get(field) for field in fields])
+            yield row
+    print '\tKept %d rows in %s' % (writer.count, table)
+
+def Write(backend, rows, table, schema, template=None):
+    fields = [name for name, fieldType, length in schema] + [Shape]
+    backend.CreateTable(table, schema, template)
+    with backend.Writer(table, fields) as writer:
+        for row in rows:
+            writer.Write([row.get(field) for field in fields])
+    return writer.count
+
+############################################################################################
+
+def Template(inputs):
+    # Spatial reference for the output - the first input, or the well known text it was written with
+    if not inputs:
+        return None
+    if Columnar.IsColumnar(inputs[0]):
+        files = Columnar.ColumnarBackend()
+        try:
+            return files.SpatialReference(inputs[0])
+        finally:
+            files.Close()
+    return inputs[0]
+
+def Wkt(backend, template):
+    # Well known text of a Template(), None if backend can't tell
+    if template is None or (isinstance(template, basestring) and template.startswith(('PROJCS', 'GEOGCS'))):
+        return template
+    if not hasattr(backend, 'SpatialReference'):
+        return None
+    spatialReference = backend.SpatialReference(template)
+    return spatialReference.exportToString() if hasattr(spatialReference, 'exportToString') else spatialReference
+
+def Run(backend, inputs, fields, output, schema, mapping, targets, cache=None, intermediates=None, dedup=None):
+    # inputs    = jurisdiction feature classes (or Columnar files) with the temp fields filled
+    # fields    = temp fields read from the inputs
+    # schema    = [(name, type, length)] of output, in output field order
+    # mapping   = FieldMap mapping from the temp fields to schema
+    # targets   = [(temp field, PolygonIndex)] for zip code and city
+    # intermediates = {'merge': (table, schema), 'locate': (table, schema)} to keep stages
+    # dedup     = Dedup for duplicate parcel IDs across the inputs
+    intermediates = intermediates or {}
+    start = time.time()
+    template = Template(inputs)
+    wkt = Wkt(backend, template)
+    SpatialIndex.Check(targets, wkt)
+
+    rows = Merge(backend, inputs, fields, dedup, wkt)
+    if 'merge' in intermediates:
+        rows = Tee(backend, rows, intermediates['merge'][0], intermediates['merge'][1], template)
+    rows = Locate(backend, rows, targets, cache)
+    if 'locate' in intermediates:
+        rows = Tee(backend, rows, intermediates['locate'][0], intermediates['locate'][1], template)
+    rows = Areas(backend, rows, 'Square_Feet', 'Acres_US', Columnar.AreaFields, wkt)
+    rows = Addresses(rows, '_HouseNumber_', '_Street_')
+    rows = Map(rows, mapping)
+    count = Write(backend, rows, output, schema, template)
+
+    elapsed = time.time() - start
+    print '\tWrote %d parcels to %s in %.1f s (%.0f rows/sec)' % (count, output, elapsed, count / elapsed if elapsed else 0.0)
+    if cache is not None:
+        print '\tAssignment cache: %(hits)d hits, %(misses)d misses' % cache.Stats()
+    if dedup is not None:
+        print MergeSummary(dedup.Stats())
+    return count
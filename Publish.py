@@ -0,0 +1,376 @@
+"""
+Name:     Publish.py
+Purpose:  Apply only what changed to the sde parcel layer
+
+          Diff() compares the new RealPropertyParcel against the OLD_RealPropertyParcel_<date>
+          backup that UpdateData() takes. Parcels are keyed on Parcel_ID and compared with a
+          fingerprint of their attributes (EditDate/EditBy left out - they change every month)
+          and their geometry. Apply() then deletes, updates and inserts only those parcels, in
+          batches, instead of DeleteFeatures + Append of every parcel. FullUpdate() reloads
+          every parcel through the same batches.
+
+          Each batch is its own edit session and operation, so it is saved to the version
+          before the next one starts. A reader thread fills a queue of at most QueueBatches
+          batches from the new table while the main thread writes them. With a progress file,
+          every saved batch is recorded. Running again with the same changes skips what was
+          saved and carries on after the last saved batch.
+
+          Works with any of the Backends - SqliteBackend stands in for sde when testing locally,
+          and BatchBenchmark() times batch sizes against it.
+
+"""
+
+import hashlib, json, os, random, shutil, tempfile, threading, time, Queue
+import Backends, Checkpoint, Geometry
+from Backends import Shape
+
+Key = 'Parcel_ID'
+
+## Changed every run, so not part of the fingerprint
+Ignore = ['EditDate', 'EditBy']
+
+BatchSize = 1000
+
+## Batches read ahead of the writer
+QueueBatches = 4
+
+## Progress is printed every this many batches
+ReportEvery = 10
+
+############################################################################################
+
+def Value(value):
+    # sde and the file gdb don't agree on '' vs null or on the last digits of a double
+    if value is None:
+        return u''
+    if isinstance(value, float):
+        return u'%.2f' % value
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return unicode(value).strip()
+
+def RowFingerprint(values, rings):
+    sha = hashlib.sha1()
+    for value in values:
+        sha.update(Value(value).encode('utf-8'))
+        sha.update('\x00')
+    sha.update(Geometry.Fingerprint(rings))
+    return sha.digest()
+
+def Fingerprints(backend, table, fields, key=Key):
+    # {key: [fingerprint, ...]} - more than one when a Parcel_ID is repeated
+    compare = [field for field in fields if field != key and field not in Ignore]
+    index = {}
+    for row in backend.Search(table, [key] + compare + [Shape]):
+        index.setdefault(row[0], []).append(RowFingerprint(row[1:-1], backend.Rings(row[-1])))
+    return index
+
+def Diff(newBackend, newTable, oldBackend, oldTable, fields, key=Key):
+    # Returns {'insert', 'update', 'delete', 'replace'} sets of keys. Repeated or null keys
+    # can't be matched row for row, so those are replaced (delete all then insert all).
+    start = time.time()
+    new = Fingerprints(newBackend, newTable, fields, key)
+    old = Fingerprints(oldBackend, oldTable, fields, key)
+    changes = {'insert': set(), 'update': set(), 'delete': set(), 'replace': set()}
+    for k, prints in new.iteritems():
+        before = old.get(k)
+        if before is None:
+            changes['insert' if k is not None else 'replace'].add(k)
+        elif sorted(before) == sorted(prints):
+            continue
+        elif len(before) == 1 and len(prints) == 1 and k is not None:
+            changes['update'].add(k)
+        else:
+            changes['replace'].add(k)
+    for k in old:
+        if k not in new:
+            changes['delete'].add(k)
+    changes['unchanged'] = len(new) - sum(len(changes[c]) for c in ('insert', 'update', 'replace'))
+    print '\tDiff of %d new and %d old Parcel_IDs in %.1f s' % (len(new), len(old), time.time() - start)
+    return changes
+
+def Summary(changes):
+    return ', '.join('%s %d' % (c, len(changes[c])) for c in ('insert', 'update', 'delete', 'replace')) + \
+           ', unchanged %d' % changes['unchanged']
+
+def Batches(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def ChangesetId(changes):
+    # Same changes, same id - a progress file only resumes the changeset it was written for
+    sha = hashlib.sha1()
+    for change in ('insert', 'update', 'delete', 'replace'):
+        sha.update(change + json.dumps(sorted(Value(k) if k is not None else None for k in changes[change])))
+    return sha.hexdigest()
+
+def Progress(path, changes, batchSize):
+    # Saved progress of this changeset, or a new record
+    progress = Checkpoint.Load(path) if path else {}
+    if progress.get('id') == ChangesetId(changes) and not progress.get('finished'):
+        print '\tResuming: %(delete)d delete, %(update)d update and %(insert)d insert batches already saved' % progress['batches']
+        progress['resumed'] = True
+        return progress
+    return {'id': ChangesetId(changes), 'batch_size': batchSize, 'deleted': False,
+            'batches': {'delete': 0, 'update': 0, 'insert': 0}, 'rows': {'delete': 0, 'update': 0, 'insert': 0},
+            'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'finished': None, 'resumed': False}
+
+def InProgress(path):
+    # True if a publish recorded in path was interrupted
+    progress = Checkpoint.Load(path) if path and os.path.exists(path) else {}
+    return bool(progress) and not progress.get('finished')
+
+def Produce(backend, table, fields, keyIndex, route, skip, batchSize, queue):
+    # Reader thread: (change, rows, keys saved earlier) batches onto queue, then None. The
+    # first skip[change] batches of each change were saved by an earlier run and are not queued.
+    try:
+        batches = {'update': [], 'insert': []}
+        counts = {'update': 0, 'insert': 0}
+        saved = set()
+        for row in backend.Search(table, fields):
+            change = route(row[keyIndex])
+            if change is None:
+                continue
+            batch = batches[change]
+            batch.append(row)
+            if len(batch) == batchSize:
+                if counts[change] < skip[change]:
+                    if change == 'insert':
+                        saved.update(r[keyIndex] for r in batch)
+                else:
+                    queue.put((change, batch, saved if change == 'insert' else None))
+                counts[change] += 1
+                batches[change] = []
+        for change, batch in sorted(batches.items()):
+            if batch and counts[change] >= skip[change]:
+                queue.put((change, batch, saved if change == 'insert' else None))
+        queue.put(None)
+    except Exception as e:
+        queue.put(e)
+
+def Reinsert(target, table, key, fields, rows, keys):
+    target.DeleteByKey(table, key, keys)
+    return target.Insert(table, fields, rows)
+
+def Apply(changes, newBackend, newTable, target, targetTable, fields, key=Key, batchSize=BatchSize, dryRun=False,
+          progress=None, full=False):
+    # Writes the changes to targetTable one saved batch at a time. progress = JSON path to
+    # resume from. full deletes every row of targetTable first (changes['insert'] is then all
+    # of newTable). Returns the changes with the row counts and rows/sec under 'published'.
+    print '\tChangeset: ' + Summary(changes)
+    if dryRun:
+        return changes
+
+    start = time.time()
+    fields = list(fields) + [Shape]
+    keyIndex = fields.index(key)
+    state = Progress(progress, changes, batchSize)
+    batchSize = state['batch_size']
+    timing = {'rows': 0, 'start': time.time()}
+
+    def Commit(change, write):
+        with target.Edit():
+            with target.Operation():
+                rows = write()
+        state['rows'][change] += rows
+        state['batches'][change] += 1
+        if progress:
+            Checkpoint.Save(progress, state)
+        timing['rows'] += rows
+        if sum(state['batches'].values()) % ReportEvery == 0:
+            elapsed = time.time() - timing['start']
+            print '\t\t%(delete)d delete, %(update)d update, %(insert)d insert batches saved' % state['batches'] + \
+                  ' (%.0f rows/sec)' % (timing['rows'] / elapsed if elapsed else 0.0)
+
+    if not state['deleted']:
+        if full:
+            # What is left to delete - a resumed full reload starts the deletes over
+            keys = sorted(set(row[0] for row in target.Search(targetTable, [key])))
+            state['batches']['delete'] = 0
+        else:
+            keys = sorted(changes['delete'] | changes['replace'])
+        for i, batch in enumerate(Batches(keys, batchSize)):
+            if i >= state['batches']['delete']:
+                Commit('delete', lambda: target.DeleteByKey(targetTable, key, batch))
+        state['deleted'] = True
+
+    inserts = changes['insert'] | changes['replace']
+    updates = changes['update']
+    route = lambda k: 'insert' if k in inserts else 'update' if k in updates else None
+    queue = Queue.Queue(QueueBatches)
+    reader = threading.Thread(target=Produce, args=(newBackend, newTable, fields, keyIndex, route,
+                                                    dict(state['batches']), batchSize, queue))
+    reader.daemon = True
+    reader.start()
+    recheck = state['resumed']
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        change, rows, saved = item
+        if change == 'update':
+            Commit('update', lambda: target.UpdateByKey(targetTable, key, fields, dict((row[keyIndex], row) for row in rows)))
+        elif recheck:
+            # The batch after the last recorded one may have been saved before the record was
+            # written - clear its parcels so they aren't inserted twice
+            keys = set(row[keyIndex] for row in rows) - saved
+            Commit('insert', lambda: Reinsert(target, targetTable, key, fields, rows, keys))
+            recheck = False
+        else:
+            Commit('insert', lambda: target.Insert(targetTable, fields, rows))
+    reader.join()
+
+    elapsed = time.time() - start
+    counts = state['rows']
+    total = timing['rows']
+    state['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    state['seconds'] = round(elapsed, 3)
+    state['rows_per_sec'] = round(total / elapsed, 1) if elapsed else None
+    if progress:
+        Checkpoint.Save(progress, state)
+    print '\tDeleted %(delete)d, updated %(update)d, inserted %(insert)d rows' % counts + \
+          ' - %d this run in %.1f s (%.0f rows/sec, batches of %d)' % (total, elapsed, total / elapsed if elapsed else 0.0, batchSize)
+    changes['published'] = {'rows': counts, 'batches': state['batches'], 'seconds': state['seconds'],
+                            'rows_per_sec': state['rows_per_sec'], 'batch_size': batchSize}
+    return changes
+
+def DeltaUpdate(newTable, oldTable, targetTable, fields, backend=None, target=None, batchSize=BatchSize, dryRun=False,
+                progress=None):
+    # newTable/oldTable read with backend, changes written to targetTable with target
+    if backend is None:
+        backend = Backends.ArcpyBackend()
+    if target is None:
+        target = backend
+    changes = Diff(backend, newTable, backend, oldTable, fields)
+    return Apply(changes, backend, newTable, target, targetTable, fields, batchSize=batchSize, dryRun=dryRun,
+                 progress=progress)
+
+def FullUpdate(newTable, targetTable, fields, backend=None, target=None, batchSize=BatchSize, dryRun=False,
+               progress=None, key=Key):
+    # Every row of targetTable deleted and every row of newTable inserted, in saved batches
+    if backend is None:
+        backend = Backends.ArcpyBackend()
+    if target is None:
+        target = backend
+    changes = {'insert': set(row[0] for row in backend.Search(newTable, [key])),
+               'update': set(), 'delete': set(), 'replace': set(), 'unchanged': 0}
+    return Apply(changes, backend, newTable, target, targetTable, fields, key, batchSize, dryRun, progress, full=True)
+
+############################################################################################
+
+Fields = ['Parcel_ID', 'Name_Owner', 'Square_Feet']
+
+def Synthetic(parcels, seed=1, changed=0.05):
+    # (new, old) MemoryBackend tables of square parcels - old has changed of them edited,
+    # missing or extra
+    rng = random.Random(seed)
+    memory = Backends.MemoryBackend()
+    new, old = [], []
+    for n in range(parcels):
+        x, y = (n % 500) * 100.0, (n // 500) * 100.0
+        row = {'Parcel_ID': u'P%06d' % n, 'Name_Owner': u'OWNER %d' % rng.randint(1, parcels),
+               'Square_Feet': 10000.0, Shape: [[(x, y), (x, y + 100), (x + 100, y + 100), (x + 100, y), (x, y)]]}
+        roll = rng.random()
+        if roll >= changed:
+            new.append(row)
+            old.append(dict(row))
+        elif roll < changed / 3:
+            new.append(row)
+        elif roll < changed * 2 / 3:
+            old.append(row)
+        else:
+            new.append(row)
+            old.append(dict(row, Name_Owner=u'EARLIER OWNER'))
+    memory.tables['New'] = new
+    memory.tables['Old'] = old
+    return memory
+
+def Target(memory, path, table='Old'):
+    # SqliteBackend at path holding a copy of table
+    target = Backends.SqliteBackend(path)
+    target.CreateTable('Parcels', [('Parcel_ID', 'TEXT', 20), ('Name_Owner', 'TEXT', 100), ('Square_Feet', 'DOUBLE', 0)])
+    target.Insert('Parcels', Fields + [Shape], memory.Search(table, Fields + [Shape]))
+    target.connection.execute('CREATE INDEX Parcels_Parcel_ID ON Parcels (Parcel_ID)')
+    return target
+
+class Interrupt(Exception):
+    pass
+
+class Interrupted(object):
+    # target that fails on the writes after the first `after`. late makes the failing write
+    # go through first, as if the run stopped before its progress was recorded.
+    def __init__(self, target, after, late=False):
+        self.target = target
+        self.after = after
+        self.late = late
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if name not in ('Insert', 'UpdateByKey', 'DeleteByKey'):
+            return attribute
+        def Write(*args):
+            if self.after <= 0:
+                if self.late:
+                    attribute(*args)
+                raise Interrupt('publish interrupted')
+            self.after -= 1
+            return attribute(*args)
+        return Write
+
+def SelfTest(parcels=5000):
+    # Delta and full publishes to sqlite, each interrupted part way and resumed, must leave the
+    # target the same as the new table
+    folder = tempfile.mkdtemp()
+    try:
+        memory = Synthetic(parcels)
+        expected = sorted((row[0], row[1]) for row in memory.Search('New', ['Parcel_ID', 'Name_Owner']))
+        for name, after, late in (('delta', 9, False), ('full', 60, False), ('delta', 10, True), ('full', 70, True)):
+            target = Target(memory, os.path.join(folder, '%s%d.sqlite' % (name, after)))
+            progress = os.path.join(folder, '%s%d.json' % (name, after))
+            def Run(writer):
+                if name == 'delta':
+                    changes = Diff(memory, 'New', memory, 'Old', Fields)
+                    return Apply(changes, memory, 'New', writer, 'Parcels', Fields, batchSize=25, progress=progress)
+                return FullUpdate('New', 'Parcels', Fields, memory, writer, batchSize=100, progress=progress)
+            try:
+                Run(Interrupted(target, after, late))
+                raise AssertionError('not interrupted')
+            except Interrupt:
+                pass
+            assert InProgress(progress)
+            Run(target)
+            assert not InProgress(progress)
+            actual = sorted(target.Search('Parcels', ['Parcel_ID', 'Name_Owner']))
+            assert actual == expected, name + ' publish differs from the new table after resuming'
+            target.connection.close()
+        print 'Publish self test passed: delta and full publishes resumed after interruptions'
+    finally:
+        shutil.rmtree(folder)
+
+def BatchBenchmark(parcels=100000, sizes=(100, 500, 1000, 5000, 20000), full=True):
+    # Rows/sec of a publish to a sqlite target for each batch size
+    memory = Synthetic(parcels)
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        for size in sizes:
+            target = Target(memory, os.path.join(folder, '%d.sqlite' % size))
+            if full:
+                changes = FullUpdate('New', 'Parcels', Fields, memory, target, batchSize=size,
+                                     progress=os.path.join(folder, '%d.json' % size))
+            else:
+                changes = Apply(Diff(memory, 'New', memory, 'Old', Fields), memory, 'New', target, 'Parcels', Fields,
+                                batchSize=size, progress=os.path.join(folder, '%d.json' % size))
+            target.connection.close()
+            results.append((size, changes['published']['rows_per_sec']))
+    finally:
+        shutil.rmtree(folder)
+    for size, rate in results:
+        print '\tbatches of %6d: %8.0f rows/sec' % (size, rate)
+    return results
+
+if __name__ == '__main__':
+    SelfTest()
@@ -0,0 +1,354 @@
+"""
+Name:     RestSource.py
+Purpose:  Download a feature layer from an ArcGIS REST service - York County's AGOServices Parcels
+
+          Fetch() asks the layer for its object IDs, splits them into pages of maxRecordCount and
+          queries the pages on a few threads, each keeping its own keep-alive connection. A page
+          is retried until every object ID asked for came back (and its Content-MD5 matches, when
+          the server sends one). Features are written to the output as pages arrive, so only
+          the pages in flight are ever held in memory.
+
+          record=folder saves every response. StubServer(folder) serves them back on localhost,
+          optionally failing some requests, so a fetch can be rerun without the county server
+          (SelfTest()).
+
+"""
+
+import base64, datetime, hashlib, httplib, json, os, random, shutil, socket, tempfile, threading, time, urllib, urlparse, zlib
+import BaseHTTPServer, Queue, SocketServer
+from Backends import Shape
+
+## Esri field types --> CreateTable types. Others (OID, geometry, blobs) aren't copied.
+Types = {'esriFieldTypeString':       'TEXT',
+         'esriFieldTypeDouble':       'DOUBLE',
+         'esriFieldTypeSingle':       'FLOAT',
+         'esriFieldTypeInteger':      'LONG',
+         'esriFieldTypeSmallInteger': 'SHORT',
+         'esriFieldTypeDate':         'DATE',
+         'esriFieldTypeGUID':         'TEXT',
+         'esriFieldTypeGlobalID':     'TEXT'}
+
+## Dates come back as milliseconds since 1970
+Epoch = datetime.datetime(1970, 1, 1)
+
+############################################################################################
+
+class PageError(Exception):
+    # Incomplete or garbled response - retried
+    pass
+
+def Key(path, params):
+    # File name of a recorded response
+    return hashlib.sha1(path + '?' + urllib.urlencode(sorted(params.items()))).hexdigest() + '.json'
+
+class Connection(object):
+    # One keep-alive connection, reopened after an error
+
+    def __init__(self, url, timeout=60, record=None):
+        parts = urlparse.urlparse(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.timeout = timeout
+        self.record = record
+        self.connection = None
+        self.requests = 0
+        self.retries = 0
+        self.bytes = 0
+
+    def Get(self, path, params):
+        # Response body, checked against Content-MD5 and gunzipped
+        if self.connection is None:
+            connection = httplib.HTTPSConnection if self.https else httplib.HTTPConnection
+            self.connection = connection(self.host, timeout=self.timeout)
+        try:
+            self.connection.request('GET', path + '?' + urllib.urlencode(sorted(params.items())),
+                                    headers={'Accept-Encoding': 'gzip'})
+            response = self.connection.getresponse()
+            body = response.read()
+        except Exception:
+            self.Close()
+            raise
+        self.requests += 1
+        self.bytes += len(body)
+        if response.status != 200:
+            raise PageError('HTTP %d' % response.status)
+        md5 = response.getheader('content-md5')
+        if md5 and base64.b64encode(hashlib.md5(body).digest()) != md5:
+            raise PageError('checksum mismatch')
+        if response.getheader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if self.record:
+            with open(os.path.join(self.record, Key(path, params)), 'wb') as f:
+                f.write(body)
+        return body
+
+    def Json(self, path, params):
+        result = json.loads(self.Get(path, params))
+        if 'error' in result:
+            raise PageError('%s %s' % (result['error'].get('code'), result['error'].get('message')))
+        return result
+
+    def Close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+############################################################################################
+
+def QueryParams(where, oidField, names, first, last):
+    # Query for the object IDs first..last
+    page = '%s >= %d AND %s <= %d' % (oidField, first, oidField, last)
+    return {'where': page if where in (None, '', '1=1') else '(%s) AND %s' % (where, page),
+            'outFields': ','.join(names + [oidField]),
+            'returnGeometry': 'true',
+            'f': 'json'}
+
+def Page(connection, path, params, oidField, ids):
+    # Features of one page, only if all of ids came back. Returns (features, sha256).
+    body = connection.Get(path + '/query', params)
+    page = json.loads(body)
+    if 'error' in page:
+        raise PageError('%s %s' % (page['error'].get('code'), page['error'].get('message')))
+    features = page.get('features') or []
+    returned = set(feature['attributes'].get(oidField) for feature in features)
+    if returned != set(ids):
+        raise PageError('%d of %d features' % (len(returned & set(ids)), len(ids)))
+    return features, hashlib.sha256(body).hexdigest()
+
+def Rings(geometry):
+    # Esri JSON polygon --> rings of (x, y)
+    if not geometry or not geometry.get('rings'):
+        return None
+    return [[(point[0], point[1]) for point in ring] for ring in geometry['rings']]
+
+def Fetch(url, backend, output, fields=None, where='1=1', template=None, workers=4, pageSize=None,
+          retries=3, backoff=1.0, timeout=60, record=None):
+    # url = the layer, e.g. .../FeatureServer/0. fields = the ones to copy (all by default).
+    # template is passed to CreateTable - or a function of the layer's spatialReference dict
+    # returning it. Returns the counts and rates; raises IOError if a page never came back whole.
+    start = time.time()
+    path = urlparse.urlparse(url).path.rstrip('/')
+    main = Connection(url, timeout, record)
+    info = main.Json(path, {'f': 'json'})
+    layerFields = dict((field['name'].upper(), field) for field in info['fields'])
+    if fields is None:
+        fields = [field['name'] for field in info['fields']
+                  if field['type'] in Types and not field['name'].lower().startswith('shape')]
+    missing = [field for field in fields if field.upper() not in layerFields]
+    if missing:
+        raise ValueError('Not in the layer: ' + ', '.join(missing))
+    names = [layerFields[field.upper()]['name'] for field in fields]
+    schema = [(field, Types.get(layerFields[field.upper()]['type'], 'TEXT'),
+               layerFields[field.upper()].get('length') or 50) for field in fields]
+    dates = [i for i, field in enumerate(fields) if layerFields[field.upper()]['type'] == 'esriFieldTypeDate']
+    if callable(template):
+        template = template(info.get('extent', {}).get('spatialReference') or info.get('spatialReference'))
+
+    result = main.Json(path + '/query', {'where': where or '1=1', 'returnIdsOnly': 'true', 'f': 'json'})
+    oidField = result['objectIdFieldName']
+    ids = sorted(result.get('objectIds') or [])
+    size = pageSize or info.get('maxRecordCount') or 1000
+    pages = Queue.Queue()
+    count = 0
+    for i in range(0, len(ids), size):
+        pages.put((count, ids[i:i + size]))
+        count += 1
+    print '\t%d features in %d pages of %d' % (len(ids), count, size)
+
+    ## (page, (features, sha256), error) - bounded so fast workers wait for the writer
+    done = Queue.Queue(workers * 2)
+    connections = []
+
+    def Worker():
+        connection = Connection(url, timeout, record)
+        connections.append(connection)
+        try:
+            while True:
+                try:
+                    number, chunk = pages.get_nowait()
+                except Queue.Empty:
+                    return
+                params = QueryParams(where, oidField, names, chunk[0], chunk[-1])
+                attempt = 0
+                while True:
+                    attempt += 1
+                    try:
+                        done.put((number, Page(connection, path, params, oidField, chunk), None))
+                        break
+                    except (PageError, ValueError, KeyError, IOError, socket.error, httplib.HTTPException) as e:
+                        connection.Close()
+                        if attempt > retries:
+                            done.put((number, None, '%s: %s' % (type(e).__name__, e)))
+                            break
+                        time.sleep(backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.0))
+                connection.retries += attempt - 1
+        finally:
+            connection.Close()
+            done.put(None)
+
+    threads = [threading.Thread(target=Worker) for i in range(max(1, min(workers, count)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    checksums = {}
+    errors = []
+    written = 0
+    backend.CreateTable(output, schema, template)
+    with backend.Writer(output, list(fields) + [Shape]) as writer:
+        finished = 0
+        while finished < len(threads):
+            item = done.get()
+            if item is None:
+                finished += 1
+                continue
+            number, page, error = item
+            if error:
+                errors.append('page %d: %s' % (number, error))
+                continue
+            features, checksums[number] = page
+            for feature in features:
+                attributes = feature['attributes']
+                row = [attributes.get(name) for name in names]
+                for i in dates:
+                    if row[i] is not None:
+                        row[i] = Epoch + datetime.timedelta(milliseconds=row[i])
+                row.append(Rings(feature.get('geometry')))
+                writer.Write(row)
+                written += 1
+    for thread in threads:
+        thread.join()
+    main.Close()
+
+    seconds = time.time() - start
+    stats = {'features': written, 'pages': len(checksums), 'failed_pages': len(errors),
+             'requests': main.requests + sum(c.requests for c in connections),
+             'retries': sum(c.retries for c in connections),
+             'bytes': main.bytes + sum(c.bytes for c in connections),
+             'seconds': round(seconds, 3),
+             'pages_per_sec': round(len(checksums) / seconds, 1) if seconds else 0.0,
+             'features_per_sec': round(written / seconds, 1) if seconds else 0.0,
+             'checksums': [checksums[number] for number in sorted(checksums)]}
+    print '\t%(features)d features, %(pages)d pages in %(seconds).1f s (%(pages_per_sec).1f pages/sec, ' \
+          '%(features_per_sec).0f features/sec, %(retries)d retries)' % stats
+    if errors:
+        raise IOError('%d of %d pages failed - %s' % (len(errors), count, '; '.join(errors[:5])))
+    return stats
+
+############################################################################################
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves the recorded response for the path and query, failing some on purpose
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+        path = os.path.join(self.server.folder, Key(parts.path, params))
+        with self.server.lock:
+            roll = self.server.random.random()
+        if not os.path.exists(path):
+            return self.Send(404, '{"error": {"code": 404, "message": "not recorded"}}')
+        with open(path, 'rb') as f:
+            body = f.read()
+        if roll < self.server.failRate / 2:
+            return self.Send(503, 'busy')
+        if roll < self.server.failRate and params.get('returnGeometry'):
+            # Partial page - what a timed out server query looks like
+            page = json.loads(body)
+            page['features'] = page['features'][:len(page['features']) // 2]
+            body = json.dumps(page)
+        self.Send(200, body, {'Content-MD5': base64.b64encode(hashlib.md5(body).digest())})
+
+    def Send(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # server = StubServer(folder); server.Start(); Fetch(server.url + layerPath, ...); server.Stop()
+    daemon_threads = True
+
+    def __init__(self, folder, failRate=0.0, seed=1):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.folder = folder
+        self.failRate = failRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def Start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+############################################################################################
+
+def SelfTest(features=2500, pageSize=200, failRate=0.2, workers=4):
+    # Records a synthetic layer, serves it with failures and checks the fetch got it all
+    import Backends
+    folder = tempfile.mkdtemp()
+    path = '/arcgis/rest/services/AGOServices/Parcels/FeatureServer/0'
+    fields = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+              {'name': 'GPIN', 'type': 'esriFieldTypeString', 'length': 20},
+              {'name': 'LOCADDR', 'type': 'esriFieldTypeString', 'length': 60},
+              {'name': 'SALEDATE', 'type': 'esriFieldTypeDate', 'length': 8},
+              {'name': 'Shape__Area', 'type': 'esriFieldTypeDouble'}]
+    rng = random.Random(1)
+    ids = sorted(rng.sample(xrange(1, features * 2), features))
+    records = {}
+    for oid in ids:
+        x, y = rng.uniform(0, 10000), rng.uniform(0, 10000)
+        records[oid] = {'attributes': {'OBJECTID': oid, 'GPIN': 'G%06d' % oid, 'LOCADDR': '%d MAIN ST' % oid,
+                                       'SALEDATE': 1500000000000 + oid * 1000, 'Shape__Area': 100.0},
+                        'geometry': {'rings': [[[x, y], [x, y + 10], [x + 10, y + 10], [x + 10, y], [x, y]]]}}
+
+    def Save(subpath, params, response):
+        with open(os.path.join(folder, Key(subpath, params)), 'wb') as f:
+            f.write(json.dumps(response))
+    Save(path, {'f': 'json'}, {'fields': fields, 'maxRecordCount': pageSize,
+                               'extent': {'spatialReference': {'wkid': 102747, 'latestWkid': 2284}}})
+    Save(path + '/query', {'where': '1=1', 'returnIdsOnly': 'true', 'f': 'json'},
+         {'objectIdFieldName': 'OBJECTID', 'objectIds': list(reversed(ids))})
+    names = ['GPIN', 'LOCADDR', 'SALEDATE']
+    for i in range(0, len(ids), pageSize):
+        chunk = ids[i:i + pageSize]
+        Save(path + '/query', QueryParams('1=1', 'OBJECTID', names, chunk[0], chunk[-1]),
+             {'features': [records[oid] for oid in chunk]})
+
+    server = StubServer(folder, failRate)
+    server.Start()
+    try:
+        backend = Backends.MemoryBackend()
+        references = []
+        stats = Fetch(server.url + path, backend, 'YC', ['GPIN', 'LOCADDR', 'SALEDATE'], workers=workers,
+                      template=lambda sr: references.append(sr), backoff=0.01, retries=6)
+    finally:
+        server.Stop()
+        shutil.rmtree(folder)
+
+    rows = dict((row['GPIN'], row) for row in backend.tables['YC'])
+    assert stats['features'] == features == len(rows), stats
+    assert references == [{'wkid': 102747, 'latestWkid': 2284}]
+    for oid in ids:
+        row = rows['G%06d' % oid]
+        assert row['LOCADDR'] == '%d MAIN ST' % oid
+        assert row['SALEDATE'] == Epoch + datetime.timedelta(milliseconds=1500000000000 + oid * 1000)
+        assert row[Shape][0][0] == tuple(records[oid]['geometry']['rings'][0][0])
+    print 'RestSource self test passed (%d requests for %d pages, %d retries)' % (
+        stats['requests'], stats['pages'], stats['retries'])
+    return stats
+
+if __name__ == '__main__':
+    SelfTest()
@@ -0,0 +1,79 @@
+"""
+Name:     Scheduler.py
+Purpose:  Run each jurisdiction's fetch --> copy --> normalize chain as its own task on a process pool
+
+          The seven jurisdictions are independent until MergeParcels(), so wall clock time is
+          roughly the slowest jurisdiction instead of the sum of all seven. A failed task is
+          reported in the status and never stops the others.
+
+"""
+
+import multiprocessing, time, traceback
+
+############################################################################################
+
+def RunTask(key):
+    # Runs in the worker process. Never raises - errors come back in the status.
+    start = time.time()
+    try:
+        import MonthlyParcelUpdate
+        output = MonthlyParcelUpdate.RunJurisdiction(key)
+        return {'key': key, 'status': 'done', 'output': output, 'error': None,
+                'seconds': time.time() - start}
+    except Exception:
+        return {'key': key, 'status': 'failed', 'output': None, 'error': traceback.format_exc(),
+                'seconds': time.time() - start}
+
+def PrintStatus(status):
+    line = '\t%-4s %-8s %7.1f s' % (status['key'], status['status'], status.get('seconds') or 0.0)
+    if status['status'] == 'done':
+        line += '  ' + str(status['output'])
+    print line
+    if status.get('error'):
+        print '\t\t' + status['error'].strip().replace('\n', '\n\t\t')
+
+def Run(keys, workers=None, task=RunTask, timeout=None, poll=1.0):
+    # Returns {key: status}. workers defaults to one per jurisdiction, capped at the cpu count.
+    # A task still running after timeout seconds is marked 'timeout' and its worker killed.
+    if workers is None:
+        workers = min(len(keys), multiprocessing.cpu_count())
+    print 'Running %d jurisdictions on %d workers' % (len(keys), workers)
+
+    # One task per worker process so every jurisdiction starts with a clean arcpy environment
+    pool = multiprocessing.Pool(workers, maxtasksperchild=1)
+    start = time.time()
+    status = {}
+    pending = {}
+    for key in keys:
+        status[key] = {'key': key, 'status': 'queued', 'output': None, 'error': None, 'seconds': None}
+        pending[key] = pool.apply_async(task, (key,))
+    pool.close()
+
+    try:
+        while pending:
+            for key, result in pending.items():
+                if result.ready():
+                    try:
+                        status[key] = result.get()
+                    except Exception:
+                        # Worker died or the result could not be sent back
+                        status[key] = {'key': key, 'status': 'failed', 'output': None,
+                                       'error': traceback.format_exc(), 'seconds': time.time() - start}
+                    del pending[key]
+                    PrintStatus(status[key])
+                elif timeout is not None and time.time() - start > timeout:
+                    status[key]['status'] = 'timeout'
+                    status[key]['seconds'] = time.time() - start
+                    del pending[key]
+                    PrintStatus(status[key])
+            if pending:
+                time.sleep(poll)
+    finally:
+        if any(s['status'] == 'timeout' for s in status.values()):
+            pool.terminate()
+        pool.join()
+
+    # Merge barrier - everything above has finished one way or another
+    done = [key for key in keys if status[key]['status'] == 'done']
+    print '%d of %d jurisdictions done in %.1f s' % (len(done), len(keys), time.time() - start)
+    return status
@@ -0,0 +1,441 @@
+"""
+Name:     SpatialIndex.py
+Purpose:  Zip code and city assignment without SpatialJoin_analysis
+
+          PolygonIndex keeps the static ZipCode/City polygons in packed arrays with a uniform
+          grid over them. Assign() reads each parcel's center once and fills _Zip_Code_ and
+          _City_Loc_ together, without writing Master_Join_1_ZipCode / Master_Join_2_City.
+
+          Save()/Load() keep an index in a binary file that is memory mapped on later runs, and
+          Cached() only rebuilds it when the source layer's signature or the spatial reference
+          it was projected to changes. All the arrays
+          are fixed width so the file is used in place; worker processes mapping the same file
+          share one copy through the OS page cache. Only the coordinates stay on the map - the
+          bounds, grid cells and offsets are small and read one element at a time by Lookup(),
+          which is several times slower on NumPy views, so Load() copies them. Save() closes
+          this process's maps of a file before replacing it (Windows won't remove a mapped file).
+
+          Matches SpatialJoin_analysis JOIN_ONE_TO_ONE / HAVE_THEIR_CENTER_IN:
+          - the center is the true (area weighted) centroid, holes included
+          - a center on a polygon boundary (within Tolerance) is in that polygon
+          - where polygons share the boundary the lowest OBJECTID wins
+          - no match leaves the field null
+          - the zip code and city polygons are projected to the parcels' spatial reference
+            when they are read (Build(wkt=...)), and Check() refuses an index in any other
+
+"""
+
+import array, hashlib, itertools, math, mmap, os, struct, time, weakref
+import Backends, Geometry
+from Backends import Shape, Centroid, OID
+
+## 0.001 meters in US survey feet - the default XY tolerance for our state plane data
+Tolerance = 0.0032808333
+
+## Target number of polygons per grid cell
+CellLoad = 2.0
+
+## Parcels per assignment cache round trip
+Chunk = 1000
+
+############################################################################################
+
+class PolygonIndex(object):
+
+    def __init__(self):
+        self.labels = []
+        self.bounds = array.array('d')       # xmin, ymin, xmax, ymax per polygon
+        self.ringStart = array.array('i', [0])   # rings of polygon i are ringStart[i]:ringStart[i+1]
+        self.pointStart = array.array('i', [0])  # points of ring j are pointStart[j]:pointStart[j+1]
+        self.coords = array.array('d')       # x, y, x, y, ...
+        self.cellStart = array.array('i')    # polygons in cell c are cellItems[cellStart[c]:cellStart[c+1]]
+        self.cellItems = array.array('i')
+        self.grid = (0.0, 0.0, 1.0, 1, 1)    # xmin, ymin, cell size, columns, rows
+        self.signature = None
+        self.wkt = None                      # spatial reference of the coordinates, None if unknown
+        self.map = None
+        self.path = None
+
+    def Add(self, label, rings):
+        # Add polygons in OBJECTID order - the first match wins in Lookup
+        xs = [x for ring in rings for x, y in ring]
+        ys = [y for ring in rings for x, y in ring]
+        self.labels.append(label)
+        self.bounds.extend([min(xs), min(ys), max(xs), max(ys)])
+        for ring in rings:
+            for x, y in ring:
+                self.coords.append(x)
+                self.coords.append(y)
+            self.pointStart.append(len(self.coords) // 2)
+        self.ringStart.append(len(self.pointStart) - 1)
+
+    def BuildGrid(self):
+        count = len(self.labels)
+        b = self.bounds
+        xmin = min(b[0::4]); ymin = min(b[1::4]); xmax = max(b[2::4]); ymax = max(b[3::4])
+        width = max(xmax - xmin, 1e-9); height = max(ymax - ymin, 1e-9)
+        size = math.sqrt(width * height * CellLoad / max(count, 1))
+        columns = int(width / size) + 1
+        rows = int(height / size) + 1
+        cells = [[] for i in range(columns * rows)]
+        for i in range(count):
+            c0, r0 = self.Cell(b[4 * i] - Tolerance, b[4 * i + 1] - Tolerance, xmin, ymin, size, columns, rows)
+            c1, r1 = self.Cell(b[4 * i + 2] + Tolerance, b[4 * i + 3] + Tolerance, xmin, ymin, size, columns, rows)
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    cells[r * columns + c].append(i)
+        self.cellStart = array.array('i', [0])
+        self.cellItems = array.array('i')
+        for cell in cells:
+            self.cellItems.extend(cell)
+            self.cellStart.append(len(self.cellItems))
+        self.grid = (xmin, ymin, size, columns, rows)
+
+    def Cell(self, x, y, xmin, ymin, size, columns, rows):
+        c = min(max(int((x - xmin) / size), 0), columns - 1)
+        r = min(max(int((y - ymin) / size), 0), rows - 1)
+        return c, r
+
+    def Contains(self, i, x, y):
+        b = self.bounds
+        if x < b[4 * i] - Tolerance or x > b[4 * i + 2] + Tolerance or \
+           y < b[4 * i + 1] - Tolerance or y > b[4 * i + 3] + Tolerance:
+            return False
+        rings = [self.Ring(ring) for ring in range(self.ringStart[i], self.ringStart[i + 1])]
+        inside = False
+        for coords in rings:
+            for p in range(0, len(coords) - 2, 2):
+                x1, y1, x2, y2 = coords[p:p + 4]
+                if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                    inside = not inside
+        if inside:
+            return True
+        # On the boundary counts as in
+        for coords in rings:
+            for p in range(0, len(coords) - 2, 2):
+                x1, y1, x2, y2 = coords[p:p + 4]
+                if min(x1, x2) - Tolerance <= x <= max(x1, x2) + Tolerance and \
+                   min(y1, y2) - Tolerance <= y <= max(y1, y2) + Tolerance and \
+                   SegmentDistance(x, y, x1, y1, x2, y2) <= Tolerance:
+                    return True
+        return False
+
+    def Ring(self, ring):
+        # x, y, x, y, ... of one ring as a list (coords may be an array or a mapped numpy view)
+        return self.coords[2 * self.pointStart[ring]:2 * self.pointStart[ring + 1]].tolist()
+
+    def Release(self):
+        # Copies the coordinates off the cache file and closes the map
+        if self.map is None:
+            return
+        coords = array.array('d')
+        coords.fromstring(self.coords.tostring())
+        self.coords = coords
+        self.map.close()
+        self.map = None
+
+    def Lookup(self, x, y):
+        xmin, ymin, size, columns, rows = self.grid
+        if x < xmin - Tolerance or y < ymin - Tolerance or \
+           x > xmin + columns * size + Tolerance or y > ymin + rows * size + Tolerance:
+            return None
+        c, r = self.Cell(x, y, xmin, ymin, size, columns, rows)
+        cell = r * columns + c
+        for p in range(self.cellStart[cell], self.cellStart[cell + 1]):
+            i = self.cellItems[p]
+            if self.Contains(i, x, y):
+                return self.labels[i]
+        return None
+
+def SegmentDistance(x, y, x1, y1, x2, y2):
+    dx, dy = x2 - x1, y2 - y1
+    if dx == 0.0 and dy == 0.0:
+        return math.hypot(x - x1, y - y1)
+    t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+############################################################################################
+
+def Build(backend, table, labelField, wkt=None):
+    # Index every polygon of table, labelled with labelField. With wkt the polygons are read
+    # projected to it - the parcels' spatial reference, as SpatialJoin_analysis projected on the fly.
+    start = time.time()
+    index = PolygonIndex()
+    index.wkt = wkt
+    if wkt:
+        rows = backend.Search(table, [OID, labelField, Shape], None, wkt)
+    else:
+        rows = backend.Search(table, [OID, labelField, Shape])
+    rows = sorted(rows, key=lambda row: row[0])
+    for oid, label, shape in rows:
+        rings = backend.Rings(shape)
+        if rings:
+            index.Add(label, rings)
+    index.BuildGrid()
+    print '\tIndexed %d polygons from %s in %.1f s' % (len(index.labels), table, time.time() - start)
+    return index
+
+def Check(targets, wkt):
+    # Refuses indexes in another spatial reference than the parcels (wkt) - every lookup
+    # would quietly miss
+    for field, index in targets:
+        if not Geometry.SameCoordinates(index.wkt, wkt):
+            raise ValueError('%s index is in %s, the parcels in %s - rebuild it with Build(wkt=...)'
+                             % (field, index.wkt.split(';')[0][:60], wkt.split(';')[0][:60]))
+
+def Assign(backend, table, targets, cache=None):
+    # targets = [(field, PolygonIndex)]. One geometry read of table, then the fields are written
+    # by OBJECTID so the geometry is never rewritten. With an AssignmentCache only geometries
+    # not seen before are looked up in the indexes.
+    if hasattr(backend, 'SpatialReference'):
+        spatialReference = backend.SpatialReference(table)
+        Check(targets, spatialReference.exportToString() if hasattr(spatialReference, 'exportToString') else spatialReference)
+    start = time.time()
+    values = {}
+    if cache is None:
+        for oid, center in backend.Search(table, [OID, Centroid]):
+            values[oid] = [index.Lookup(*center) if center else None for field, index in targets]
+    else:
+        rows = backend.Search(table, [OID, Shape])
+        while True:
+            chunk = list(itertools.islice(rows, Chunk))
+            if not chunk:
+                break
+            values.update(Locate(backend, chunk, targets, cache))
+    fields = [OID] + [field for field, index in targets]
+    count = backend.UpdateRows(table, fields, lambda row: [row[0]] + values[row[0]])
+    elapsed = time.time() - start
+    print '\tAssigned %s to %d parcels in %.1f s (%.0f rows/sec)' % (
+        ', '.join(field for field, index in targets), count, elapsed, count / elapsed if elapsed else 0.0)
+    if cache is not None:
+        print '\tAssignment cache: %(hits)d hits, %(misses)d misses' % cache.Stats()
+    return count
+
+def Locate(backend, items, targets, cache):
+    # items = [(key, shape)] --> {key: [value per target]}, only cache misses are looked up
+    prints = [(key, Geometry.Fingerprint(backend.Rings(shape)), shape) for key, shape in items]
+    found = cache.Get(fingerprint for key, fingerprint, shape in prints)
+    new = {}
+    values = {}
+    for key, fingerprint, shape in prints:
+        if fingerprint in found:
+            cache.hits += 1
+        elif fingerprint in new:
+            cache.hits += 1
+            found[fingerprint] = new[fingerprint]
+        else:
+            cache.misses += 1
+            center = backend.Center(shape)
+            new[fingerprint] = found[fingerprint] = [index.Lookup(*center) if center else None for field, index in targets]
+        values[key] = found[fingerprint]
+    cache.Put(new)
+    return values
+
+def CacheSignature(targets):
+    # Signature for an AssignmentCache of these targets - None if an index has no signature
+    parts = []
+    for field, index in targets:
+        if not index.signature:
+            return None
+        parts.append(field + ':' + index.signature)
+    return hashlib.sha256('|'.join(parts)).hexdigest()
+
+############################################################################################
+
+Magic = 'PIDX0002'
+
+## Fixed width header: magic, signature, polygon/ring/point/cell/item counts, label bytes,
+## spatial reference bytes, grid
+Header = struct.Struct('<8s64s7i3d2i')
+
+Arrays = [('bounds', 'd'), ('ringStart', 'i'), ('pointStart', 'i'), ('coords', 'd'),
+          ('cellStart', 'i'), ('cellItems', 'i'), ('labelStart', 'i')]
+
+## Arrays Load() leaves on the map when NumPy is available, the rest are copied
+Views = ['coords']
+
+## Indexes of this process still mapping their cache file
+Mapped = weakref.WeakSet()
+
+def Save(index, path, signature):
+    # Written to a temp file and renamed so a half written cache is never picked up
+    labels = [(label or u'').encode('utf-8') if isinstance(label, unicode) else (label or '') for label in index.labels]
+    labelStart = array.array('i', [0])
+    for label in labels:
+        labelStart.append(labelStart[-1] + len(label))
+    blob = ''.join(labels)
+    wkt = (index.wkt or '').encode('utf-8')
+    index.labelStart = labelStart
+    xmin, ymin, size, columns, rows = index.grid
+    tempPath = path + '.tmp'
+    with open(tempPath, 'wb') as f:
+        f.write(Header.pack(Magic, signature, len(index.labels), len(index.pointStart), len(index.coords),
+                            len(index.cellStart), len(index.cellItems), len(blob), len(wkt), xmin, ymin, size, columns, rows))
+        for name, typecode in Arrays:
+            getattr(index, name).tofile(f)
+        f.write(blob)
+        f.write(wkt)
+    del index.labelStart
+    for mapped in list(Mapped):
+        if mapped.path == os.path.abspath(path):
+            mapped.Release()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tempPath, path)
+
+def Signature(path):
+    # Signature the cache file was built from, without mapping it
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        header = f.read(Header.size)
+    if len(header) < Header.size or header[:8] != Magic:
+        return None
+    return Header.unpack(header)[1].rstrip('\x00')
+
+def Load(path):
+    # Memory maps the cache - with NumPy the coordinates are a view on the map, otherwise copies
+    f = open(path, 'rb')
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    values = Header.unpack_from(data, 0)
+    magic, signature, polygons, rings, coords, cells, items, labelBytes, wktBytes = values[:9]
+    index = PolygonIndex()
+    index.signature = signature.rstrip('\x00')
+    index.grid = values[9:]
+    counts = {'bounds': 4 * polygons, 'ringStart': polygons + 1, 'pointStart': rings, 'coords': coords,
+              'cellStart': cells, 'cellItems': items, 'labelStart': polygons + 1}
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    offset = Header.size
+    for name, typecode in Arrays:
+        size = counts[name] * array.array(typecode).itemsize
+        if numpy is not None and name in Views:
+            values = numpy.frombuffer(data, numpy.dtype(typecode).newbyteorder('<'), counts[name], offset)
+        else:
+            values = array.array(typecode)
+            values.fromstring(data[offset:offset + size])
+        setattr(index, name, values)
+        offset += size
+    starts = index.labelStart.tolist()
+    index.labels = [data[offset + starts[i]:offset + starts[i + 1]].decode('utf-8') for i in range(polygons)]
+    del index.labelStart
+    offset += labelBytes
+    index.wkt = data[offset:offset + wktBytes].decode('utf-8') or None
+    index.map = data
+    index.path = os.path.abspath(path)
+    Mapped.add(index)
+    return index
+
+def Cached(backend, table, labelField, path, wkt=None):
+    # Index from the cache file at path, rebuilt first if table has changed since it was written
+    # or was projected to another spatial reference than wkt
+    signature = hashlib.sha256(backend.Signature(table, [labelField]) + '|' + (wkt or '')).hexdigest()
+    if Signature(path) == signature:
+        index = Load(path)
+        print '\tUsing cached index of %s (%d polygons)' % (table, len(index.labels))
+        return index
+    index = Build(backend, table, labelField, wkt)
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    Save(index, path, signature)
+    index.signature = signature
+    return index
+
+############################################################################################
+
+def Square(x, y, size):
+    return [[(x, y), (x, y + size), (x + size, y + size), (x + size, y), (x, y)]]
+
+def SyntheticData(parcels=500000, zones=(300, 40), side=100000.0, seed=1):
+    # Grids of zip code and city polygons with square parcels scattered over them
+    import random
+    random.seed(seed)
+    memory = Backends.MemoryBackend()
+    for name, count, label in (('ZipCode', zones[0], 'ZCTA5CE10'), ('City', zones[1], 'NAMELSAD')):
+        per = int(math.sqrt(count))
+        size = side / per
+        memory.tables[name] = [{label: '%s%d' % (name, i), Shape: Square((i % per) * size, (i // per) * size, size)}
+                               for i in range(per * per)]
+    memory.tables['Parcels'] = [{'_Zip_Code_': None, '_City_Loc_': None,
+                                 Shape: Square(random.uniform(0, side - 50), random.uniform(0, side - 50), 50.0)}
+                                for i in range(parcels)]
+    return memory
+
+def Benchmark(parcels=500000):
+    # Fused indexed assignment on synthetic data, no arcpy needed
+    memory = SyntheticData(parcels)
+    start = time.time()
+    zips = Build(memory, 'ZipCode', 'ZCTA5CE10')
+    cities = Build(memory, 'City', 'NAMELSAD')
+    Assign(memory, 'Parcels', [('_Zip_Code_', zips), ('_City_Loc_', cities)])
+    elapsed = time.time() - start
+    print '%d parcels: %.1f s (%.0f parcels/sec)' % (parcels, elapsed, parcels / elapsed)
+    return elapsed
+
+def LookupBenchmark(points=20000, path=None):
+    # Lookup() on a freshly built index against the same index loaded from its cache file
+    import random, tempfile
+    memory = SyntheticData(0)
+    index = Build(memory, 'ZipCode', 'ZCTA5CE10')
+    folder = tempfile.mkdtemp() if path is None else None
+    path = path or os.path.join(folder, 'ZipCode.pidx')
+    random.seed(2)
+    centers = [(random.uniform(0, 100000.0), random.uniform(0, 100000.0)) for i in range(points)]
+    try:
+        Save(index, path, 'benchmark')
+        loaded = Load(path)
+        times = []
+        for candidate in (index, loaded):
+            start = time.time()
+            found = [candidate.Lookup(x, y) for x, y in centers]
+            times.append(time.time() - start)
+        assert found == [index.Lookup(x, y) for x, y in centers]
+        # Replacing the file while it is mapped
+        Save(index, path, 'rebuilt')
+        assert loaded.map is None and loaded.Lookup(*centers[0]) == index.Lookup(*centers[0])
+        assert Load(path).signature == 'rebuilt'
+    finally:
+        if folder:
+            import shutil
+            shutil.rmtree(folder, ignore_errors=True)
+    print '%d lookups: built %.3f s, loaded %.3f s' % (points, times[0], times[1])
+    return times
+
+def CompareSpatialJoin(gdb, parcels=500000):
+    # Writes the synthetic data to gdb, then times ZipCodeJoin() + CityJoin() style SpatialJoins
+    # against Build() + Assign() on the same feature classes and counts any disagreements
+    import arcpy, os
+    memory = SyntheticData(parcels)
+    backend = Backends.ArcpyBackend()
+    schemas = {'ZipCode':  [('ZCTA5CE10', 'TEXT', 10)],
+               'City':     [('NAMELSAD', 'TEXT', 100)],
+               'Parcels':  [('_Zip_Code_', 'TEXT', 10), ('_City_Loc_', 'TEXT', 50)]}
+    for name, schema in schemas.items():
+        fields = [field for field, fieldType, length in schema]
+        if arcpy.Exists(os.path.join(gdb, name)):
+            arcpy.Delete_management(os.path.join(gdb, name))
+        backend.CreateTable(os.path.join(gdb, name), schema)
+        backend.Insert(os.path.join(gdb, name), fields + [Shape],
+                       ([record[field] for field in fields] + [record[Shape]] for record in memory.tables[name]))
+    fc = lambda name: os.path.join(gdb, name)
+
+    start = time.time()
+    arcpy.SpatialJoin_analysis(fc('Parcels'), fc('ZipCode'), fc('Join_1'), "JOIN_ONE_TO_ONE", "KEEP_ALL", "", "HAVE_THEIR_CENTER_IN")
+    arcpy.SpatialJoin_analysis(fc('Join_1'), fc('City'), fc('Join_2'), "JOIN_ONE_TO_ONE", "KEEP_ALL", "", "HAVE_THEIR_CENTER_IN")
+    joinSeconds = time.time() - start
+
+    start = time.time()
+    zips = Build(backend, fc('ZipCode'), 'ZCTA5CE10')
+    cities = Build(backend, fc('City'), 'NAMELSAD')
+    Assign(backend, fc('Parcels'), [('_Zip_Code_', zips), ('_City_Loc_', cities)])
+    indexSeconds = time.time() - start
+
+    joined = dict((row[0], row[1:]) for row in backend.Search(fc('Join_2'), ['TARGET_FID', 'ZCTA5CE10', 'NAMELSAD']))
+    differences = sum(1 for row in backend.Search(fc('Parcels'), [OID, '_Zip_Code_', '_City_Loc_'])
+                      if tuple(row[1:]) != tuple(joined.get(row[0], (None, None))))
+    print 'SpatialJoin x2: %.1f s   indexed: %.1f s   differences: %d' % (joinSeconds, indexSeconds, differences)
+    return joinSeconds, indexSeconds, differences
@@ -0,0 +1,252 @@
+"""
+Name:     Staging.py
+Purpose:  Publish by building the new parcels offline and swapping them in
+
+          Load() writes the new RealPropertyParcel to <live>_Staging and builds its spatial and
+          attribute indexes there, while readers keep using <live>. Promote() then renames
+          <live> to <live>_Previous and the staging table to <live>. Rollback() swaps <live>
+          and <live>_Previous back, and running it again rolls forward.
+
+          On SqliteBackend each swap is one transaction, so a reader on another connection sees
+          the old generation or the new one and never a partial layer. On sde the swap is
+          Rename_management calls, which need the services' schema locks released. The time
+          between them is the switchover Promote() reports. If a rename fails part way the ones
+          already made are undone, so the live name always has a layer, and the generation
+          before <live>_Previous is only dropped once the swap has worked.
+
+          Demo() runs a publish end to end on a sqlite file while a reader polls the live table
+          on its own connection. It reports how long the reader saw something other than a
+          complete generation, for an in-place FullUpdate() and for the swap.
+
+"""
+
+import os, shutil, sqlite3, tempfile, threading, time
+import Backends, Publish
+from Backends import Shape
+
+Staged = '_Staging'
+Previous = '_Previous'
+Retired = '_Retired'
+
+## Attribute indexes built on the staging table
+IndexFields = ['Parcel_ID']
+
+############################################################################################
+
+def Load(backend, table, target, live, fields, schema, template=None, indexFields=IndexFields):
+    # table (read with backend) --> <live>_Staging in target with its indexes. Readers of live
+    # are not touched. Returns the row count.
+    start = time.time()
+    staging = live + Staged
+    target.CreateTable(staging, schema, template)
+    count = target.Insert(staging, list(fields) + [Shape], backend.Search(table, list(fields) + [Shape]))
+    loaded = time.time()
+    target.Index(staging, indexFields)
+    print '\tStaged %d parcels in %s: loaded in %.1f s, indexed in %.1f s' % (
+        count, staging, loaded - start, time.time() - loaded)
+    return count
+
+def Swap(target, pairs):
+    # target.Rename(pairs). Where that isn't one transaction the renames are made one at a
+    # time, and if one fails those already made are undone in reverse before it is raised.
+    if getattr(target, 'AtomicRename', False):
+        target.Rename(pairs)
+        return
+    done = []
+    try:
+        for pair in pairs:
+            target.Rename([pair])
+            done.append(pair)
+    except Exception:
+        for table, name in reversed(done):
+            target.Rename([(name, table)])
+        raise
+
+def Promote(target, live):
+    # <live>_Staging becomes live, live becomes <live>_Previous (the generation before that is
+    # dropped once the swap has worked). Returns the seconds the swap took.
+    staging, previous, retired = live + Staged, live + Previous, live + Retired
+    if not target.Exists(staging):
+        raise RuntimeError('Nothing staged - %s does not exist' % staging)
+    if target.Exists(previous):
+        target.Drop(retired)
+        target.Rename([(previous, retired)])
+    start = time.time()
+    try:
+        if target.Exists(live):
+            Swap(target, [(live, previous), (staging, live)])
+        else:
+            target.Rename([(staging, live)])
+    except Exception:
+        if target.Exists(retired):
+            target.Rename([(retired, previous)])
+        raise
+    seconds = time.time() - start
+    target.Drop(retired)
+    print '\tSwapped %s into %s in %.3f s - %s kept for rollback' % (staging, live, seconds, previous)
+    return seconds
+
+def Rollback(target, live):
+    # Swap live and <live>_Previous. Returns the seconds the swap took.
+    previous, swapping = live + Previous, live + '_Rollback'
+    if not target.Exists(previous):
+        raise RuntimeError('No earlier generation - %s does not exist' % previous)
+    start = time.time()
+    Swap(target, [(live, swapping), (previous, live), (swapping, previous)])
+    seconds = time.time() - start
+    print '\tRolled %s back to the previous generation in %.3f s' % (live, seconds)
+    return seconds
+
+def Plan(target, live, rollback=False):
+    # What Promote() (or Rollback()) would rename, without touching target
+    staging, previous = live + Staged, live + Previous
+    if rollback:
+        if not target.Exists(previous):
+            return ['No earlier generation - %s does not exist' % previous]
+        return ['Rename %s to %s' % pair for pair in [(live, live + '_Rollback'), (previous, live), (live + '_Rollback', previous)]]
+    if not target.Exists(staging):
+        return ['Nothing staged - %s does not exist' % staging]
+    steps = []
+    if target.Exists(previous):
+        steps.append('Drop %s once the swap has worked' % previous)
+    if target.Exists(live):
+        steps.append('Rename %s to %s' % (live, previous))
+    steps.append('Rename %s to %s' % (staging, live))
+    return steps
+
+############################################################################################
+
+class Locked(Backends.MemoryBackend):
+    # MemoryBackend whose renames of the tables in locked fail, as Rename_management does on
+    # a layer a service still holds a schema lock on. Renames are one at a time, like sde.
+    def __init__(self, locked=()):
+        Backends.MemoryBackend.__init__(self)
+        self.locked = set(locked)
+
+    def Rename(self, pairs):
+        for table, name in pairs:
+            if table in self.locked:
+                raise RuntimeError('Cannot acquire a schema lock on ' + table)
+            Backends.MemoryBackend.Rename(self, [(table, name)])
+
+def SelfTest():
+    # A swap or rollback that fails part way leaves the live layer and the rollback
+    # generation where they were
+    def Generations(locked):
+        target = Locked(locked)
+        for table, rows in (('Parcels', 2), ('Parcels' + Previous, 1), ('Parcels' + Staged, 3)):
+            target.tables[table] = [{'Parcel_ID': str(i)} for i in range(rows)]
+        return target
+    counts = lambda target: dict((table, len(rows)) for table, rows in target.tables.items())
+    for locked in (['Parcels'], ['Parcels' + Staged]):
+        target = Generations(locked)
+        before = counts(target)
+        try:
+            Promote(target, 'Parcels')
+            raise AssertionError('swap with %s locked did not fail' % locked[0])
+        except RuntimeError:
+            pass
+        assert counts(target) == before, (locked, counts(target))
+    target = Generations([])
+    Promote(target, 'Parcels')
+    assert counts(target) == {'Parcels': 3, 'Parcels' + Previous: 2}
+    for locked in (['Parcels'], ['Parcels' + Previous]):
+        target.locked = set(locked)
+        try:
+            Rollback(target, 'Parcels')
+            raise AssertionError('rollback with %s locked did not fail' % locked[0])
+        except RuntimeError:
+            pass
+        assert counts(target) == {'Parcels': 3, 'Parcels' + Previous: 2}, (locked, counts(target))
+    target.locked = set()
+    Rollback(target, 'Parcels')
+    assert counts(target) == {'Parcels': 2, 'Parcels' + Previous: 3}
+    assert Plan(target, 'Parcels') == ['Nothing staged - Parcels_Staging does not exist']
+    print 'Staging self test passed: failed swaps and rollbacks put every generation back'
+
+############################################################################################
+
+class Reader(threading.Thread):
+    # Counts the rows of table on its own connection as fast as it can until stopped.
+    # samples = [(start, end, count or None if the read failed)]
+    def __init__(self, path, table):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.table = table
+        self.samples = []
+        self.stopping = threading.Event()
+
+    def run(self):
+        connection = sqlite3.connect(self.path, timeout=60)
+        while not self.stopping.is_set():
+            start = time.time()
+            try:
+                count = connection.execute('SELECT COUNT(*) FROM "%s"' % self.table).fetchone()[0]
+            except sqlite3.Error:
+                count = None
+            self.samples.append((start, time.time(), count))
+            time.sleep(0.001)
+        connection.close()
+
+    def Stop(self):
+        self.stopping.set()
+        self.join()
+
+def Visible(samples, complete):
+    # What the reader saw: reads, reads that weren't a complete generation (count not in
+    # complete, or failed), the span from the first such read to the end of the last, and the
+    # slowest read
+    bad = [(start, end) for start, end, count in samples if count not in complete]
+    return {'reads': len(samples), 'incomplete_reads': len(bad),
+            'incomplete_seconds': round(bad[-1][1] - bad[0][0], 4) if bad else 0.0,
+            'longest_read_seconds': round(max(end - start for start, end, count in samples), 4) if samples else 0.0}
+
+def Demo(parcels=50000, batchSize=Publish.BatchSize):
+    # In-place FullUpdate() and Load() + Promote() + Rollback() on a sqlite file with a reader
+    # polling the live table. Returns what the reader saw for each.
+    memory = Publish.Synthetic(parcels)
+    old, new = memory.Count('Old'), memory.Count('New')
+    schema = [('Parcel_ID', 'TEXT', 20), ('Name_Owner', 'TEXT', 100), ('Square_Feet', 'DOUBLE', 0)]
+    folder = tempfile.mkdtemp()
+    results = {}
+    try:
+        for mode in ('in place', 'swap'):
+            path = os.path.join(folder, mode.replace(' ', '') + '.sqlite')
+            target = Backends.SqliteBackend(path)
+            # Readers aren't held up by the staging writes, as with separate tables on sde
+            target.connection.execute('PRAGMA journal_mode=WAL')
+            Load(memory, 'Old', target, 'Parcels', Publish.Fields, schema)
+            Promote(target, 'Parcels')
+            reader = Reader(path, 'Parcels')
+            reader.start()
+            time.sleep(0.05)
+            start = time.time()
+            if mode == 'in place':
+                Publish.FullUpdate('New', 'Parcels', Publish.Fields, memory, target, batchSize)
+            else:
+                Load(memory, 'New', target, 'Parcels', Publish.Fields, schema)
+                results['switchover_seconds'] = Promote(target, 'Parcels')
+            seconds = time.time() - start
+            time.sleep(0.05)
+            reader.Stop()
+            assert target.Count('Parcels') == new
+            results[mode] = dict(Visible(reader.samples, (old, new)), publish_seconds=round(seconds, 3))
+            if mode == 'swap':
+                Rollback(target, 'Parcels')
+                assert target.Count('Parcels') == old and target.Count('Parcels' + Previous) == new
+                Rollback(target, 'Parcels')
+                assert target.Count('Parcels') == new
+            target.connection.close()
+    finally:
+        shutil.rmtree(folder)
+    for mode in ('in place', 'swap'):
+        print '\t%-9s publish %6.2f s, reader saw a partial layer for %6.3f s (%d of %d reads), slowest read %.3f s' % (
+            mode, results[mode]['publish_seconds'], results[mode]['incomplete_seconds'],
+            results[mode]['incomplete_reads'], results[mode]['reads'], results[mode]['longest_read_seconds'])
+    print '\tswitchover %.4f s' % results['switchover_seconds']
+    return results
+
+if __name__ == '__main__':
+    SelfTest()
+    Demo()
@@ -1,10 +1,11 @@
 import arcpy, datetime, os, zipfile, urllib
+import Config
 from arcpy import env
 
-env.workspace = r'R:\Divisions\InfoTech\Shared\GIS\Parcels'
+env.workspace = Config.Workspace
 env.overwriteoutput = True
 
-TodaysDate = datetime.datetime.today().strftime('%Y%m%d') # today's date in yyyymmdd format
+TodaysDate = Config.TodaysDate # today's date in yyyymmdd format
 
 WB  = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'Parcels_' + TodaysDate + '.gdb' + os.sep + 'WB'
 YC  = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'Parcels_' + TodaysDate + '.gdb' + os.sep + 'YC'
@@ -1,12 +1,13 @@
 
 
 import arcpy, datetime, os, zipfile, urllib
+import Backends, Config, Publish
 from arcpy import env
 
-env.workspace = r'R:\Divisions\InfoTech\Shared\GIS\Parcels'
+env.workspace = Config.Workspace
 env.overwriteoutput = True
 
-TodaysDate = datetime.datetime.today().strftime('%Y%m%d') # today's date in yyyymmdd format
+TodaysDate = Config.TodaysDate # today's date in yyyymmdd format
 
 ## Temporary fields are used so no duplicates cause errors when added to each feature class
 TempFields   = ['_Parcel_ID_','_Name_Owner_','_HouseNumber_','_Street_','_City_Loc_','_State_','_Zip_Code_',
@@ -44,24 +45,23 @@ def UpdateData():
     inWorkspace = DatabaseServer_Database_sde
     parentVersion = "sde.DEFAULT"
     versionName = "bkingery"
-    # Execute CreateVersion
-    arcpy.CreateVersion_management(inWorkspace, parentVersion, versionName, "PROTECTED")
-    print 'version created'
+    progress = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'PublishProgress.json'
+    if not Publish.InProgress(progress):
+        # Execute CreateVersion - already there when resuming
+        arcpy.CreateVersion_management(inWorkspace, parentVersion, versionName, "PROTECTED")
+        print 'version created'
 
     MASTER = r'R:\Divisions\InfoTech\Shared\GIS\Parcels\OS_Conway_sdeVector.sde\sdeVector.SDEDATAOWNER.Cadastral\sdeVector.SDEDATAOWNER.RealPropertyParcel'
-    # Create the layers
-    arcpy.MakeFeatureLayer_management(MASTER,'parcel_lyr')
+    # Create the layers - through a connection to the version, which the edit session is
+    # opened on too, so the saved batches go to bkingery and not DEFAULT
+    connection = env.workspace + os.sep + 'UpdateFolder' + os.sep + TodaysDate + os.sep + 'OS_Conway_sdeVector_bkingery.sde'
+    versionWorkspace = Backends.ArcpyBackend().ConnectVersion(inWorkspace, 'BKINGERY.' + versionName, connection)
+    arcpy.MakeFeatureLayer_management(versionWorkspace + MASTER[len(inWorkspace):],'parcel_lyr')
     print 'make layer complete'
-    arcpy.ChangeVersion_management('parcel_lyr','TRANSACTIONAL','BKINGERY.bkingery')
-    print 'change version'
     
-    # Delete rows in versioned feature class
-    arcpy.DeleteFeatures_management('parcel_lyr')
-    print 'Parcels deleted'
-
-    try:
-        arcpy.Append_management(CleanedParcels, 'parcel_lyr', "TEST")
-        print 'Parcels updated'
-    except:
-        print 'Error, but still check the version, it might have worked'
+    # Delete and insert every parcel in saved batches - run again to resume if it fails
+    # part way (see Publish.py)
+    Publish.FullUpdate(CleanedParcels, 'parcel_lyr', FinalFields, target=Backends.ArcpyBackend(versionWorkspace),
+                       progress=progress)
+    print 'Parcels updated'
 
@@ -0,0 +1,348 @@
+"""
+Name:     ZipSource.py
+Purpose:  Read the delivered shapefiles straight out of their zip archives
+
+          ZipReader(archive).Search(member, fields) reads the .shp and .dbf members of
+          Parcels.zip, JCC_Parcels.zip, Parcel.zip ... and yields rows like a Backend cursor
+          (Shape as rings, see Geometry.py), so FieldMap.Normalize() can write the normalized
+          table without extracting the archive and copying the shapefile into the gdb first.
+
+          - Stored members are memory-mapped in place
+          - Deflated members are decompressed as they are read
+          - Only polygon shapefiles (types 5, 15, 25) - Z and M values are ignored
+
+          A file geodatabase inside a zip (Waterworks.zip) can't be read this way. OgrReader
+          reads it through GDAL's /vsizip/ when osgeo is installed, otherwise ExtractMembers()
+          extracts just the .gdb folder.
+
+          SelfTest() writes small shapefiles into stored and deflated zips and reads them back.
+
+"""
+
+import datetime, mmap, os, shutil, struct, tempfile, zipfile
+
+## Shape types read as polygons
+PolygonTypes = (5, 15, 25)
+
+## Used when the archive has no .cpg for the .dbf
+Encoding = 'cp1252'
+
+############################################################################################
+
+class MappedMember(object):
+    # read(n) over a stored member, memory-mapped in place. Only the member is mapped so a
+    # large archive doesn't need that much address space (32 bit ArcMap python).
+
+    def __init__(self, path, info):
+        self.file = open(path, 'rb')
+        self.file.seek(info.header_offset)
+        header = self.file.read(30)
+        if header[:4] != 'PK\x03\x04':
+            raise zipfile.BadZipfile('Bad local header for ' + info.filename)
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        start = info.header_offset + 30 + nameLength + extraLength
+        aligned = start - start % mmap.ALLOCATIONGRANULARITY
+        self.size = info.file_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), self.size + start - aligned, access=mmap.ACCESS_READ, offset=aligned)
+        else:
+            self.map = ''
+        self.position = start - aligned
+        self.end = self.position + self.size
+
+    def read(self, n=-1):
+        if n < 0 or self.position + n > self.end:
+            n = self.end - self.position
+        data = self.map[self.position:self.position + n]
+        self.position += n
+        return data
+
+    def close(self):
+        if self.size:
+            self.map.close()
+        self.file.close()
+
+def Open(archive, info):
+    # File-like read(n) of a member
+    if info.compress_type == zipfile.ZIP_STORED:
+        return MappedMember(archive.filename, info)
+    return archive.open(info)
+
+def ReadExactly(stream, n):
+    data = stream.read(n)
+    while len(data) < n:
+        more = stream.read(n - len(data))
+        if not more:
+            raise EOFError('Truncated shapefile member')
+        data += more
+    return data
+
+############################################################################################
+
+def DbfHeader(stream):
+    # (record count, record length, [(name, type, length, decimals)])
+    header = ReadExactly(stream, 32)
+    count, headerLength, recordLength = struct.unpack('<IHH', header[4:12])
+    fields = []
+    descriptors = ReadExactly(stream, headerLength - 32)
+    for i in range(0, len(descriptors) - 1, 32):
+        descriptor = descriptors[i:i + 32]
+        if descriptor[0] == '\r':
+            break
+        name = descriptor[:11].split('\x00')[0]
+        fields.append((name, descriptor[11], ord(descriptor[16]), ord(descriptor[17])))
+    return count, recordLength, fields
+
+def DbfValue(raw, fieldType, decimals, encoding):
+    if fieldType in 'CM':
+        return raw.rstrip(' \x00').decode(encoding)
+    value = raw.strip(' \x00')
+    if fieldType in 'NF':
+        if not value or value.startswith('*'):
+            return None
+        if decimals == 0 and '.' not in value:
+            return int(value)
+        return float(value)
+    if fieldType == 'D':
+        if not value.strip('0'):
+            return None
+        return datetime.datetime.strptime(value, '%Y%m%d')
+    if fieldType == 'L':
+        return {'T': True, 'Y': True, 'F': False, 'N': False}.get(value.upper()[:1])
+    return value
+
+def ShpRecord(stream):
+    # Rings of the next record, None for a null shape
+    number, length = struct.unpack('>ii', ReadExactly(stream, 8))
+    content = ReadExactly(stream, length * 2)
+    shapeType, = struct.unpack_from('<i', content, 0)
+    if shapeType == 0:
+        return None
+    if shapeType not in PolygonTypes:
+        raise ValueError('Shape type %d is not a polygon' % shapeType)
+    parts, points = struct.unpack_from('<ii', content, 36)
+    starts = list(struct.unpack_from('<%di' % parts, content, 44)) + [points]
+    values = struct.unpack_from('<%dd' % (2 * points), content, 44 + 4 * parts)
+    coordinates = zip(values[0::2], values[1::2])
+    return [coordinates[starts[i]:starts[i + 1]] for i in range(parts)]
+
+############################################################################################
+
+class ZipReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path, 'r')
+
+    def Member(self, name, extension):
+        # Member ending in name + extension, any folder, any case
+        wanted = os.path.splitext(name.replace('\\', '/'))[0].lower() + extension
+        for info in self.archive.infolist():
+            filename = info.filename.lower()
+            if filename == wanted or filename.endswith('/' + wanted):
+                return info
+        return None
+
+    def Fields(self, member):
+        stream = Open(self.archive, self.Member(member, '.dbf'))
+        try:
+            return [name for name, fieldType, length, decimals in DbfHeader(stream)[2]]
+        finally:
+            stream.close()
+
+    def Projection(self, member):
+        # Well known text of the .prj, None if there isn't one
+        info = self.Member(member, '.prj')
+        return self.archive.read(info).strip() if info else None
+
+    def Count(self, member):
+        stream = Open(self.archive, self.Member(member, '.dbf'))
+        try:
+            return DbfHeader(stream)[0]
+        finally:
+            stream.close()
+
+    def Search(self, member, fields, where=None):
+        # Rows of fields (Backends.Shape for the rings), deleted records skipped
+        from Backends import Shape
+        dbfInfo = self.Member(member, '.dbf')
+        shpInfo = self.Member(member, '.shp')
+        if dbfInfo is None or shpInfo is None:
+            raise IOError('%s has no %s shapefile' % (self.path, member))
+        cpg = self.Member(member, '.cpg')
+        encoding = self.archive.read(cpg).strip() if cpg else Encoding
+        dbf = Open(self.archive, dbfInfo)
+        shp = Open(self.archive, shpInfo)
+        try:
+            count, recordLength, dbfFields = DbfHeader(dbf)
+            layout = {}
+            offset = 1
+            for name, fieldType, length, decimals in dbfFields:
+                layout[name.upper()] = (offset, length, fieldType, decimals)
+                offset += length
+            for field in fields:
+                if field != Shape and field.upper() not in layout:
+                    raise KeyError('%s has no field %s' % (member, field))
+            wanted = [None if field == Shape else layout[field.upper()] for field in fields]
+            ReadExactly(shp, 100)
+            for i in range(count):
+                record = ReadExactly(dbf, recordLength)
+                rings = ShpRecord(shp)
+                if record[0] == '*':
+                    continue
+                row = [rings if spec is None else
+                       DbfValue(record[spec[0]:spec[0] + spec[1]], spec[2], spec[3], encoding) for spec in wanted]
+                if where is None or where(dict(zip(fields, row))):
+                    yield row
+        finally:
+            dbf.close()
+            shp.close()
+
+    def Close(self):
+        self.archive.close()
+
+############################################################################################
+
+class OgrReader(object):
+    # A layer of a file geodatabase inside a zip through GDAL's /vsizip/, e.g.
+    # OgrReader(POQZip, 'Waterworks/Waterworks.gdb').Search('Tax_Parcels', fields)
+
+    def __init__(self, path, dataset):
+        from osgeo import ogr
+        self.source = ogr.Open('/vsizip/' + path.replace('\\', '/') + '/' + dataset)
+        if self.source is None:
+            raise IOError('GDAL could not open %s in %s' % (dataset, path))
+
+    def Projection(self, layer):
+        reference = self.source.GetLayerByName(layer).GetSpatialRef()
+        return reference.ExportToWkt() if reference else None
+
+    def Search(self, layer, fields, where=None):
+        from Backends import Shape
+        for feature in self.source.GetLayerByName(layer):
+            geometry = feature.GetGeometryRef()
+            row = [Rings(geometry) if field == Shape else feature.GetField(field) for field in fields]
+            if where is None or where(dict(zip(fields, row))):
+                yield row
+
+def Rings(geometry):
+    # OGR polygon / multipolygon --> rings
+    if geometry is None:
+        return None
+    if geometry.GetGeometryCount() and geometry.GetGeometryRef(0).GetGeometryCount():
+        polygons = [geometry.GetGeometryRef(i) for i in range(geometry.GetGeometryCount())]
+    else:
+        polygons = [geometry]
+    rings = []
+    for polygon in polygons:
+        for i in range(polygon.GetGeometryCount()):
+            ring = polygon.GetGeometryRef(i)
+            rings.append([(ring.GetX(j), ring.GetY(j)) for j in range(ring.GetPointCount())])
+    return rings
+
+def ExtractMembers(path, prefix, folder):
+    # Extracts only the members under prefix (e.g. 'Waterworks/Waterworks.gdb/'), skipping
+    # files already there with the same size. Returns the extracted folder.
+    with zipfile.ZipFile(path, 'r') as archive:
+        for info in archive.infolist():
+            if not info.filename.startswith(prefix) or info.filename.endswith('/'):
+                continue
+            target = os.path.join(folder, *info.filename.split('/'))
+            if os.path.exists(target) and os.path.getsize(target) == info.file_size:
+                continue
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with archive.open(info) as source:
+                with open(target, 'wb') as output:
+                    shutil.copyfileobj(source, output, 1024 * 1024)
+    return os.path.join(folder, *prefix.rstrip('/').split('/'))
+
+############################################################################################
+
+def WriteShapefile(base, fields, rows):
+    # Small polygon shapefile writer for SelfTest(). fields = [(name, 'C' or 'N', length, decimals)],
+    # rows = [[value, ..., rings]]
+    records = []
+    for row in rows:
+        rings = row[-1]
+        if rings is None:
+            records.append(struct.pack('<i', 0))
+            continue
+        points = [point for ring in rings for point in ring]
+        xs = [x for x, y in points]
+        ys = [y for x, y in points]
+        starts = []
+        for ring in rings:
+            starts.append(sum(len(r) for r in rings[:len(starts)]))
+        records.append(struct.pack('<i4d2i', 5, min(xs), min(ys), max(xs), max(ys), len(rings), len(points)) +
+                       struct.pack('<%di' % len(starts), *starts) +
+                       struct.pack('<%dd' % (2 * len(points)), *[v for point in points for v in point]))
+    shp = []
+    shx = []
+    offset = 50
+    for number, content in enumerate(records, 1):
+        shp.append(struct.pack('>ii', number, len(content) // 2) + content)
+        shx.append(struct.pack('>ii', offset, len(content) // 2))
+        offset += 4 + len(content) // 2
+    def Header(length):
+        return struct.pack('>i5ii', 9994, 0, 0, 0, 0, 0, length) + struct.pack('<ii8d', 1000, 5, *([0.0] * 8))
+    shpData = ''.join(shp)
+    with open(base + '.shp', 'wb') as f:
+        f.write(Header(50 + len(shpData) // 2) + shpData)
+    with open(base + '.shx', 'wb') as f:
+        f.write(Header(50 + 4 * len(shx)) + ''.join(shx))
+
+    recordLength = 1 + sum(length for name, fieldType, length, decimals in fields)
+    headerLength = 32 + 32 * len(fields) + 1
+    dbf = [struct.pack('<B3BIHH20x', 3, 116, 1, 1, len(rows), headerLength, recordLength)]
+    for name, fieldType, length, decimals in fields:
+        dbf.append(struct.pack('<11sc4xBB14x', name, fieldType, length, decimals))
+    dbf.append('\r')
+    for row in rows:
+        dbf.append(' ')
+        for (name, fieldType, length, decimals), value in zip(fields, row[:-1]):
+            if value is None:
+                text = ''
+            elif fieldType == 'N':
+                text = ('%.*f' % (decimals, value)).rjust(length)
+            else:
+                text = value.encode(Encoding)
+            dbf.append(text[:length].ljust(length))
+    dbf.append('\x1a')
+    with open(base + '.dbf', 'wb') as f:
+        f.write(''.join(dbf))
+
+def SelfTest():
+    # Writes a shapefile into a stored and a deflated zip, reads both back and compares
+    from Backends import Shape
+    folder = tempfile.mkdtemp()
+    try:
+        fields = [('PID', 'C', 20, 0), ('LUCat', 'C', 30, 0), ('STRTNUMB', 'N', 10, 0), ('ACRES', 'N', 12, 3)]
+        square = [[(0.0, 0.0), (0.0, 10.0), (10.0, 10.0), (10.0, 0.0), (0.0, 0.0)]]
+        holed = [[(100.0, 100.0), (100.0, 200.0), (200.0, 200.0), (200.0, 100.0), (100.0, 100.0)],
+                 [(120.0, 120.0), (180.0, 120.0), (180.0, 180.0), (120.0, 180.0), (120.0, 120.0)]]
+        rows = [[u'100-1', u'Residential', 123, 1.5, square],
+                [u'100-2', u'Caf\xe9', None, None, holed],
+                [u'', u'', 0, 0.25, None]]
+        base = os.path.join(folder, 'Parcels')
+        WriteShapefile(base, fields, rows)
+        names = [name for name, fieldType, length, decimals in fields]
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            path = os.path.join(folder, 'Parcels_%d.zip' % compression)
+            with zipfile.ZipFile(path, 'w', compression) as archive:
+                for extension in ('.shp', '.shx', '.dbf'):
+                    archive.write(base + extension, 'Parcel/Parcels' + extension)
+            reader = ZipReader(path)
+            read = list(reader.Search('Parcels.shp', names + [Shape]))
+            if read != rows:
+                raise AssertionError('Compression %d read %r, expected %r' % (compression, read, rows))
+            if reader.Count('Parcels') != len(rows):
+                raise AssertionError('Compression %d count' % compression)
+            reader.Close()
+        extracted = ExtractMembers(path, 'Parcel/', os.path.join(folder, 'Extracted'))
+        if sorted(os.listdir(extracted)) != ['Parcels.dbf', 'Parcels.shp', 'Parcels.shx']:
+            raise AssertionError('ExtractMembers')
+        print 'ZipSource self test passed'
+        return True
+    finally:
+        shutil.rmtree(folder, True)